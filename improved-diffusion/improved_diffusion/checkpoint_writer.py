@@ -0,0 +1,187 @@
+"""
+Asynchronous, atomic checkpoint writing with a retention policy.
+
+State dicts are snapshotted to CPU on the training thread, then serialized on
+a background thread. Local files are written to a temporary name, fsynced and
+renamed, so a crash never leaves a truncated checkpoint behind; blob storage
+paths are written through blobfile, which only commits on close. After every
+complete checkpoint a "latest" pointer is updated (see
+train_util.find_resume_checkpoint()) and old checkpoints are pruned.
+"""
+
+import os
+import re
+import threading
+
+import blobfile as bf
+import torch as th
+
+from . import logger
+
+LATEST_POINTER = "latest"
+
+# Files written for a training step, e.g. model001000.pt, ema_0.9999_001000.pt.
+_CHECKPOINT_RE = re.compile(r"^(?:model|opt|scaler|state|ema_[0-9.]+_)(\d+)\.pt$")
+
+
+def _is_local(path):
+    return "://" not in path
+
+
+def _to_cpu(obj):
+    """
+    Copy every tensor of a (nested) state dict to CPU memory, so that training
+    can keep updating the originals while the copy is being written.
+    """
+    if th.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """
+    th.save() obj to path such that path is either absent, its old version,
+    or complete.
+    """
+    atomic_write(path, lambda f: th.save(obj, f))
+
+
+def atomic_write(path, write):
+    """
+    Call write() with a binary file object such that path is either absent,
+    its old version, or everything write() wrote.
+    """
+    if not _is_local(path):
+        with bf.BlobFile(path, "wb") as f:
+            write(f)
+        return
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # not supported on every platform / filesystem
+    finally:
+        os.close(fd)
+
+
+def _write_text(text, path):
+    if not _is_local(path):
+        with bf.BlobFile(path, "w") as f:
+            f.write(text)
+        return
+    tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_latest_checkpoint(checkpoint_dir):
+    """
+    Get the path of the model file of the latest complete checkpoint in a
+    directory, or None.
+    """
+    if not checkpoint_dir:
+        return None
+    pointer = bf.join(checkpoint_dir, LATEST_POINTER)
+    if not bf.exists(pointer):
+        return None
+    with bf.BlobFile(pointer, "r") as f:
+        filename = f.read().strip()
+    path = bf.join(checkpoint_dir, filename)
+    return path if bf.exists(path) else None
+
+
+class CheckpointWriter:
+    """
+    Writes the files of a checkpoint step, at most one step in flight.
+
+    :param checkpoint_dir: the directory to write to.
+    :param keep_last: keep the checkpoints of the last N steps; 0 keeps all.
+    :param keep_every: also keep the checkpoints of steps divisible by K.
+    :param async_write: if False, write on the calling thread.
+    """
+
+    def __init__(self, checkpoint_dir, keep_last=0, keep_every=0, async_write=True):
+        self.checkpoint_dir = checkpoint_dir
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.async_write = async_write
+        self._thread = None
+        self._error = None
+
+    def save(self, step, files, model_filename):
+        """
+        Write a checkpoint step.
+
+        :param step: the training step, used for retention.
+        :param files: a dict of filename -> object to th.save().
+        :param model_filename: the file the "latest" pointer refers to.
+        """
+        self.wait()
+        for name in files:
+            logger.log(f"writing to {bf.join(self.checkpoint_dir, name)}")
+        files = {name: _to_cpu(obj) for name, obj in files.items()}
+        if self.async_write:
+            self._thread = threading.Thread(
+                target=self._run, args=(step, files, model_filename), daemon=True
+            )
+            self._thread.start()
+        else:
+            self._write(step, files, model_filename)
+
+    def wait(self):
+        """
+        Block until the pending checkpoint is written, re-raising its error.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self, step, files, model_filename):
+        try:
+            self._write(step, files, model_filename)
+        except BaseException as e:  # surfaced by the next wait()
+            self._error = e
+
+    def _write(self, step, files, model_filename):
+        for name, obj in files.items():
+            atomic_save(obj, bf.join(self.checkpoint_dir, name))
+        _write_text(model_filename, bf.join(self.checkpoint_dir, LATEST_POINTER))
+        self._prune(step)
+
+    def _prune(self, current_step):
+        if self.keep_last <= 0:
+            return
+        by_step = {}
+        for name in bf.listdir(self.checkpoint_dir):
+            match = _CHECKPOINT_RE.match(name)
+            if match:
+                by_step.setdefault(int(match.group(1)), []).append(name)
+        keep = set(sorted(by_step)[-self.keep_last:]) | {current_step}
+        for step, names in by_step.items():
+            if step in keep or (self.keep_every > 0 and step % self.keep_every == 0):
+                continue
+            for name in names:
+                bf.remove(bf.join(self.checkpoint_dir, name))
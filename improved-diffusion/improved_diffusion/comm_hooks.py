@@ -0,0 +1,75 @@
+"""
+DDP communication hooks that compress the gradients before they are
+all-reduced, for data parallelism over slow links.
+
+- fp16 / bf16: all-reduce the gradient buckets in half precision (half the
+  bytes; bf16 keeps the range of fp32, fp16 keeps more mantissa bits).
+- powersgd: all-reduce rank-r factors P (n x r) and Q (m x r) of every n x m
+  gradient matrix instead of the matrix (Vogels et al., 2019), with error
+  feedback so that what is not sent is added to the next step's gradient.
+  Buckets too small to be worth compressing, and every bucket during the
+  first powersgd_start_iter steps, are all-reduced uncompressed.
+- powersgd_fp16 / powersgd_bf16: powersgd with the factors in half precision.
+
+Hooks only run when DDP synchronizes, i.e. on the last microbatch of a step
+(the others run under no_sync()), so they compress the accumulated gradient.
+The PowerSGD error feedback buffers are not checkpointed; they start from
+zero after a restart.
+"""
+
+import torch as th
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+COMM_HOOKS = ("", "fp16", "bf16", "powersgd", "powersgd_fp16", "powersgd_bf16")
+
+
+def register_comm_hook(ddp_model, name, powersgd_rank=1, powersgd_start_iter=1000):
+    """
+    Register a compression hook on a DistributedDataParallel model.
+
+    :param name: one of COMM_HOOKS; "" keeps DDP's uncompressed all-reduce.
+    :param powersgd_rank: the rank of the PowerSGD approximation.
+    :param powersgd_start_iter: the number of steps all-reduced uncompressed
+                                before PowerSGD kicks in.
+    """
+    assert name in COMM_HOOKS, f"unknown DDP communication hook: {name}"
+    if not name:
+        return
+    if name == "fp16":
+        ddp_model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+        return
+    if name == "bf16":
+        ddp_model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+        return
+    state = powerSGD_hook.PowerSGDState(
+        process_group=None,
+        matrix_approximation_rank=powersgd_rank,
+        # Error feedback and warm start need at least one uncompressed step.
+        start_powerSGD_iter=max(powersgd_start_iter, 2),
+    )
+    hook = powerSGD_hook.powerSGD_hook
+    if name == "powersgd_fp16":
+        hook = default_hooks.fp16_compress_wrapper(hook)
+    elif name == "powersgd_bf16":
+        hook = default_hooks.bf16_compress_wrapper(hook)
+    if dist.get_backend() == "gloo":
+        hook = _one_bucket_at_a_time(hook)
+    ddp_model.register_comm_hook(state, hook)
+
+
+def _one_bucket_at_a_time(hook):
+    """
+    Finish a bucket before the next one starts.
+
+    PowerSGD chains all-reduces in future callbacks, which gloo runs on its
+    own threads: with several buckets in flight, ranks can issue them in
+    different orders and deadlock.
+    """
+
+    def hook_one_bucket(state, bucket):
+        fut = th.futures.Future()
+        fut.set_result(hook(state, bucket).wait())
+        return fut
+
+    return hook_one_bucket
@@ -1,22 +1,66 @@
 """
 Helpers for distributed training.
+
+Processes are started either by torchrun (or any launcher setting the
+torch.distributed variables RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT),
+which can restart failed workers with a different world size, or by mpiexec.
+mpi4py is only imported, and only needed, in the latter case; a process
+started on its own is a world of one.
 """
 
 import io
+import mmap
 import os
 import socket
+import tempfile
+import uuid
 
 import blobfile as bf
-from mpi4py import MPI
 import torch as th
 import torch.distributed as dist
 
+from .indexed_checkpoint import IndexedCheckpoint, is_indexable, is_indexed_checkpoint, write_indexed
+
 # Change this to reflect your cluster layout.
-# The GPU for a given rank is (rank % GPUS_PER_NODE).
+# With mpiexec, the GPU for a given rank is (rank % GPUS_PER_NODE); torchrun
+# ranks use the GPU of their LOCAL_RANK.
 GPUS_PER_NODE = 1 #8
 
 SETUP_RETRY_COUNT = 3
 
+# The largest message of a checkpoint sent between nodes, well below the 2 GiB
+# limit of MPI counts.
+SHARED_LOAD_CHUNK_BYTES = 64 * 2 ** 20
+
+_ENV_LAUNCH_VARIABLES = ("RANK", "WORLD_SIZE", "MASTER_ADDR", "MASTER_PORT")
+
+_launcher = None
+_comms = None
+
+
+def launcher():
+    """
+    Get how this process was started: "env" (torchrun), "mpi" (mpiexec, or
+    any process if mpi4py is installed) or "single".
+    """
+    global _launcher
+    if _launcher is None:
+        if all(name in os.environ for name in _ENV_LAUNCH_VARIABLES):
+            _launcher = "env"
+        elif _import_mpi() is not None:
+            _launcher = "mpi"
+        else:
+            _launcher = "single"
+    return _launcher
+
+
+def _import_mpi():
+    try:
+        from mpi4py import MPI  # calls MPI_Init()
+    except ImportError:
+        return None
+    return MPI
+
 
 def setup_dist():
     """
@@ -25,19 +69,35 @@ def setup_dist():
     if dist.is_initialized():
         return
 
-    comm = MPI.COMM_WORLD
     backend = "gloo" if not th.cuda.is_available() else "nccl"
-
-    if backend == "gloo":
-        hostname = "localhost"
+    kind = launcher()
+    if kind == "env":
+        local_size = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+        if backend == "nccl":
+            th.cuda.set_device(dev())
+    elif kind == "mpi":
+        MPI = _import_mpi()
+        comm = MPI.COMM_WORLD
+        single_node = len(set(comm.allgather(socket.gethostname()))) == 1
+        if backend == "gloo" and single_node:
+            hostname = "localhost"
+        else:
+            hostname = socket.gethostbyname(socket.getfqdn())
+        local_size = comm.Split_type(MPI.COMM_TYPE_SHARED).Get_size()
+        os.environ["MASTER_ADDR"] = comm.bcast(hostname, root=0)
+        os.environ["RANK"] = str(comm.rank)
+        os.environ["WORLD_SIZE"] = str(comm.size)
+        os.environ["MASTER_PORT"] = str(comm.bcast(_find_free_port(), root=0))
     else:
-        hostname = socket.gethostbyname(socket.getfqdn())
-    os.environ["MASTER_ADDR"] = comm.bcast(hostname, root=0)
-    os.environ["RANK"] = str(comm.rank)
-    os.environ["WORLD_SIZE"] = str(comm.size)
-
-    port = comm.bcast(_find_free_port(), root=0)
-    os.environ["MASTER_PORT"] = str(port)
+        local_size = 1
+        os.environ["MASTER_ADDR"] = "localhost"
+        os.environ["RANK"] = "0"
+        os.environ["WORLD_SIZE"] = "1"
+        os.environ["MASTER_PORT"] = str(_find_free_port())
+    if backend == "gloo" and "OMP_NUM_THREADS" not in os.environ:
+        # Split the cores of a node between its ranks instead of having every
+        # rank spawn a thread per core.
+        th.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
     dist.init_process_group(backend=backend, init_method="env://")
 
 
@@ -46,23 +106,240 @@ def dev():
     Get the device to use for torch.distributed.
     """
     if th.cuda.is_available():
-        return th.device(f"cuda:{MPI.COMM_WORLD.Get_rank() % GPUS_PER_NODE}")
+        if launcher() == "env":
+            return th.device(f"cuda:{os.environ.get('LOCAL_RANK', 0)}")
+        return th.device(f"cuda:{get_rank() % GPUS_PER_NODE}")
     return th.device("cpu")
 
 
-def load_state_dict(path, **kwargs):
+def get_rank():
+    """
+    Get the rank of this process, also before setup_dist().
+    """
+    if dist.is_initialized():
+        return dist.get_rank()
+    kind = launcher()
+    if kind == "mpi":
+        return _import_mpi().COMM_WORLD.Get_rank()
+    return int(os.environ["RANK"]) if kind == "env" else 0
+
+
+def get_world_size():
+    """
+    Get the number of processes, also before setup_dist().
+    """
+    if dist.is_initialized():
+        return dist.get_world_size()
+    kind = launcher()
+    if kind == "mpi":
+        return _import_mpi().COMM_WORLD.Get_size()
+    return int(os.environ["WORLD_SIZE"]) if kind == "env" else 1
+
+
+class _MPIComm:
+    def __init__(self, comm):
+        self.comm = comm
+        self.rank = comm.rank
+        self.size = comm.size
+
+    def bcast(self, obj):
+        return self.comm.bcast(obj, root=0)
+
+    def bcast_buffer(self, buffer):
+        self.comm.Bcast(buffer, root=0)
+
+    def gather(self, obj):
+        return self.comm.gather(obj, root=0)
+
+    def barrier(self):
+        self.comm.Barrier()
+
+
+class _TorchComm:
+    def __init__(self, group, ranks):
+        self.group = group
+        self.ranks = ranks
+        self.rank = ranks.index(dist.get_rank())
+        self.size = len(ranks)
+
+    def bcast(self, obj):
+        objects = [obj]
+        dist.broadcast_object_list(objects, src=self.ranks[0], group=self.group)
+        return objects[0]
+
+    def bcast_buffer(self, buffer):
+        dist.broadcast(th.frombuffer(buffer, dtype=th.uint8), src=self.ranks[0], group=self.group)
+
+    def gather(self, obj):
+        objects = [None] * self.size if self.rank == 0 else None
+        dist.gather_object(obj, objects, dst=self.ranks[0], group=self.group)
+        return objects
+
+    def barrier(self):
+        dist.barrier(group=self.group)
+
+
+def _get_comms():
+    """
+    Get the communicators used to load checkpoints (and gather objects): all
+    the ranks, the ranks of this node, and the first rank of every node (None
+    on the other ranks).
+    They run on CPU, over MPI with mpiexec and over gloo otherwise.
+    """
+    global _comms
+    if _comms is not None:
+        return _comms
+    if launcher() == "mpi":
+        MPI = _import_mpi()
+        comm = MPI.COMM_WORLD
+        local = comm.Split_type(MPI.COMM_TYPE_SHARED, key=comm.rank)
+        leaders = comm.Split(0 if local.rank == 0 else MPI.UNDEFINED, key=comm.rank)
+        _comms = (
+            _MPIComm(comm),
+            _MPIComm(local),
+            _MPIComm(leaders) if leaders != MPI.COMM_NULL else None,
+        )
+        return _comms
+    assert dist.is_initialized(), "call setup_dist() first"
+    world_ranks = list(range(dist.get_world_size()))
+    # Object and byte broadcasts go over gloo, also when training uses NCCL.
+    world = dist.new_group(world_ranks, backend="gloo") if dist.get_backend() != "gloo" else dist.group.WORLD
+    hosts = [None] * len(world_ranks)
+    dist.all_gather_object(hosts, socket.gethostname(), group=world)
+    nodes = {}
+    for rank, host in enumerate(hosts):
+        nodes.setdefault(host, []).append(rank)
+    # Every rank creates every group, in the same order.
+    local = None
+    for ranks in nodes.values():
+        group = dist.new_group(ranks, backend="gloo")
+        if dist.get_rank() in ranks:
+            local = _TorchComm(group, ranks)
+    leader_ranks = [ranks[0] for ranks in nodes.values()]
+    leaders = dist.new_group(leader_ranks, backend="gloo")
+    _comms = (
+        _TorchComm(world, world_ranks),
+        local,
+        _TorchComm(leaders, leader_ranks) if dist.get_rank() in leader_ranks else None,
+    )
+    return _comms
+
+
+def gather_objects(obj):
     """
-    Load a PyTorch file without redundant fetches across MPI ranks.
+    Gather a picklable object of every rank on rank 0, over CPU.
+
+    :return: the list of objects by rank on rank 0, None on the other ranks.
+    """
+    return _get_comms()[0].gather(obj)
+
+
+def load_state_dict(path, shared_memory=True, **kwargs):
     """
-    if MPI.COMM_WORLD.Get_rank() == 0:
+    Load a PyTorch file without redundant fetches across ranks.
+
+    Local indexed checkpoints (see indexed_checkpoint.py) are memory-mapped
+    by every rank instead, so the weights are read from the page cache
+    without a copy in each process. Must be called on all ranks.
+
+    :param shared_memory: with several ranks, load through shared memory
+                          (see _load_shared()) instead of broadcasting the
+                          file to every rank.
+    """
+    indexed = is_indexed_checkpoint(path)
+    if indexed and "://" not in path:
+        return IndexedCheckpoint(path).state_dict(kwargs.get("map_location"))
+    if get_world_size() == 1:
         with bf.BlobFile(path, "rb") as f:
             data = f.read()
+    elif shared_memory:
+        return _load_shared(path, indexed, **kwargs)
     else:
-        data = None
-    data = MPI.COMM_WORLD.bcast(data)
+        world = _get_comms()[0]
+        if world.rank == 0:
+            with bf.BlobFile(path, "rb") as f:
+                data = f.read()
+        else:
+            data = None
+        data = world.bcast(data)
+    if indexed:
+        return IndexedCheckpoint(buffer=bytearray(data)).state_dict(kwargs.get("map_location"))
     return th.load(io.BytesIO(data), **kwargs)
 
 
+def _load_shared(path, indexed, **kwargs):
+    """
+    Rank 0 reads the file into a POSIX shared memory file and sends it, in
+    chunks of SHARED_LOAD_CHUNK_BYTES, to one rank per other node, which
+    writes its own; all the ranks of a node then map their node's file.
+
+    Flat dicts of tensors are stored in the indexed format, so that every
+    local rank gets zero-copy views of the same pages; other objects (e.g.
+    optimizer states) are stored as is and deserialized by each rank.
+    """
+    world, local, leaders = _get_comms()
+
+    name = world.bcast(f"improved_diffusion_{uuid.uuid4().hex}" if world.rank == 0 else None)
+    shm_path = os.path.join(_shared_memory_dir(), name)
+
+    try:
+        # A failure of rank 0 is broadcast in place of the header, so that
+        # every rank raises instead of waiting for the file.
+        header = None
+        if world.rank == 0:
+            try:
+                indexed = _write_shared(path, indexed, shm_path)
+                header = (indexed, os.path.getsize(shm_path), None)
+            except Exception as e:
+                error = e
+                header = (None, 0, repr(e))
+        indexed, size, failure = world.bcast(header)
+        if failure is not None:
+            if world.rank == 0:
+                raise error
+            raise RuntimeError(f"rank 0 failed to load {path}: {failure}")
+        if leaders is not None and leaders.size > 1 and size:
+            with open(shm_path, "r+b" if world.rank == 0 else "w+b") as f:
+                f.truncate(size)
+                with mmap.mmap(f.fileno(), size) as mapped, memoryview(mapped) as view:
+                    for begin in range(0, size, SHARED_LOAD_CHUNK_BYTES):
+                        chunk = view[begin : begin + SHARED_LOAD_CHUNK_BYTES]
+                        leaders.bcast_buffer(chunk)
+                        chunk.release()
+        local.barrier()
+        if indexed:
+            return IndexedCheckpoint(shm_path).state_dict(kwargs.get("map_location"))
+        with open(shm_path, "rb") as f:
+            return th.load(f, **kwargs)
+    finally:
+        # The mappings outlive the name.
+        local.barrier()
+        if local.rank == 0 and os.path.exists(shm_path):
+            os.remove(shm_path)
+
+
+def _write_shared(path, indexed, shm_path):
+    """
+    Write the checkpoint at path to shm_path, converted to the indexed format
+    if it is a flat dict of tensors.
+
+    :return: whether shm_path is in the indexed format.
+    """
+    if not indexed:
+        with bf.BlobFile(path, "rb") as f:
+            state_dict = th.load(f, map_location="cpu")
+        if is_indexable(state_dict):
+            with open(shm_path, "wb") as f:
+                write_indexed(state_dict, f)
+            return True
+    bf.copy(path, shm_path, overwrite=True)
+    return indexed
+
+
+def _shared_memory_dir():
+    return "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
 def sync_params(params):
     """
     Synchronize a sequence of Tensors across ranks from rank 0.
@@ -10,9 +10,10 @@ import math
 
 import numpy as np
 import torch as th
+from torch.nn.parallel.distributed import DistributedDataParallel
 
 from .nn import mean_flat
-from .losses import normal_kl, discretized_gaussian_log_likelihood, discretized_text_log_likelihood
+from .losses import normal_kl, discretized_gaussian_log_likelihood, discretized_text_log_likelihood, token_cross_entropy
 
 
 def get_named_beta_schedule(schedule_name, num_diffusion_timesteps):
@@ -179,6 +180,7 @@ class GaussianDiffusion:
         rescale_timesteps=False,
         model_arch=None,
         training_mode='emb',
+        logits_chunk_size=0,
         # model_arch='conv-unet',
     ):
         self.model_mean_type = model_mean_type
@@ -186,6 +188,9 @@ class GaussianDiffusion:
         self.loss_type = loss_type
         self.rescale_timesteps = rescale_timesteps
         self.model_arch=model_arch
+        # Positions per chunk of the rounding cross-entropy, see
+        # losses.token_cross_entropy(); 0 computes all the logits at once.
+        self.logits_chunk_size = logits_chunk_size
 
         # Use float64 for accuracy.
         betas = np.array(betas, dtype=np.float64)
@@ -795,6 +800,99 @@ class GaussianDiffusion:
                 yield out
                 img = out["sample"]
 
+    def p_sample_loop_branching(
+        self,
+        model,
+        shape,
+        branch_timesteps,
+        branch_factors,
+        noise=None,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        device=None,
+        progress=False,
+        top_p=None,
+    ):
+        """
+        Generate a tree of samples: each root trajectory is shared down to the
+        first branch timestep, where it forks into children that continue with
+        independent noise, and so on for every further branch timestep.
+
+        This draws the same number of candidates (e.g. for MBR decoding) as
+        sampling N * prod(branch_factors) independent trajectories, but the
+        high-noise steps above the branch points are computed once per parent.
+
+        :param shape: the shape of the roots, (N, ...).
+        :param branch_timesteps: decreasing timesteps at which every current
+                                 trajectory is forked; the step at a branch
+                                 timestep is the first one sampled separately.
+        :param branch_factors: the number of children of each fork, one per
+                               branch timestep.
+        :param model_kwargs: keyword arguments for the N roots; tensors are
+                             repeated along with the trajectories.
+        Other arguments are the same as p_sample_loop().
+        :return: a dict containing the following keys:
+                 - 'sample': the N * prod(branch_factors) samples, with the
+                   descendants of each root contiguous (as repeat_interleave).
+                 - 'model_evals': the number of per-sample model evaluations.
+                 - 'independent_model_evals': the same for independent
+                   trajectories.
+                 - 'compute_saved': the fraction of evaluations saved.
+        """
+        assert len(branch_timesteps) == len(branch_factors), "one factor per branch timestep"
+        assert list(branch_timesteps) == sorted(branch_timesteps, reverse=True), \
+            "branch timesteps must decrease"
+        if device is None:
+            device = next(model.parameters()).device
+        assert isinstance(shape, (tuple, list))
+        if noise is not None:
+            img = noise
+        else:
+            img = th.randn(*shape, device=device)
+        model_kwargs = dict(model_kwargs or {})
+        forks = dict(zip(branch_timesteps, branch_factors))
+        indices = list(range(self.num_timesteps))[::-1]
+
+        if progress:
+            # Lazy import so that we don't depend on tqdm.
+            from tqdm.auto import tqdm
+
+            indices = tqdm(indices)
+
+        model_evals = 0
+        for i in indices:
+            if i in forks:
+                img = img.repeat_interleave(forks[i], dim=0)
+                model_kwargs = {
+                    k: v.repeat_interleave(forks[i], dim=0) if th.is_tensor(v) else v
+                    for k, v in model_kwargs.items()
+                }
+            t = th.tensor([i] * img.shape[0], device=device)
+            with th.no_grad():
+                out = self.p_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                    top_p=top_p,
+                )
+                img = out["sample"]
+            model_evals += img.shape[0]
+        # Forks at timesteps outside the schedule never happen.
+        assert img.shape[0] == shape[0] * int(np.prod(branch_factors)), \
+            "branch timesteps must be in [0, num_timesteps)"
+
+        independent_model_evals = img.shape[0] * self.num_timesteps
+        return {
+            "sample": img,
+            "model_evals": model_evals,
+            "independent_model_evals": independent_model_evals,
+            "compute_saved": 1.0 - model_evals / independent_model_evals,
+        }
+
     def p_sample_loop_langevin_progressive(
         self,
         model,
@@ -1427,11 +1525,8 @@ class GaussianDiffusion:
         else:
             # print(x_t.shape)
             reshaped_x_t = x_t
-        logits = get_logits(reshaped_x_t)  # bsz, seqlen, vocab
-        # print(logits.shape)
-        loss_fct = th.nn.CrossEntropyLoss(reduction='none')
-        decoder_nll = loss_fct(logits.view(-1, logits.size(-1)), input_ids.view(-1)).view(input_ids.shape)
-        # print(decoder_nll.shape)
+        # bsz, seqlen; with logits_chunk_size, the bsz x seqlen x vocab logits are never materialized.
+        decoder_nll = token_cross_entropy(get_logits, reshaped_x_t, input_ids, self.logits_chunk_size)
         decoder_nll = decoder_nll.mean(dim=-1)
         return decoder_nll
 
@@ -1454,7 +1549,10 @@ class GaussianDiffusion:
         return {'pred_xprev':pred_prev, 'pred_xstart':pred_xstart}
 
     def __get_module(self, model):
-        return model.model.module if self.use_cuda else model.model
+        # Unwrap _WrappedModel and, when training in parallel (on GPU or CPU),
+        # DistributedDataParallel.
+        model = model.model
+        return model.module if isinstance(model, DistributedDataParallel) else model
 
     def training_losses_e2e(self, model, x_start, t, model_kwargs=None, noise=None):
         """
@@ -1689,11 +1787,7 @@ class GaussianDiffusion:
             assert model_output.shape == target.shape == x_start.shape
             # terms["mse"] = mean_flat((target - model_output) ** 2)
 
-            ce = th.nn.CrossEntropyLoss(reduction='none')
-            model_logits = get_logits(model_output)
-            # print(model_logits.shape)
-            ce_loss = ce(model_logits.view(-1, model_logits.size(-1)), input_ids.view(-1))
-            ce_loss = ce_loss.view(input_ids.shape)
+            ce_loss = token_cross_entropy(get_logits, model_output, input_ids, self.logits_chunk_size)
             # print(ce_loss.shape)
             terms["ce"] = mean_flat(ce_loss)
             # print(terms["ce"].shape)
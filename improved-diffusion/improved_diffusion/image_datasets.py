@@ -1,9 +1,10 @@
 from PIL import Image
 import blobfile as bf
-from mpi4py import MPI
 import numpy as np
 from torch.utils.data import DataLoader, Dataset
 
+from . import dist_util
+
 
 def load_data(
     *, data_dir, batch_size, image_size, class_cond=False, deterministic=False, permutation=None
@@ -38,8 +39,8 @@ def load_data(
         image_size,
         all_files,
         classes=classes,
-        shard=MPI.COMM_WORLD.Get_rank(),
-        num_shards=MPI.COMM_WORLD.Get_size(),
+        shard=dist_util.get_rank(),
+        num_shards=dist_util.get_world_size(),
         permutation=permutation,
     )
     if deterministic:
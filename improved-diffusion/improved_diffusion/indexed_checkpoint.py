@@ -0,0 +1,191 @@
+"""
+An indexed checkpoint format for state dicts, with memory-mapped, per-tensor
+lazy access.
+
+The layout is that of safetensors, so these files can also be read with the
+safetensors library:
+
+    [8 bytes: little-endian header length N]
+    [N bytes: JSON header, space-padded to a multiple of 8]
+    [the raw bytes of the tensors, back to back]
+
+The header maps each tensor name to its dtype, shape and [begin, end) byte
+offsets in the data section, plus string "__metadata__". Tensors are stored
+from the widest dtype down, so every tensor is aligned to its element size.
+
+Local files are memory-mapped: opening one only reads its header, a tensor is
+a view of the mapped pages, which are read when (and only when) the tensor is
+used. Loading a model from such a file therefore never holds a second copy of
+the weights in memory.
+"""
+
+import json
+import mmap
+import struct
+
+import blobfile as bf
+import torch as th
+
+from .checkpoint_writer import atomic_write
+
+INDEXED_SUFFIX = ".safetensors"
+
+_DTYPES = {
+    "F64": th.float64,
+    "F32": th.float32,
+    "F16": th.float16,
+    "BF16": th.bfloat16,
+    "I64": th.int64,
+    "I32": th.int32,
+    "I16": th.int16,
+    "I8": th.int8,
+    "U8": th.uint8,
+    "BOOL": th.bool,
+}
+_DTYPE_NAMES = {dtype: name for name, dtype in _DTYPES.items()}
+
+
+def is_indexed_checkpoint(path):
+    return path.endswith(INDEXED_SUFFIX)
+
+
+def is_indexable(obj):
+    """
+    Check if obj is a flat dict of tensors that the indexed format can store.
+    """
+    return isinstance(obj, dict) and all(
+        isinstance(name, str) and th.is_tensor(tensor) and tensor.dtype in _DTYPE_NAMES
+        for name, tensor in obj.items()
+    )
+
+
+def save_indexed_checkpoint(state_dict, path, metadata=None):
+    """
+    Write a flat dict of tensors in the indexed format, atomically.
+
+    Tensors sharing storage (e.g. tied weights) are written once per name.
+
+    :param state_dict: a dict of name -> tensor.
+    :param path: the path of the file, conventionally ending in .safetensors.
+    :param metadata: an optional dict of str -> str stored in the header.
+    """
+    atomic_write(path, lambda f: write_indexed(state_dict, f, metadata))
+
+
+def write_indexed(state_dict, f, metadata=None):
+    """
+    Write a flat dict of tensors in the indexed format to a binary file
+    object; see save_indexed_checkpoint().
+    """
+    for name, tensor in state_dict.items():
+        if not th.is_tensor(tensor):
+            raise ValueError(f"{name} is not a tensor, only flat dicts of tensors can be indexed")
+        if tensor.dtype not in _DTYPE_NAMES:
+            raise ValueError(f"{name} has the unsupported dtype {tensor.dtype}")
+    names = sorted(state_dict, key=lambda name: (-state_dict[name].element_size(), name))
+
+    header = {}
+    offset = 0
+    for name in names:
+        tensor = state_dict[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+    header = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header += b" " * (-len(header) % 8)
+
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    for name in names:
+        tensor = state_dict[name].detach().cpu().contiguous().reshape(-1)
+        f.write(memoryview(tensor.view(th.uint8).numpy()))
+
+
+class IndexedCheckpoint:
+    """
+    Lazy, read-only access to the tensors of an indexed checkpoint.
+
+    Tensors are views of the file's mapped pages (or of the given buffer);
+    writing to them does not change the file. They stay valid after the
+    IndexedCheckpoint is gone.
+
+    :param path: the path of the file. Local files are memory-mapped, other
+                 (blob storage) paths are read in full.
+    :param buffer: the contents of the file, instead of a path.
+    """
+
+    def __init__(self, path=None, buffer=None):
+        assert (path is None) != (buffer is None), "pass exactly one of path and buffer"
+        if buffer is None:
+            if "://" in path:
+                with bf.BlobFile(path, "rb") as f:
+                    buffer = bytearray(f.read())
+            else:
+                with open(path, "rb") as f:
+                    # Copy-on-write, so that the tensors are writable views
+                    # (as th.frombuffer() expects) that never touch the file.
+                    buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.path = path
+        self._buffer = buffer
+        (header_size,) = struct.unpack("<Q", bytes(buffer[:8]))
+        header = json.loads(bytes(buffer[8 : 8 + header_size]).decode("utf-8"))
+        self.metadata = header.pop("__metadata__", {})
+        self._index = header
+        self._data_start = 8 + header_size
+
+    def keys(self):
+        return list(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_tensor(self, name):
+        """
+        Get one tensor, without reading any of the others.
+        """
+        if name not in self._index:
+            raise KeyError(f"{name} is not in {self.path or 'the checkpoint'}")
+        info = self._index[name]
+        dtype = _DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        itemsize = th.empty([], dtype=dtype).element_size()
+        count = (end - begin) // itemsize
+        if count == 0:
+            return th.empty(info["shape"], dtype=dtype)
+        tensor = th.frombuffer(self._buffer, dtype=dtype, count=count, offset=self._data_start + begin)
+        return tensor.reshape(info["shape"])
+
+    def state_dict(self, map_location=None):
+        """
+        Get all the tensors; on CPU they are lazy views of the file.
+
+        :param map_location: an optional device to copy the tensors to.
+        """
+        result = {}
+        for name in self._index:
+            tensor = self.get_tensor(name)
+            if map_location is not None and th.device(map_location).type != "cpu":
+                tensor = tensor.to(map_location)
+            result[name] = tensor
+        return result
+
+
+def load_tensor(path, name, map_location="cpu"):
+    """
+    Read a single tensor of a checkpoint. Indexed checkpoints only read that
+    tensor; .pt files are loaded in full.
+    """
+    if is_indexed_checkpoint(path):
+        tensor = IndexedCheckpoint(path).get_tensor(name)
+        return tensor.to(map_location) if th.device(map_location).type != "cpu" else tensor
+    with bf.BlobFile(path, "rb") as f:
+        return th.load(f, map_location=map_location)[name]
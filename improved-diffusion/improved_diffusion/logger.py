@@ -1,6 +1,13 @@
 """
 Logger copied from OpenAI baselines to avoid extra RL-based dependencies:
 https://github.com/openai/baselines/blob/ea25b9e8b234e6ee1bca43083f8f3cf974143998/baselines/logger.py
+
+Diagnostics may also be logged as torch tensors: they are accumulated on
+their device and only transferred (and averaged across torch.distributed
+ranks, in one collective) by dumpkvs(), so logging them never forces a
+host sync. Output formats are looked up in a registry (see
+register_output_format()); the optional ones (tensorboard, wandb) import
+their dependency when they are created.
 """
 
 import os
@@ -14,7 +21,9 @@ import tempfile
 import warnings
 from collections import defaultdict
 from contextlib import contextmanager
-import wandb
+
+import torch as th
+import torch.distributed as dist
 
 DEBUG = 10
 INFO = 20
@@ -157,52 +166,70 @@ class TensorBoardOutputFormat(KVWriter):
         os.makedirs(dir, exist_ok=True)
         self.dir = dir
         self.step = 1
-        prefix = "events"
-        path = osp.join(osp.abspath(dir), prefix)
-        import tensorflow as tf
-        from tensorflow.python import pywrap_tensorflow
-        from tensorflow.core.util import event_pb2
-        from tensorflow.python.util import compat
-
-        self.tf = tf
-        self.event_pb2 = event_pb2
-        self.pywrap_tensorflow = pywrap_tensorflow
-        self.writer = pywrap_tensorflow.EventsWriter(compat.as_bytes(path))
+        # Lazy import so that we don't depend on tensorboard.
+        from torch.utils.tensorboard import SummaryWriter
+
+        self.writer = SummaryWriter(log_dir=dir)
 
     def writekvs(self, kvs):
-        def summary_val(k, v):
-            kwargs = {"tag": k, "simple_value": float(v)}
-            return self.tf.Summary.Value(**kwargs)
-
-        summary = self.tf.Summary(value=[summary_val(k, v) for k, v in kvs.items()])
-        event = self.event_pb2.Event(wall_time=time.time(), summary=summary)
-        event.step = (
-            self.step
-        )  # is there any reason why you'd want to specify the step?
-        self.writer.WriteEvent(event)
-        self.writer.Flush()
+        for k, v in kvs.items():
+            if hasattr(v, "__float__"):
+                self.writer.add_scalar(k, float(v), global_step=self.step)
+        self.writer.flush()
         self.step += 1
 
     def close(self):
         if self.writer:
-            self.writer.Close()
+            self.writer.close()
             self.writer = None
 
 
+class WandbOutputFormat(KVWriter):
+    """
+    Logs key/value pairs to the active wandb run, starting one if needed.
+    """
+
+    def __init__(self, dir):
+        # Lazy import so that we don't depend on wandb.
+        import wandb
+
+        self.wandb = wandb
+        if wandb.run is None:
+            wandb.init(project=os.getenv("WANDB_PROJECT", "diffusion_lm"), dir=dir)
+
+    def writekvs(self, kvs):
+        self.wandb.log(dict(kvs))
+
+    def close(self):
+        pass
+
+
+# name -> factory(ev_dir, log_suffix) of the formats accepted by configure().
+OUTPUT_FORMATS = {
+    "stdout": lambda ev_dir, log_suffix: HumanOutputFormat(sys.stdout),
+    "log": lambda ev_dir, log_suffix: HumanOutputFormat(osp.join(ev_dir, "log%s.txt" % log_suffix)),
+    "json": lambda ev_dir, log_suffix: JSONOutputFormat(osp.join(ev_dir, "progress%s.json" % log_suffix)),
+    "csv": lambda ev_dir, log_suffix: CSVOutputFormat(osp.join(ev_dir, "progress%s.csv" % log_suffix)),
+    "tensorboard": lambda ev_dir, log_suffix: TensorBoardOutputFormat(osp.join(ev_dir, "tb%s" % log_suffix)),
+    "wandb": lambda ev_dir, log_suffix: WandbOutputFormat(ev_dir),
+}
+
+
+def register_output_format(name, factory):
+    """
+    Make a custom output format available to configure() and
+    add_output_format().
+
+    :param factory: a function (ev_dir, log_suffix) -> KVWriter and/or SeqWriter.
+    """
+    OUTPUT_FORMATS[name] = factory
+
+
 def make_output_format(format, ev_dir, log_suffix=""):
     os.makedirs(ev_dir, exist_ok=True)
-    if format == "stdout":
-        return HumanOutputFormat(sys.stdout)
-    elif format == "log":
-        return HumanOutputFormat(osp.join(ev_dir, "log%s.txt" % log_suffix))
-    elif format == "json":
-        return JSONOutputFormat(osp.join(ev_dir, "progress%s.json" % log_suffix))
-    elif format == "csv":
-        return CSVOutputFormat(osp.join(ev_dir, "progress%s.csv" % log_suffix))
-    elif format == "tensorboard":
-        return TensorBoardOutputFormat(osp.join(ev_dir, "tb%s" % log_suffix))
-    else:
+    if format not in OUTPUT_FORMATS:
         raise ValueError("Unknown format specified: %s" % (format,))
+    return OUTPUT_FORMATS[format](ev_dir, log_suffix)
 
 
 # ================================================================
@@ -226,6 +253,22 @@ def logkv_mean(key, val):
     get_current().logkv_mean(key, val)
 
 
+def logkv_sum(key, total, count):
+    """
+    Like logkv_mean(), for a sum of `count` values at once; total and count
+    may be tensors, e.g. per-bucket sums computed on device.
+    """
+    get_current().logkv_sum(key, total, count)
+
+
+def add_output_format(format):
+    """
+    Add an output format (e.g. "wandb") to the current logger.
+    """
+    current = get_current()
+    current.output_formats.append(make_output_format(format, current.get_dir()))
+
+
 def logkvs(d):
     """
     Log a dictionary of key-value pairs
@@ -241,8 +284,14 @@ def dumpkvs():
     return get_current().dumpkvs()
 
 
-def getkvs():
-    return get_current().name2val
+def getkvs(reduce=False):
+    """
+    Get the diagnostics of the current iteration without dumping them.
+
+    :param reduce: average the tensor diagnostics across ranks, as dumpkvs()
+                   does. This is a collective: every rank must call it.
+    """
+    return get_current().getkvs(reduce=reduce)
 
 
 def log(*args, level=INFO):
@@ -338,6 +387,10 @@ class Logger(object):
     def __init__(self, dir, output_formats, comm=None):
         self.name2val = defaultdict(float)  # values this iteration
         self.name2cnt = defaultdict(int)
+        # tensor diagnostics, kept on device until dumpkvs()
+        self.name2tensor = {}
+        self.name2tsum = {}
+        self.name2tcnt = {}
         self.level = INFO
         self.dir = dir
         self.output_formats = output_formats
@@ -346,14 +399,71 @@ class Logger(object):
     # Logging API, forwarded
     # ----------------------------------------
     def logkv(self, key, val):
-        self.name2val[key] = val
+        if th.is_tensor(val):
+            self.name2tensor[key] = val.detach()
+        else:
+            self.name2val[key] = val
 
     def logkv_mean(self, key, val):
+        if th.is_tensor(val):
+            self.logkv_sum(key, val, 1)
+            return
         oldval, cnt = self.name2val[key], self.name2cnt[key]
         self.name2val[key] = oldval * cnt / (cnt + 1) + val / (cnt + 1)
         self.name2cnt[key] = cnt + 1
 
+    def logkv_sum(self, key, total, count):
+        total = th.as_tensor(total).detach().float()
+        if key in self.name2tsum:
+            self.name2tsum[key] = self.name2tsum[key] + total
+            self.name2tcnt[key] = self.name2tcnt[key] + count
+        else:
+            self.name2tsum[key] = total
+            self.name2tcnt[key] = count
+
+    def _tensor_kvs(self, reduce=True):
+        """
+        Average the tensor diagnostics (across ranks, if reduce is set and
+        torch.distributed is initialized) with a single collective and a
+        single device-to-host copy. When reducing, every rank must call this
+        with the same keys, as TrainLoop does.
+        """
+        mean_keys = sorted(self.name2tsum)
+        last_keys = sorted(self.name2tensor)
+        if not mean_keys and not last_keys:
+            return {}
+        scalars = (
+            [self.name2tsum[k] for k in mean_keys]
+            + [th.as_tensor(self.name2tcnt[k]) for k in mean_keys]
+            + [self.name2tensor[k] for k in last_keys]
+        )
+        device = next((t.device for t in scalars if t.device.type != "cpu"), th.device("cpu"))
+        packed = th.stack([t.to(device).float().reshape(()) for t in scalars])
+        n = len(mean_keys)
+        if reduce and n and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            dist.all_reduce(packed[: 2 * n])
+        values = packed.tolist()
+        out = {k: values[i] / values[n + i] for i, k in enumerate(mean_keys) if values[n + i] > 0}
+        out.update(zip(last_keys, values[2 * n:]))
+        return out
+
+    def getkvs(self, reduce=False):
+        """
+        Get the current diagnostics without dumping them; see getkvs().
+        """
+        d = dict(self.name2val)
+        d.update(self._tensor_kvs(reduce=reduce))
+        return d
+
+    def clearkvs(self):
+        self.name2val.clear()
+        self.name2cnt.clear()
+        self.name2tensor.clear()
+        self.name2tsum.clear()
+        self.name2tcnt.clear()
+
     def dumpkvs(self, prefix=None):
+        tensor_kvs = self._tensor_kvs()
         if self.comm is None:
             d = self.name2val
         else:
@@ -366,14 +476,12 @@ class Logger(object):
             )
             if self.comm.rank != 0:
                 d["dummy"] = 1  # so we don't get a warning about empty dict
-        # LISA
-        wandb.log({**d})
+        d = {**d, **tensor_kvs}
         out = d.copy()  # Return the dict for unit testing purposes
         for fmt in self.output_formats:
             if isinstance(fmt, KVWriter):
                 fmt.writekvs(d)
-        self.name2val.clear()
-        self.name2cnt.clear()
+        self.clearkvs()
         return out
 
     def log(self, *args, level=INFO):
@@ -406,7 +514,7 @@ class Logger(object):
 def get_rank_without_mpi_import():
     # check environment variables here instead of importing mpi4py
     # to avoid calling MPI_Init() when this module is imported
-    for varname in ["PMI_RANK", "OMPI_COMM_WORLD_RANK"]:
+    for varname in ["PMI_RANK", "OMPI_COMM_WORLD_RANK", "RANK"]:
         if varname in os.environ:
             return int(os.environ[varname])
     return 0
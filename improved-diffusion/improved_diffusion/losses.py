@@ -7,6 +7,8 @@ https://github.com/hojonathanho/diffusion/blob/1e0dceb3b3495bbe19116a5e1b3596cd0
 import numpy as np
 
 import torch as th
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 def normal_kl(mean1, logvar1, mean2, logvar2):
@@ -117,3 +119,43 @@ def discretized_text_log_likelihood(x, *, means, log_scales):
     )
     assert log_probs.shape == x.shape
     return log_probs
+
+
+def token_cross_entropy(get_logits, hidden, input_ids, chunk_size=0):
+    """
+    Compute the cross-entropy of the logits of hidden states against tokens.
+
+    With a chunk_size, the full [N x T x vocab] logits are never materialized:
+    the positions are taken chunk_size at a time, and each chunk's logits are
+    reduced to its losses and freed, then recomputed during the backward pass
+    (activation checkpointing). Peak memory then holds the logits of one
+    chunk, at the cost of a second logits computation in backward. Losses and
+    gradients match the unchunked computation up to floating-point summation
+    order (the gradients of the logits weights are summed over chunks).
+
+    :param get_logits: maps a [N x T x C] tensor to its [N x T x vocab] logits.
+    :param hidden: the [N x T x C] hidden states.
+    :param input_ids: the [N x T] target tokens.
+    :param chunk_size: the number of positions per chunk, or 0 for no chunks.
+    :return: a [N x T] tensor of losses (in nats).
+    """
+    if chunk_size <= 0:
+        logits = get_logits(hidden)
+        return F.cross_entropy(
+            logits.view(-1, logits.size(-1)), input_ids.view(-1), reduction="none"
+        ).view(input_ids.shape)
+    # One sequence of all the positions, as get_logits may expect [N x T x C].
+    flat_hidden = hidden.reshape(1, -1, hidden.size(-1))
+    flat_ids = input_ids.reshape(1, -1)
+    losses = [
+        checkpoint(
+            token_cross_entropy,
+            get_logits,
+            flat_hidden[:, start : start + chunk_size],
+            flat_ids[:, start : start + chunk_size],
+            use_reentrant=False,
+            preserve_rng_state=False,
+        )
+        for start in range(0, flat_ids.size(1), chunk_size)
+    ]
+    return th.cat(losses, dim=1).view(input_ids.shape)
@@ -2,10 +2,12 @@
 Various utilities for neural networks.
 """
 
+import functools
 import math
 
 import torch as th
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint as _torch_checkpoint
 
 
 # PyTorch 1.7 has SiLU, but we support PyTorch 1.5.
@@ -57,12 +59,27 @@ def update_ema(target_params, source_params, rate=0.99):
     Update target parameters to be closer to those of source parameters using
     an exponential moving average.
 
+    The targets may live on another device or in another dtype than the
+    sources (e.g. EMA weights kept on CPU or in bf16); sources are cast to
+    match. The update is a single multi-tensor (_foreach) op per step.
+
     :param target_params: the target parameter sequence.
     :param source_params: the source parameter sequence.
     :param rate: the EMA rate (closer to 1 means slower).
     """
-    for targ, src in zip(target_params, source_params):
-        targ.detach().mul_(rate).add_(src, alpha=1 - rate)
+    targets = [targ.detach() for targ in target_params]
+    # Only copies to the GPU are ordered with the ops that read them; a
+    # non-blocking copy to CPU could still be in flight when they run.
+    sources = [
+        src.detach().to(device=targ.device, dtype=targ.dtype, non_blocking=targ.device.type == "cuda")
+        for targ, src in zip(targets, source_params)
+    ]
+    if hasattr(th, "_foreach_mul_"):
+        th._foreach_mul_(targets, rate)
+        th._foreach_add_(targets, sources, alpha=1 - rate)
+    else:
+        for targ, src in zip(targets, sources):
+            targ.mul_(rate).add_(src, alpha=1 - rate)
 
 
 def zero_module(module):
@@ -139,6 +156,100 @@ def checkpoint(func, inputs, params, flag):
         return func(*inputs)
 
 
+def set_checkpointing(model, flag):
+    """
+    Toggle gradient checkpointing on every submodule that supports it: our
+    blocks (and the layers selected by apply_checkpoint_policy()) read
+    `use_checkpoint` at forward time, and the transformers encoders read
+    `gradient_checkpointing`. If the model has any `use_checkpoint` module,
+    only those are toggled, so that a selective policy is not overridden by
+    whole-encoder checkpointing.
+
+    :return: the number of modules that were toggled.
+    """
+    modules = list(model.modules())
+    own = any(isinstance(getattr(m, "use_checkpoint", None), bool) for m in modules)
+    attr = "use_checkpoint" if own else "gradient_checkpointing"
+    count = 0
+    for module in modules:
+        if isinstance(getattr(module, attr, None), bool):
+            setattr(module, attr, flag)
+            count += 1
+    return count
+
+
+def parse_checkpoint_policy(policy):
+    """
+    Parse an activation checkpointing policy for the layers of an encoder:
+
+    - "" or "none": no checkpointing.
+    - "all": checkpoint every layer.
+    - "every_K": checkpoint every K-th layer (layers K-1, 2K-1, ...).
+    - "attention" / "attention_every_K": only checkpoint the attention block
+      of (every K-th) layer, whose score matrices dominate the activation
+      memory at long sequence lengths.
+
+    :return: a tuple (every, attention_only), with every == 0 for none.
+    """
+    if policy in ("", "none"):
+        return 0, False
+    attention_only = policy.startswith("attention")
+    rest = policy[len("attention"):].lstrip("_") if attention_only else policy
+    if rest in ("", "all"):
+        return 1, attention_only
+    if rest.startswith("every_") and rest[len("every_"):].isdigit() and int(rest[len("every_"):]) > 0:
+        return int(rest[len("every_"):]), attention_only
+    raise ValueError(f"unknown checkpoint policy: {policy}")
+
+
+def apply_checkpoint_policy(layers, policy, attention_attr=None):
+    """
+    Enable activation checkpointing on some of the layers of an encoder.
+
+    The selected modules keep their place (and state dict keys) in the model;
+    their forward is run through th.utils.checkpoint, which accepts the
+    keyword arguments, None inputs and tuple outputs of transformer layers.
+    They get a `use_checkpoint` flag, so set_checkpointing() toggles them.
+
+    :param layers: the sequence of layers of the encoder.
+    :param policy: a policy string, see parse_checkpoint_policy().
+    :param attention_attr: the name of the attention submodule of a layer,
+                           for the "attention" policies.
+    :return: the number of modules that were set up.
+    """
+    every, attention_only = parse_checkpoint_policy(policy)
+    if not every:
+        return 0
+    count = 0
+    for i, layer in enumerate(layers):
+        if (i + 1) % every:
+            continue
+        module = getattr(layer, attention_attr) if attention_only else layer
+        if not isinstance(module.forward, _CheckpointedForward):
+            module.forward = _CheckpointedForward(module)
+        module.use_checkpoint = True
+        count += 1
+    return count
+
+
+class _CheckpointedForward:
+    """
+    Replaces the forward of a module with one that recomputes it in the
+    backward pass while the module is training and `use_checkpoint` is set.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.forward = module.forward
+
+    def __call__(self, *args, **kwargs):
+        if not (self.module.use_checkpoint and self.module.training and th.is_grad_enabled()):
+            return self.forward(*args, **kwargs)
+        return _torch_checkpoint(
+            functools.partial(self.forward, **kwargs), *args, use_reentrant=False
+        )
+
+
 class CheckpointFunction(th.autograd.Function):
     @staticmethod
     def forward(ctx, run_function, length, *args):
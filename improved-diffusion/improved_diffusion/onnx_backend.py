@@ -0,0 +1,181 @@
+"""
+ONNX Runtime inference backend for the transformer denoisers.
+
+Only the denoising network (x_t, timesteps) -> output is exported. The token
+embedding and the tied lm_head stay in torch, since rounding and decoding read
+their weights directly.
+"""
+
+import copy
+import os
+import time
+
+import numpy as np
+import torch as th
+
+from . import logger
+
+DENOISER_BACKENDS = ("torch", "onnx")
+
+
+class _DenoiserExportWrapper(th.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x_t, timesteps):
+        return self.model(x_t, timesteps)
+
+
+def export_denoiser_onnx(model, onnx_path, seq_len=256, batch_size=2, opset_version=13):
+    """
+    Export a denoiser to ONNX with dynamic batch and sequence length axes.
+
+    :param model: a CleanedTransformerModel (or any module with the same
+                  forward(x, timesteps) signature) in lm mode.
+    :param onnx_path: the output file.
+    :param seq_len: the sequence length of the tracing inputs.
+    :return: onnx_path.
+    """
+    assert not getattr(model, "conditional_gen", False), "conditional_gen is not exportable"
+    # Export from a CPU copy, so that the caller's model stays on its device.
+    model = copy.deepcopy(model).cpu().eval()
+    x_t = th.randn(batch_size, seq_len, model.in_channels)
+    # Timesteps are floats once rescaled by the diffusion, so export them as such.
+    timesteps = th.linspace(0, 999, batch_size)
+    with th.no_grad():
+        th.onnx.export(
+            _DenoiserExportWrapper(model),
+            (x_t, timesteps),
+            onnx_path,
+            input_names=["x_t", "timesteps"],
+            output_names=["output"],
+            dynamic_axes={
+                "x_t": {0: "batch", 1: "length"},
+                "timesteps": {0: "batch"},
+                "output": {0: "batch", 1: "length"},
+            },
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    logger.log(f"exported denoiser to {onnx_path}")
+    return onnx_path
+
+
+class OnnxDenoiser:
+    """
+    A drop-in replacement for a torch denoiser in the sampling loops.
+
+    Calls run through an ONNX Runtime session; get_embeds(), get_logits() and
+    parameters() are served by the torch embedding and lm_head of `model`.
+    """
+
+    def __init__(self, onnx_path, model, providers=None, num_threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(
+            onnx_path, options, providers=providers or ["CPUExecutionProvider"]
+        )
+        self.word_embedding = model.word_embedding
+        self.lm_head = model.lm_head
+        self._pre_hooks = []
+
+    def register_forward_pre_hook(self, hook):
+        """
+        Call hook(self, (x, timesteps)) before every call, like the hook of
+        th.nn.Module (e.g. for ProfilerHook.attach()).
+        """
+        self._pre_hooks.append(hook)
+
+    def __call__(self, x, timesteps, **kwargs):
+        assert not kwargs, f"the ONNX denoiser takes no model kwargs, got {list(kwargs)}"
+        for hook in self._pre_hooks:
+            hook(self, (x, timesteps))
+        (out,) = self.session.run(
+            ["output"],
+            {
+                "x_t": x.detach().cpu().float().numpy(),
+                "timesteps": timesteps.detach().cpu().float().numpy(),
+            },
+        )
+        return th.from_numpy(out).to(device=x.device, dtype=x.dtype)
+
+    def get_embeds(self, input_ids):
+        return self.word_embedding(input_ids)
+
+    def get_logits(self, hidden_repr):
+        return self.lm_head(hidden_repr)
+
+    def parameters(self):
+        return self.word_embedding.parameters()
+
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        self.word_embedding.to(*args, **kwargs)
+        self.lm_head.to(*args, **kwargs)
+        return self
+
+
+def load_denoiser_backend(backend, model, onnx_path="", seq_len=256, num_threads=0):
+    """
+    Wrap a loaded torch denoiser in the requested inference backend.
+
+    For "onnx", the model is exported to `onnx_path` first if that file does
+    not exist yet.
+    """
+    assert backend in DENOISER_BACKENDS, f"unknown denoiser backend: {backend}"
+    if backend == "torch":
+        return model
+    assert onnx_path, "the onnx backend needs an onnx_path"
+    if not os.path.exists(onnx_path):
+        export_denoiser_onnx(model, onnx_path, seq_len=seq_len)
+    return OnnxDenoiser(onnx_path, model, num_threads=num_threads)
+
+
+@th.no_grad()
+def check_parity(model, denoiser, shapes=((1, 64), (4, 256)), num_timesteps=1000, atol=1e-4):
+    """
+    Compare a backend's outputs against the torch model on random inputs.
+
+    :param shapes: (batch, length) pairs, covering the dynamic axes.
+    :return: the largest absolute difference seen.
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    max_diff = 0.0
+    for batch_size, seq_len in shapes:
+        x_t = th.randn(batch_size, seq_len, model.in_channels)
+        timesteps = th.randint(0, num_timesteps, (batch_size,)).float()
+        diff = (model(x_t, timesteps) - denoiser(x_t, timesteps)).abs().max().item()
+        logger.log(f"parity batch={batch_size} length={seq_len}: max abs diff {diff:.2e}")
+        max_diff = max(max_diff, diff)
+    assert max_diff <= atol, f"ONNX output differs from torch by {max_diff:.2e} (atol {atol:.0e})"
+    return max_diff
+
+
+@th.no_grad()
+def benchmark_latency(denoiser, in_channels, batch_size=1, seq_len=256, repeat=20, warmup=3):
+    """
+    Measure the per-call CPU latency of a denoiser, in seconds.
+
+    :return: a dict with the mean and the 50th/90th percentiles.
+    """
+    x_t = th.randn(batch_size, seq_len, in_channels)
+    timesteps = th.full((batch_size,), 500.0)
+    for _ in range(warmup):
+        denoiser(x_t, timesteps)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        denoiser(x_t, timesteps)
+        times.append(time.perf_counter() - start)
+    return {
+        "mean": float(np.mean(times)),
+        "p50": float(np.percentile(times, 50)),
+        "p90": float(np.percentile(times, 90)),
+    }
@@ -0,0 +1,194 @@
+"""
+On-demand torch.profiler captures of a running training or sampling job.
+
+A capture is triggered by any of:
+- a signal, e.g. `kill -USR2 <pid>`;
+- a step range given up front, e.g. profile_steps="1000:1005";
+- touching a sentinel file, `<log dir>/PROFILE` by default. The file may hold
+  the number of steps to capture; touching it again triggers a new capture.
+
+A capture skips one warm-up step, records the next profile_num_steps steps
+(CPU and CUDA ops, memory, shapes and stacks), writes a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev) and a summary of the top ops to
+`<log dir>/profiles`, and turns the profiler off again.
+"""
+
+import os
+import signal
+
+import torch as th
+
+from . import logger
+
+SENTINEL_FILENAME = "PROFILE"
+
+
+def profiler_defaults():
+    """
+    Defaults for the profiler flags of the training and sampling scripts.
+    """
+    return dict(
+        profile_steps="",  # e.g. 1000:1005 to capture steps 1000 to 1004
+        profile_num_steps=5,  # steps per capture triggered by a signal or the sentinel file
+        profile_signal="SIGUSR2",  # empty to not install a signal handler
+        profile_sentinel="",  # the sentinel file, <log dir>/PROFILE by default; "none" disables it
+        profile_dir="",  # <log dir>/profiles by default
+    )
+
+
+def profiler_from_args(args):
+    """
+    Create the ProfilerHook of the profiler flags, see profiler_defaults().
+    """
+    return ProfilerHook(
+        steps=args.profile_steps,
+        num_steps=args.profile_num_steps,
+        signal_name=args.profile_signal,
+        sentinel=args.profile_sentinel,
+        out_dir=args.profile_dir,
+    )
+
+
+class ProfilerHook:
+    """
+    Call step() once per training step (or sampling step, see attach()); it
+    starts and stops the captures.
+
+    :param steps: an optional "start:end" range of steps to capture.
+    :param num_steps: the number of steps captured on a signal or sentinel.
+    :param signal_name: the signal triggering a capture, or "".
+    :param sentinel: the sentinel file, "" for <log dir>/PROFILE or "none".
+    :param out_dir: where captures are written, <log dir>/profiles if "".
+    :param row_limit: the number of ops in the summaries.
+    """
+
+    def __init__(self, steps="", num_steps=5, signal_name="SIGUSR2", sentinel="", out_dir="", row_limit=30):
+        self.range = tuple(int(s) for s in steps.split(":")) if steps else None
+        assert self.range is None or len(self.range) == 2, f"profile steps must be start:end, got {steps}"
+        self.num_steps = num_steps
+        log_dir = logger.get_dir() or "."
+        self.sentinel = None if sentinel == "none" else sentinel or os.path.join(log_dir, SENTINEL_FILENAME)
+        self.out_dir = out_dir or os.path.join(log_dir, "profiles")
+        self.row_limit = row_limit
+        self.count = 0
+        self._requested = None
+        self._profiler = None
+        self._remaining = 0
+        self._start_step = None
+        self._sentinel_mtime = self._mtime()
+        if signal_name:
+            try:
+                signal.signal(getattr(signal, signal_name), self._on_signal)
+            except ValueError:
+                # Handlers can only be installed from the main thread.
+                logger.log(f"profiler: cannot handle {signal_name} outside of the main thread")
+
+    def attach(self, model):
+        """
+        Count every forward pass of model as a step, e.g. every denoising step
+        of a sampling loop. model is a torch module, or any denoiser with a
+        register_forward_pre_hook() method such as OnnxDenoiser.
+        """
+        if not hasattr(model, "register_forward_pre_hook"):
+            logger.log(f"profiler: cannot attach to {type(model).__name__}, call step() instead")
+            return
+        model.register_forward_pre_hook(lambda module, inputs: self.step())
+
+    @property
+    def active(self):
+        return self._profiler is not None
+
+    def _on_signal(self, signum, frame):
+        self._requested = self.num_steps
+
+    def _mtime(self):
+        try:
+            return os.stat(self.sentinel).st_mtime if self.sentinel else None
+        except OSError:
+            return None
+
+    def _check_sentinel(self):
+        mtime = self._mtime()
+        if mtime is None or mtime == self._sentinel_mtime:
+            return
+        self._sentinel_mtime = mtime
+        num_steps = self.num_steps
+        try:
+            with open(self.sentinel) as f:
+                num_steps = int(f.read().strip() or num_steps)
+        except (OSError, ValueError):
+            pass
+        self._requested = num_steps
+
+    def step(self, step=None):
+        """
+        Mark the end of a step and the start of the next one.
+
+        :param step: the number of the next step, for profile_steps; counted
+                     from 0 by the hook if None.
+        """
+        step = self.count if step is None else step
+        self.count += 1
+        if self._profiler is not None:
+            self._profiler.step()
+            self._remaining -= 1
+            if self._remaining <= 0:
+                self._stop()
+            return
+        self._check_sentinel()
+        if self.range is not None and step == max(self.range[0] - 1, 0):
+            # Warm up on the step before the range.
+            self._requested = self.range[1] - self.range[0]
+        if self._requested:
+            self._start(step, self._requested)
+        self._requested = None
+
+    def _start(self, step, num_steps):
+        activities = [th.profiler.ProfilerActivity.CPU]
+        if th.cuda.is_available():
+            activities.append(th.profiler.ProfilerActivity.CUDA)
+        self._start_step = step + 1
+        self._remaining = num_steps + 1
+        logger.log(f"profiler: capturing steps {self._start_step} to {self._start_step + num_steps - 1}")
+        self._profiler = th.profiler.profile(
+            activities=activities,
+            schedule=th.profiler.schedule(wait=0, warmup=1, active=num_steps, repeat=1),
+            on_trace_ready=self._write,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True,
+        )
+        self._profiler.start()
+
+    def _stop(self):
+        self._profiler.stop()
+        self._profiler = None
+
+    def close(self):
+        """
+        End the capture in progress, if any, writing what was recorded.
+        """
+        if self._profiler is not None:
+            self._stop()
+
+    def _write(self, profiler):
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"step{self._start_step:06d}_rank{_rank():03d}"
+        trace_path = os.path.join(self.out_dir, f"trace_{name}.json")
+        profiler.export_chrome_trace(trace_path)
+        averages = profiler.key_averages()
+        sort_by = "self_cuda_time_total" if th.cuda.is_available() else "self_cpu_time_total"
+        summary_path = os.path.join(self.out_dir, f"ops_{name}.txt")
+        with open(summary_path, "w") as f:
+            f.write(f"Top ops by {sort_by}:\n")
+            f.write(averages.table(sort_by=sort_by, row_limit=self.row_limit))
+            f.write("\n\nTop ops by self_cpu_memory_usage:\n")
+            f.write(averages.table(sort_by="self_cpu_memory_usage", row_limit=self.row_limit))
+            if th.cuda.is_available():
+                f.write("\n\nTop ops by self_cuda_memory_usage:\n")
+                f.write(averages.table(sort_by="self_cuda_memory_usage", row_limit=self.row_limit))
+        logger.log(f"profiler: wrote {trace_path} and {summary_path}")
+
+
+def _rank():
+    return th.distributed.get_rank() if th.distributed.is_initialized() else 0
@@ -0,0 +1,304 @@
+"""
+Int8 inference helpers for the denoisers and the guidance classifiers.
+
+Only nn.Linear layers are quantized. Embeddings and the tied `lm_head` stay in
+float32 because rounding compares continuous samples against those weights.
+Quantized modules are inference-only: they do not propagate gradients, so they
+cannot be used inside the Langevin guidance loop.
+"""
+
+import os
+
+import blobfile as bf
+import torch as th
+import torch.nn as nn
+
+from . import logger
+
+# Sub-modules that are never quantized (matched against every name component).
+QUANTIZE_SKIP_MODULES = ("word_embedding", "lm_head", "encoder_emb")
+
+QUANTIZE_MODES = ("dynamic", "static")
+
+
+def _linear_names(model, skip_modules=QUANTIZE_SKIP_MODULES):
+    names = []
+    for name, module in model.named_modules():
+        if not isinstance(module, nn.Linear):
+            continue
+        if name in skip_modules or any(part in skip_modules for part in name.split(".")):
+            continue
+        names.append(name)
+    return names
+
+
+def quantize_dynamic(model, skip_modules=QUANTIZE_SKIP_MODULES):
+    """
+    Dynamically quantize the Linear layers of a model to int8.
+
+    Weights are stored as int8 and activations are quantized on the fly, so no
+    calibration data is required.
+
+    :param model: a float32 nn.Module on the CPU.
+    :param skip_modules: sub-module names (or full dotted paths) that must
+                         stay in float32.
+    :return: a quantized copy of the model, in eval mode.
+    """
+    qconfig_spec = {
+        name: th.quantization.default_dynamic_qconfig
+        for name in _linear_names(model, skip_modules)
+    }
+    return th.quantization.quantize_dynamic(
+        model.eval(), qconfig_spec=qconfig_spec, dtype=th.qint8, inplace=False
+    )
+
+
+def _affine_qparams(min_val, max_val):
+    """
+    Compute quint8 (scale, zero_point) covering [min_val, max_val] and 0.
+    """
+    min_val = min(float(min_val), 0.0)
+    max_val = max(float(max_val), 0.0)
+    scale = max((max_val - min_val) / 255.0, 1e-8)
+    zero_point = int(round(-min_val / scale))
+    return scale, min(max(zero_point, 0), 255)
+
+
+class StaticQuantizedLinear(nn.Module):
+    """
+    A Linear layer with int8 per-channel weights and a calibrated activation
+    range, so activations are quantized with fixed parameters instead of
+    being re-scanned on every call.
+    """
+
+    def __init__(self, linear, input_range=(-1.0, 1.0), output_range=(-1.0, 1.0)):
+        super().__init__()
+        self.in_features = linear.in_features
+        self.out_features = linear.out_features
+        in_scale, in_zero_point = _affine_qparams(*input_range)
+        self.register_buffer("input_scale", th.tensor(in_scale, dtype=th.float64))
+        self.register_buffer("input_zero_point", th.tensor(in_zero_point))
+        # The buffers as Python numbers, so that forward() does not convert them.
+        self._input_qparams = (in_scale, in_zero_point)
+
+        weight = linear.weight.detach().float().cpu()
+        w_scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        qweight = th.quantize_per_channel(
+            weight,
+            w_scale.double(),
+            th.zeros(self.out_features, dtype=th.long),
+            0,
+            th.qint8,
+        )
+        bias = None if linear.bias is None else linear.bias.detach().float().cpu()
+        self.qlinear = th.nn.quantized.Linear(self.in_features, self.out_features)
+        self.qlinear.set_weight_bias(qweight, bias)
+        self.qlinear.scale, self.qlinear.zero_point = _affine_qparams(*output_range)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self._input_qparams = (self.input_scale.item(), int(self.input_zero_point.item()))
+
+    def forward(self, x):
+        qx = th.quantize_per_tensor(x.float(), *self._input_qparams, th.quint8)
+        return self.qlinear(qx).dequantize()
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
+def collect_activation_ranges(model, run_calibration, skip_modules=QUANTIZE_SKIP_MODULES):
+    """
+    Record the input and output ranges of every quantizable Linear layer.
+
+    :param model: the float32 model to calibrate.
+    :param run_calibration: a callable taking no arguments that runs a few
+                            forward passes of `model` on calibration data.
+    :return: a dict mapping layer names to (in_min, in_max, out_min, out_max).
+    """
+    ranges = {}
+    handles = []
+
+    def make_hook(name):
+        def hook(module, inputs, output):
+            x = inputs[0].detach()
+            y = output.detach()
+            stats = (x.min().item(), x.max().item(), y.min().item(), y.max().item())
+            if name in ranges:
+                old = ranges[name]
+                stats = (
+                    min(old[0], stats[0]),
+                    max(old[1], stats[1]),
+                    min(old[2], stats[2]),
+                    max(old[3], stats[3]),
+                )
+            ranges[name] = stats
+
+        return hook
+
+    modules = dict(model.named_modules())
+    for name in _linear_names(model, skip_modules):
+        handles.append(modules[name].register_forward_hook(make_hook(name)))
+    try:
+        model.eval()
+        with th.no_grad():
+            run_calibration()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return ranges
+
+
+def quantize_static(model, ranges, skip_modules=QUANTIZE_SKIP_MODULES):
+    """
+    Replace calibrated Linear layers by StaticQuantizedLinear.
+
+    Layers with no recorded range (never reached during calibration) fall back
+    to dynamic quantization.
+
+    :param model: a float32 nn.Module on the CPU.
+    :param ranges: the output of collect_activation_ranges().
+    :return: a quantized copy of the model, in eval mode.
+    """
+    qmodel = quantize_dynamic(
+        model,
+        skip_modules=tuple(skip_modules) + tuple(ranges.keys()),
+    )
+    modules = dict(model.named_modules())
+    for name, (in_min, in_max, out_min, out_max) in ranges.items():
+        parent_name, _, child = name.rpartition(".")
+        parent = qmodel.get_submodule(parent_name) if parent_name else qmodel
+        setattr(
+            parent,
+            child,
+            StaticQuantizedLinear(modules[name], (in_min, in_max), (out_min, out_max)),
+        )
+    return qmodel.eval()
+
+
+def quantized_cache_path(checkpoint_path, mode, cache_dir=None):
+    """
+    Get the on-disk location of the quantized copy of a checkpoint.
+    """
+    directory, base = os.path.split(checkpoint_path)
+    stem = base.rsplit(".", 1)[0]
+    return bf.join(cache_dir or directory, f"{stem}.int8_{mode}.pt")
+
+
+def load_quantized_model(
+    model_fn, checkpoint_path, mode="dynamic", cache_dir=None, calibrate_fn=None
+):
+    """
+    Build an int8 model from a float32 checkpoint, caching the result on disk.
+
+    The cache is reused as long as it is newer than the checkpoint, so only the
+    first call pays for loading the float32 weights and quantizing them.
+
+    :param model_fn: a callable with no arguments that builds the float32
+                     architecture (weights are loaded here).
+    :param checkpoint_path: the float32 state dict to quantize.
+    :param mode: "dynamic", or "static" to use calibrated activation ranges.
+    :param cache_dir: where to store the quantized state dict; defaults to the
+                      checkpoint's directory.
+    :param calibrate_fn: for static mode, a callable taking the float32 model
+                         and running forward passes on calibration data.
+    :return: the quantized model, in eval mode on the CPU.
+    """
+    assert mode in QUANTIZE_MODES, f"unknown quantization mode: {mode}"
+    cache_path = quantized_cache_path(checkpoint_path, mode, cache_dir)
+    model = model_fn().cpu().eval()
+
+    if bf.exists(cache_path) and bf.stat(cache_path).mtime >= bf.stat(checkpoint_path).mtime:
+        logger.log(f"loading quantized model from cache: {cache_path}")
+        with bf.BlobFile(cache_path, "rb") as f:
+            cached = th.load(f, map_location="cpu")
+        if mode == "dynamic":
+            qmodel = quantize_dynamic(model)
+        else:
+            # Placeholder ranges; the calibrated ones are restored from the cache.
+            qmodel = quantize_static(
+                model, {name: (-1.0, 1.0, -1.0, 1.0) for name in cached["ranges"]}
+            )
+        qmodel.load_state_dict(cached["state_dict"])
+        return qmodel.eval()
+
+    with bf.BlobFile(checkpoint_path, "rb") as f:
+        model.load_state_dict(th.load(f, map_location="cpu"))
+    ranges = {}
+    if mode == "dynamic":
+        qmodel = quantize_dynamic(model)
+    else:
+        assert calibrate_fn is not None, "static quantization needs calibration data"
+        ranges = collect_activation_ranges(model, lambda: calibrate_fn(model))
+        qmodel = quantize_static(model, ranges)
+
+    logger.log(f"saving quantized model to {cache_path}")
+    with bf.BlobFile(cache_path, "wb") as f:
+        th.save({"state_dict": qmodel.state_dict(), "ranges": ranges}, f)
+    return qmodel.eval()
+
+
+def model_size_mb(model):
+    """
+    Get the serialized size of a model's state dict, in megabytes.
+    """
+    import io
+
+    buf = io.BytesIO()
+    th.save(model.state_dict(), buf)
+    return buf.tell() / 2 ** 20
+
+
+@th.no_grad()
+def rounded_token_agreement(fp32_model, int8_model, diffusion, input_ids, timesteps, seed=0):
+    """
+    Compare the tokens recovered from x_0 predictions of two denoisers.
+
+    Both models see the same noised inputs; their x_0 predictions are rounded
+    through the float32 lm_head, as in the sampling scripts.
+
+    :param input_ids: an [N x T] tensor of ground-truth tokens.
+    :param timesteps: an iterable of diffusion steps to evaluate.
+    :return: a dict mapping each step to (agreement, fp32 acc, int8 acc).
+    """
+    x_start = fp32_model.get_embeds(input_ids)
+    results = {}
+    for step in timesteps:
+        t = th.full((input_ids.shape[0],), int(step), dtype=th.long)
+        gen = th.Generator().manual_seed(seed + int(step))
+        noise = th.randn(x_start.shape, generator=gen)
+        x_t = diffusion.q_sample(x_start, t, noise=noise)
+        tokens = []
+        for model in (fp32_model, int8_model):
+            out = diffusion.p_mean_variance(model, x_t, t, clip_denoised=False)
+            tokens.append(fp32_model.get_logits(out["pred_xstart"]).argmax(dim=-1))
+        results[int(step)] = (
+            (tokens[0] == tokens[1]).float().mean().item(),
+            (tokens[0] == input_ids).float().mean().item(),
+            (tokens[1] == input_ids).float().mean().item(),
+        )
+    return results
+
+
+@th.no_grad()
+def classifier_accuracy(model, input_ids, labels, timesteps=None, batch_size=64, seed=0):
+    """
+    Compute the accuracy of a guidance classifier.
+
+    The RNG is re-seeded first so that classifiers drawing their own noise
+    levels see the same draws, which keeps fp32 and int8 runs comparable.
+
+    :param input_ids: an [N x T] tensor of tokens.
+    :param labels: an [N] tensor of class ids.
+    :param timesteps: optional [N] tensor of noise levels fed to the model.
+    """
+    correct = 0
+    with th.random.fork_rng(devices=[]):
+        th.manual_seed(seed)
+        for i in range(0, input_ids.shape[0], batch_size):
+            batch_t = None if timesteps is None else timesteps[i : i + batch_size]
+            output = model(
+                input_ids=input_ids[i : i + batch_size], labels=None, timesteps=batch_t
+            )
+            correct += (output.logits.argmax(dim=-1) == labels[i : i + batch_size]).sum().item()
+    return correct / input_ids.shape[0]
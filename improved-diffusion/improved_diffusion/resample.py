@@ -57,6 +57,16 @@ class ScheduleSampler(ABC):
         weights = th.from_numpy(weights_np).float().to(device)
         return indices, weights
 
+    def state_dict(self):
+        """
+        Get the state to restore with load_state_dict() on resuming, e.g.
+        the loss history of a loss-aware sampler.
+        """
+        return {}
+
+    def load_state_dict(self, state_dict):
+        pass
+
 
 class UniformSampler(ScheduleSampler):
     def __init__(self, diffusion):
@@ -77,31 +87,19 @@ class LossAwareSampler(ScheduleSampler):
         This method will perform synchronization to make sure all of the ranks
         maintain the exact same reweighting.
 
+        All ranks must pass the same number of timesteps (as TrainLoop does);
+        timesteps and losses are packed into one tensor, so this is a single
+        all_gather and the result never leaves the device.
+
         :param local_ts: an integer Tensor of timesteps.
         :param local_losses: a 1D Tensor of losses.
         """
-        batch_sizes = [
-            th.tensor([0], dtype=th.int32, device=local_ts.device)
-            for _ in range(dist.get_world_size())
-        ]
-        dist.all_gather(
-            batch_sizes,
-            th.tensor([len(local_ts)], dtype=th.int32, device=local_ts.device),
-        )
-
-        # Pad all_gather batches to be the maximum batch size.
-        batch_sizes = [x.item() for x in batch_sizes]
-        max_bs = max(batch_sizes)
-
-        timestep_batches = [th.zeros(max_bs).to(local_ts) for bs in batch_sizes]
-        loss_batches = [th.zeros(max_bs).to(local_losses) for bs in batch_sizes]
-        dist.all_gather(timestep_batches, local_ts)
-        dist.all_gather(loss_batches, local_losses)
-        timesteps = [
-            x.item() for y, bs in zip(timestep_batches, batch_sizes) for x in y[:bs]
-        ]
-        losses = [x.item() for y, bs in zip(loss_batches, batch_sizes) for x in y[:bs]]
-        self.update_with_all_losses(timesteps, losses)
+        # float64 holds every timestep index exactly.
+        packed = th.stack([local_ts.to(th.float64), local_losses.detach().to(th.float64)])
+        gathered = [th.empty_like(packed) for _ in range(dist.get_world_size())]
+        dist.all_gather(gathered, packed)
+        gathered = th.cat(gathered, dim=1)
+        self.update_with_all_losses(gathered[0].long(), gathered[1])
 
     @abstractmethod
     def update_with_all_losses(self, ts, losses):
@@ -116,39 +114,89 @@ class LossAwareSampler(ScheduleSampler):
         ranks with identical arguments. Thus, it should have deterministic
         behavior to maintain state across workers.
 
-        :param ts: a list of int timesteps.
-        :param losses: a list of float losses, one per timestep.
+        :param ts: an integer Tensor (or list) of timesteps.
+        :param losses: a Tensor (or list) of float losses, one per timestep.
         """
 
 
 class LossSecondMomentResampler(LossAwareSampler):
+    """
+    Sample timesteps proportionally to the root mean square of their last
+    history_per_term losses.
+
+    The history is a [num_timesteps x history_per_term] ring buffer that lives
+    on the device of the losses; updates are scatters and sampling uses
+    th.multinomial, so neither synchronizes with the host.
+    """
+
     def __init__(self, diffusion, history_per_term=10, uniform_prob=0.001):
         self.diffusion = diffusion
         self.history_per_term = history_per_term
         self.uniform_prob = uniform_prob
-        self._loss_history = np.zeros(
-            [diffusion.num_timesteps, history_per_term], dtype=np.float64
+        # The extra last column absorbs the writes an update drops (see below).
+        self._loss_history = th.zeros(
+            [diffusion.num_timesteps, history_per_term + 1], dtype=th.float64
         )
-        self._loss_counts = np.zeros([diffusion.num_timesteps], dtype=np.int)
+        # The number of losses seen per timestep; the next slot is count % history.
+        self._loss_counts = th.zeros([diffusion.num_timesteps], dtype=th.long)
+
+    def _to(self, device):
+        if self._loss_history.device != device:
+            self._loss_history = self._loss_history.to(device)
+            self._loss_counts = self._loss_counts.to(device)
+
+    def _weights(self):
+        """
+        The normalized sampling distribution, as a tensor on the device of
+        the history.
+        """
+        n = self.diffusion.num_timesteps
+        uniform = th.full([n], 1.0 / n, dtype=th.float64, device=self._loss_history.device)
+        weights = th.sqrt(th.mean(self._loss_history[:, :-1] ** 2, dim=-1))
+        weights = weights / weights.sum().clamp(min=1e-300)
+        weights = weights * (1 - self.uniform_prob) + self.uniform_prob / n
+        return th.where(self._warmed_up(), weights, uniform)
 
     def weights(self):
-        if not self._warmed_up():
-            return np.ones([self.diffusion.num_timesteps], dtype=np.float64)
-        weights = np.sqrt(np.mean(self._loss_history ** 2, axis=-1))
-        weights /= np.sum(weights)
-        weights *= 1 - self.uniform_prob
-        weights += self.uniform_prob / len(weights)
-        return weights
+        return self._weights().cpu().numpy()
+
+    def sample(self, batch_size, device):
+        self._to(device)
+        p = self._weights()
+        indices = th.multinomial(p, batch_size, replacement=True)
+        weights = (1 / (len(p) * p[indices])).float()
+        return indices, weights
 
     def update_with_all_losses(self, ts, losses):
-        for t, loss in zip(ts, losses):
-            if self._loss_counts[t] == self.history_per_term:
-                # Shift out the oldest loss term.
-                self._loss_history[t, :-1] = self._loss_history[t, 1:]
-                self._loss_history[t, -1] = loss
-            else:
-                self._loss_history[t, self._loss_counts[t]] = loss
-                self._loss_counts[t] += 1
+        ts = th.as_tensor(ts, dtype=th.long)
+        self._to(ts.device)
+        losses = th.as_tensor(losses, dtype=th.float64, device=ts.device)
+        n, history = self.diffusion.num_timesteps, self.history_per_term
+
+        # Rank each loss among the earlier ones of the same timestep, so that
+        # repeated timesteps fill consecutive slots as a sequential update would.
+        order = th.sort(ts, stable=True).indices
+        sorted_ts = ts[order]
+        occurrences = th.bincount(ts, minlength=n)
+        first = th.cumsum(occurrences, 0) - occurrences
+        rank = th.empty_like(ts)
+        rank[order] = th.arange(len(ts), device=ts.device) - first[sorted_ts]
+
+        # Only the last `history` losses of a timestep survive the update; the
+        # others are sent to the scratch column instead of being masked out,
+        # which would need a device-to-host sync.
+        keep = rank >= occurrences[ts] - history
+        slots = th.where(keep, (self._loss_counts[ts] + rank) % history, th.full_like(ts, history))
+        self._loss_history[ts, slots] = losses
+        self._loss_counts += occurrences
+
+    def state_dict(self):
+        return {"loss_history": self._loss_history, "loss_counts": self._loss_counts}
+
+    def load_state_dict(self, state_dict):
+        device = self._loss_history.device
+        self._loss_history = state_dict["loss_history"].to(device=device, dtype=th.float64)
+        self._loss_counts = state_dict["loss_counts"].to(device=device, dtype=th.long)
 
     def _warmed_up(self):
-        return (self._loss_counts == self.history_per_term).all()
+        return (self._loss_counts >= self.history_per_term).all()
@@ -0,0 +1,121 @@
+"""
+An endless iterator over shuffled batches of a dataset whose position can be
+saved and restored.
+
+Every epoch is a permutation of the dataset drawn from (seed, epoch). It is
+cut into global batches of batch_size examples per rank, and rank r takes the
+r-th batch_size examples of each. The position is then only (epoch, offset),
+the number of examples of the epoch consumed by all the ranks: restoring it
+skips ahead by index arithmetic instead of iterating the dataset, and works
+with a different number of ranks too. The examples left at the end of an
+epoch, fewer than a global batch, are dropped.
+
+Random augmentations resume too if the dataset draws them from the generator
+passed to its get_example(index, rng) method, which is seeded by (seed, epoch,
+index); see symbolic_music.datasets.MidiDataset.
+"""
+
+import numpy as np
+import torch as th
+from torch.utils.data import DataLoader, Dataset
+
+from . import dist_util, logger
+
+
+class ResumableLoader:
+    """
+    :param dataset: a map-style dataset.
+    :param batch_size: the batch size per rank.
+    :param seed: the seed of the permutations, the same on every rank.
+    :param num_workers: the number of DataLoader worker processes.
+    """
+
+    def __init__(self, dataset, batch_size, seed=0, num_workers=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+        self.offset = 0
+        self._batches = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._batches is None:
+            self._batches = self._load_batches()
+        try:
+            batch = next(self._batches)
+        except StopIteration:
+            self.epoch += 1
+            self.offset = 0
+            self._batches = self._load_batches()
+            batch = next(self._batches)
+        # Batches prefetched by the workers are not counted until consumed.
+        self.offset += self.batch_size * dist_util.get_world_size()
+        return batch
+
+    def state_dict(self):
+        return dict(epoch=self.epoch, offset=self.offset, seed=self.seed, size=len(self.dataset))
+
+    def load_state_dict(self, state_dict):
+        if (state_dict["seed"], state_dict["size"]) != (self.seed, len(self.dataset)):
+            logger.log(f"data loader: resuming a position of seed {state_dict['seed']} over "
+                       f"{state_dict['size']} examples with seed {self.seed} over {len(self.dataset)}, "
+                       "the examples will differ")
+        self.epoch = state_dict["epoch"]
+        self.offset = state_dict["offset"]
+        self._batches = None
+
+    def _load_batches(self):
+        """
+        Start a DataLoader over the batches of this rank from the current
+        position to the end of the epoch.
+        """
+        rank, world_size = dist_util.get_rank(), dist_util.get_world_size()
+        global_batch = self.batch_size * world_size
+        assert len(self.dataset) >= global_batch, \
+            f"{len(self.dataset)} examples are less than a global batch of {global_batch}"
+        permutation = th.randperm(len(self.dataset), generator=_generator(self.seed, self.epoch))
+        indices = []
+        for start in range(self.offset, len(self.dataset) - global_batch + 1, global_batch):
+            start += rank * self.batch_size
+            indices.extend((self.epoch, i) for i in permutation[start : start + self.batch_size].tolist())
+        return iter(
+            DataLoader(
+                _SeededExamples(self.dataset, self.seed),
+                batch_size=self.batch_size,
+                sampler=indices,
+                num_workers=self.num_workers,
+                # Seeds the workers without drawing from the global torch RNG,
+                # whose state is resumed separately. Augmentations drawn from
+                # the worker seeds rather than get_example()'s rng do not resume.
+                generator=_generator(self.seed, self.epoch, self.offset, rank),
+            )
+        )
+
+
+class _SeededExamples(Dataset):
+    """
+    Loads the example of an (epoch, index) key, with a generator seeded by
+    (seed, epoch, index) if the dataset has a get_example(index, rng) method.
+    """
+
+    def __init__(self, dataset, seed):
+        self.dataset = dataset
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        epoch, index = key
+        if hasattr(self.dataset, "get_example"):
+            return self.dataset.get_example(index, np.random.default_rng([self.seed, epoch, index]))
+        return self.dataset[index]
+
+
+def _generator(*keys):
+    seed = int(np.random.SeedSequence(list(keys)).generate_state(1)[0])
+    return th.Generator().manual_seed(seed)
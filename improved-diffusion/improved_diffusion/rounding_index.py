@@ -0,0 +1,253 @@
+"""
+Nearest-embedding search used to round continuous samples onto the
+vocabulary.
+
+A RoundingIndex is built once per embedding matrix: vocabulary norms (or the
+normalized matrix for cosine) are cached, and queries are processed in chunks
+so that at most chunk_size x vocab distances exist at any time. For large
+vocabularies an inverted-file (IVF) index, optionally with product-quantized
+(PQ) codes, restricts each query to the vocabulary entries of its closest
+clusters.
+"""
+
+import math
+
+import torch as th
+
+ROUNDING_METRICS = ("l2", "cos")
+ROUNDING_INDEX_MODES = ("exact", "ivf", "ivfpq")
+
+
+def _kmeans(x, n_clusters, n_iters=20, seed=0):
+    """
+    Lloyd's k-means on the rows of x. Returns (centroids, assignments).
+    """
+    gen = th.Generator(device="cpu").manual_seed(seed)
+    perm = th.randperm(x.shape[0], generator=gen)[:n_clusters].to(x.device)
+    centroids = x[perm].clone()
+    for _ in range(n_iters):
+        assign = th.cdist(x, centroids).argmin(dim=1)
+        sums = th.zeros_like(centroids).index_add_(0, assign, x)
+        counts = th.bincount(assign, minlength=n_clusters).unsqueeze(1).to(x.dtype)
+        # Keep empty clusters where they are.
+        centroids = th.where(counts > 0, sums / counts.clamp(min=1), centroids)
+    return centroids, th.cdist(x, centroids).argmin(dim=1)
+
+
+class RoundingIndex:
+    """
+    A nearest-neighbour index over the rows of an embedding matrix.
+
+    :param embeddings: a [V x D] tensor; it is not copied, so the index must
+                       be rebuilt if it changes (see for_embedding()).
+    :param metric: "l2" or "cos".
+    :param chunk_size: the number of queries scored at once.
+    :param mode: "exact", "ivf" (inverted lists, exact distances within the
+                 probed lists) or "ivfpq" (inverted lists scored with PQ
+                 codes, then re-ranked exactly).
+    :param n_lists: the number of IVF clusters; defaults to 4 * sqrt(V).
+    :param n_probe: the number of clusters searched per query.
+    :param pq_subspaces: the number of PQ sub-vectors; must divide D.
+    :param pq_bits: bits per PQ code (codebook size 2 ** pq_bits).
+    :param refine_factor: with PQ, how many candidates per result are
+                          re-ranked with exact distances.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        metric="l2",
+        chunk_size=4096,
+        mode="exact",
+        n_lists=None,
+        n_probe=8,
+        pq_subspaces=4,
+        pq_bits=8,
+        refine_factor=4,
+        seed=0,
+    ):
+        assert metric in ROUNDING_METRICS, f"unknown metric: {metric}"
+        assert mode in ROUNDING_INDEX_MODES, f"unknown index mode: {mode}"
+        embeddings = embeddings.detach()
+        self.metric = metric
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.vocab_size, self.dim = embeddings.shape
+        self.weight = embeddings
+        if metric == "cos":
+            embeddings = embeddings / embeddings.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        self.embeddings = embeddings
+        self.emb_norm = (embeddings ** 2).sum(-1)  # V
+
+        if mode != "exact":
+            self.n_lists = min(n_lists or int(4 * math.sqrt(self.vocab_size)), self.vocab_size)
+            self.n_probe = min(n_probe, self.n_lists)
+            self.centroids, assign = _kmeans(embeddings, self.n_lists, seed=seed)
+            # Padded inverted lists: [n_lists x max_len] of vocab ids, -1 = empty.
+            order = th.argsort(assign)
+            counts = th.bincount(assign, minlength=self.n_lists)
+            offsets = th.cumsum(counts, 0) - counts
+            rank = th.arange(self.vocab_size, device=embeddings.device) - offsets[assign[order]]
+            self.lists = th.full(
+                (self.n_lists, int(counts.max())), -1, dtype=th.long, device=embeddings.device
+            )
+            self.lists[assign[order], rank] = order
+        if mode == "ivfpq":
+            assert self.dim % pq_subspaces == 0, "pq_subspaces must divide the embedding size"
+            self.pq_subspaces = pq_subspaces
+            self.refine_factor = refine_factor
+            sub = embeddings.view(self.vocab_size, pq_subspaces, -1)
+            n_codes = min(2 ** pq_bits, self.vocab_size)
+            codebooks, codes = [], []
+            for m in range(pq_subspaces):
+                book, code = _kmeans(sub[:, m].contiguous(), n_codes, seed=seed + m + 1)
+                codebooks.append(book)
+                codes.append(code)
+            self.codebooks = th.stack(codebooks)  # M x K x D/M
+            self.codes = th.stack(codes, dim=1)  # V x M
+            self.codebook_norm = (self.codebooks ** 2).sum(-1)  # M x K
+
+    @classmethod
+    def for_embedding(cls, module, **kwargs):
+        """
+        Get the index of an nn.Embedding (or any module with a `weight`),
+        building it on first use and again whenever the weight changes.
+        """
+        weight = module.weight
+        key = (weight.data_ptr(), weight._version, tuple(weight.shape), str(weight.device))
+        config = tuple(sorted(kwargs.items()))
+        cache = module.__dict__.setdefault("_rounding_indexes", {})
+        entry = cache.get(config)
+        if entry is None or entry[0] != key:
+            entry = (key, cls(weight, **kwargs))
+            cache[config] = entry
+        return entry[1]
+
+    def _scores(self, queries, candidates=None):
+        """
+        Higher-is-better scores of queries [Q x D] against all rows, or against
+        per-query candidate ids [Q x C] (-1 entries score -inf).
+        """
+        if candidates is None:
+            dots = queries @ self.embeddings.t()
+            if self.metric == "cos":
+                return dots
+            q_norm = (queries ** 2).sum(-1, keepdim=True)
+            return -(q_norm + self.emb_norm[None] - 2.0 * dots).clamp(min=0.0)
+        safe = candidates.clamp(min=0)
+        dots = th.einsum("qd,qcd->qc", queries, self.embeddings[safe])
+        if self.metric == "cos":
+            scores = dots
+        else:
+            q_norm = (queries ** 2).sum(-1, keepdim=True)
+            scores = -(q_norm + self.emb_norm[safe] - 2.0 * dots).clamp(min=0.0)
+        return scores.masked_fill(candidates < 0, -float("inf"))
+
+    def _probe(self, queries):
+        """
+        Get the candidate vocab ids [Q x n_probe * max_len] of each query.
+        """
+        if self.metric == "cos":
+            lists = (queries @ self.centroids.t()).topk(self.n_probe, dim=-1).indices
+        else:
+            lists = (-th.cdist(queries, self.centroids)).topk(self.n_probe, dim=-1).indices
+        return self.lists[lists].view(queries.shape[0], -1)
+
+    def _pq_scores(self, queries, candidates):
+        """
+        Approximate scores of queries against candidates from their PQ codes.
+        """
+        sub_q = queries.view(queries.shape[0], self.pq_subspaces, -1)  # Q x M x D/M
+        dots = th.einsum("qmd,mkd->qmk", sub_q, self.codebooks)
+        if self.metric == "cos":
+            table = dots
+        else:
+            table = -(self.codebook_norm[None] - 2.0 * dots)  # query norm is constant
+        codes = self.codes[candidates.clamp(min=0)]  # Q x C x M
+        scores = th.gather(
+            table.unsqueeze(1).expand(-1, candidates.shape[1], -1, -1),
+            3,
+            codes.unsqueeze(-1),
+        ).squeeze(-1).sum(-1)
+        return scores.masked_fill(candidates < 0, -float("inf"))
+
+    def _search_chunk(self, queries, k):
+        if self.mode == "exact":
+            return self._scores(queries).topk(k, dim=-1)
+        candidates = self._probe(queries)
+        if self.mode == "ivfpq":
+            n_refine = min(k * self.refine_factor, candidates.shape[1])
+            shortlist = self._pq_scores(queries, candidates).topk(n_refine, dim=-1).indices
+            candidates = th.gather(candidates, 1, shortlist)
+        k = min(k, candidates.shape[1])
+        values, positions = self._scores(queries, candidates).topk(k, dim=-1)
+        return values, th.gather(candidates, 1, positions)
+
+    def search(self, queries, k=1):
+        """
+        Find the k best vocabulary entries for each query.
+
+        :param queries: a [... x D] tensor.
+        :return: a tuple (scores, indices), each [N x k] with N the number of
+                 queries; scores are negative squared distances for l2 and
+                 cosine similarities for cos.
+        """
+        queries = queries.reshape(-1, self.dim).to(
+            device=self.embeddings.device, dtype=self.embeddings.dtype
+        )
+        if self.metric == "cos":
+            queries = queries / queries.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        values, indices = [], []
+        for chunk in th.split(queries, self.chunk_size):
+            v, i = self._search_chunk(chunk, k)
+            values.append(v)
+            indices.append(i)
+        return th.cat(values), th.cat(indices)
+
+    def scores(self, x):
+        """
+        Get exact scores of every vector in a [... x D] tensor against the
+        whole vocabulary, e.g. to mask them before rounding.
+
+        :return: a tensor with shape x.shape[:-1] + (V,), on x's device.
+        """
+        flat = x.reshape(-1, self.dim).to(device=self.embeddings.device, dtype=self.embeddings.dtype)
+        if self.metric == "cos":
+            flat = flat / flat.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        out = th.cat([self._scores(chunk) for chunk in th.split(flat, self.chunk_size)])
+        return out.view(*x.shape[:-1], self.vocab_size).to(x.device)
+
+    def round(self, x):
+        """
+        Get the nearest vocabulary id of every vector in a [... x D] tensor.
+
+        :return: a tensor of ids with shape x.shape[:-1], on x's device.
+        """
+        _, indices = self.search(x, k=1)
+        return indices[:, 0].view(x.shape[:-1]).to(x.device)
+
+    def soft_round(self, x, temperature):
+        """
+        Replace every vector by the softmax(score / temperature)-weighted mean
+        of the (unnormalized) embeddings, using exact scores chunked like
+        search().
+        """
+        flat = x.reshape(-1, self.dim).to(device=self.embeddings.device, dtype=self.embeddings.dtype)
+        if self.metric == "cos":
+            flat = flat / flat.norm(dim=-1, keepdim=True).clamp(min=1e-12)
+        out = []
+        for chunk in th.split(flat, self.chunk_size):
+            probs = th.softmax(self._scores(chunk) / temperature, dim=-1)
+            out.append(probs @ self.weight)
+        return th.cat(out).view(x.shape).to(device=x.device, dtype=x.dtype)
+
+
+def rounding_index_kwargs(args):
+    """
+    Get RoundingIndex options from the sampling flags (see
+    rounding_policy_defaults()); older argument namespaces get the exact index.
+    """
+    return dict(
+        mode=getattr(args, "rounding_index", "exact"),
+        n_probe=getattr(args, "rounding_n_probe", 8),
+    )
@@ -0,0 +1,156 @@
+"""
+Policies deciding when the x_0 prediction is clamped to the vocabulary during
+sampling.
+
+A policy wraps a rounding function with the `denoised_fn(x, t)` signature used
+by GaussianDiffusion.p_mean_variance(). `t` is the index into the sampling
+schedule (so it counts respaced steps when timestep_respacing is set), and
+all entries of `t` are assumed equal, as in the sampling loops.
+"""
+
+from .rounding_index import RoundingIndex
+
+ROUNDING_POLICIES = ("always", "threshold", "every_k", "soft")
+
+
+class RoundingPolicy:
+    """
+    Round on every step.
+
+    :param round_fn: a callable (x, t) -> x snapping x onto the embeddings.
+    """
+
+    def __init__(self, round_fn):
+        self.round_fn = round_fn
+        self.num_calls = 0
+        self.num_rounded = 0
+
+    def should_round(self, step):
+        return True
+
+    def __call__(self, x, t):
+        self.num_calls += 1
+        if self.should_round(int(t[0])):
+            self.num_rounded += 1
+            return self.round_fn(x, t)
+        return x
+
+
+class ThresholdRounding(RoundingPolicy):
+    """
+    Round only once the sampler is below a given step, leaving the noisy early
+    steps (where the x_0 prediction is far from any token) untouched.
+    """
+
+    def __init__(self, round_fn, t_threshold):
+        super().__init__(round_fn)
+        self.t_threshold = t_threshold
+
+    def should_round(self, step):
+        return step < self.t_threshold
+
+
+class EveryKRounding(RoundingPolicy):
+    """
+    Round on every k-th step. The last step (t = 0) is always rounded.
+    """
+
+    def __init__(self, round_fn, every_k):
+        super().__init__(round_fn)
+        assert every_k >= 1
+        self.every_k = every_k
+
+    def should_round(self, step):
+        return step % self.every_k == 0
+
+
+class SoftRounding(RoundingPolicy):
+    """
+    Replace x_0 by a softmax-weighted mix of embeddings, sharpening towards a
+    hard nearest-embedding rounding as t goes to 0.
+
+    The weights are softmax(-||x - e||^2 / tau) with tau annealed linearly from
+    `temperature` at t = num_timesteps - 1 down to 0; the final steps (where
+    tau would vanish) fall back to `round_fn`.
+
+    Samples are expected channels-last ([N x T x C]), as produced by the
+    transformer denoisers.
+
+    :param embedding: an nn.Embedding (or any module with a `weight`) holding
+                      the vocabulary embeddings.
+    """
+
+    def __init__(self, round_fn, embedding, num_timesteps, temperature=1.0, min_temperature=1e-3):
+        super().__init__(round_fn)
+        self.embedding = embedding
+        self.num_timesteps = num_timesteps
+        self.temperature = temperature
+        self.min_temperature = min_temperature
+
+    def __call__(self, x, t):
+        self.num_calls += 1
+        self.num_rounded += 1
+        step = int(t[0])
+        tau = self.temperature * step / max(self.num_timesteps - 1, 1)
+        if tau < self.min_temperature:
+            return self.round_fn(x, t)
+        return RoundingIndex.for_embedding(self.embedding).soft_round(x, tau)
+
+
+def create_rounding_policy(
+    policy,
+    round_fn,
+    embedding=None,
+    num_timesteps=None,
+    t_threshold=200,
+    every_k=10,
+    temperature=1.0,
+):
+    """
+    Create a rounding policy by name.
+
+    :param policy: one of ROUNDING_POLICIES.
+    :param round_fn: the hard rounding function, (x, t) -> x.
+    :param embedding: the embedding module, for the "soft" policy.
+    :param num_timesteps: the length of the sampling schedule, for "soft".
+    """
+    if policy == "always":
+        return RoundingPolicy(round_fn)
+    elif policy == "threshold":
+        return ThresholdRounding(round_fn, t_threshold)
+    elif policy == "every_k":
+        return EveryKRounding(round_fn, every_k)
+    elif policy == "soft":
+        assert embedding is not None and num_timesteps is not None
+        return SoftRounding(round_fn, embedding, num_timesteps, temperature)
+    else:
+        raise NotImplementedError(f"unknown rounding policy: {policy}")
+
+
+def rounding_policy_defaults():
+    """
+    Defaults for the rounding policy flags of the sampling scripts.
+    """
+    return dict(
+        rounding_policy="always",
+        rounding_t_threshold=200,
+        rounding_every_k=10,
+        rounding_temperature=1.0,
+        rounding_index="exact",  # exact | ivf | ivfpq, see RoundingIndex
+        rounding_n_probe=8,
+    )
+
+
+def rounding_policy_from_args(args, round_fn, embedding, num_timesteps):
+    """
+    Create the rounding policy selected by the rounding_policy_defaults() flags.
+    """
+    return create_rounding_policy(
+        args.rounding_policy,
+        round_fn,
+        embedding=embedding,
+        num_timesteps=num_timesteps,
+        t_threshold=args.rounding_t_threshold,
+        every_k=args.rounding_every_k,
+        temperature=args.rounding_temperature,
+    )
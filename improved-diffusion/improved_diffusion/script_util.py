@@ -35,6 +35,7 @@ def model_and_diffusion_defaults():
         rescale_timesteps=True,
         rescale_learned_sigmas=True,
         use_checkpoint=False,
+        checkpoint_policy='',  # transformer layers to checkpoint: all, every_K, attention, attention_every_K
         use_scale_shift_norm=True,
         model_arch='trans-unet',
         in_channel=8,
@@ -44,6 +45,7 @@ def model_and_diffusion_defaults():
         config_name='bert-base-uncased',
         experiment_mode='lm',
         logits_mode=1,
+        logits_chunk_size=0,  # positions per chunk of the rounding cross-entropy, 0 computes all the logits at once
     )
 
 
@@ -75,6 +77,8 @@ def create_model_and_diffusion(
     config_name,
     experiment_mode,
     logits_mode,
+    checkpoint_policy='',
+    logits_chunk_size=0,
     **kwargs,
 ):
     model = create_model(
@@ -97,6 +101,7 @@ def create_model_and_diffusion(
         config_name=config_name,
         experiment_mode=experiment_mode,
         logits_mode=logits_mode,
+        checkpoint_policy=checkpoint_policy,
     )
     diffusion = create_gaussian_diffusion(
         steps=diffusion_steps,
@@ -110,6 +115,7 @@ def create_model_and_diffusion(
         timestep_respacing=timestep_respacing,
         model_arch=model_arch,
         training_mode=training_mode,
+        logits_chunk_size=logits_chunk_size,
     )
     return model, diffusion
 
@@ -134,6 +140,7 @@ def create_model(
     config_name='',
     experiment_mode='lm',
     logits_mode=1,
+    checkpoint_policy='',
 ):
     print(f'creating model, based on {model_arch}')
     if model_arch == 'conv-unet':
@@ -255,6 +262,10 @@ def create_model(
         for res in attention_resolutions.split(","):
             attention_ds.append(image_size // int(res))
 
+        # use_checkpoint alone checkpoints every encoder layer.
+        if use_checkpoint and not checkpoint_policy:
+            checkpoint_policy = 'all'
+
         if model_arch == 'music-transformer':
             return MusicTransformerModel(
                 in_channels=in_channel,
@@ -263,7 +274,8 @@ def create_model(
                 dropout=dropout,
                 config_name=config_name,
                 vocab_size=vocab_size,
-                experiment_mode=experiment_mode
+                experiment_mode=experiment_mode,
+                checkpoint_policy=checkpoint_policy,
             )
 
         elif model_arch == 'longformer':
@@ -273,7 +285,8 @@ def create_model(
                 out_channels=(out_channel if not learn_sigma else out_channel*2),
                 dropout=dropout,
                 vocab_size=vocab_size,
-                experiment_mode=experiment_mode
+                experiment_mode=experiment_mode,
+                checkpoint_policy=checkpoint_policy,
             )
         return CleanedTransformerModel(
             in_channels=in_channel,
@@ -282,7 +295,8 @@ def create_model(
             dropout=dropout,
             vocab_size=vocab_size,
             experiment_mode=experiment_mode,
-            max_position_embeddings=max(image_size ** 2, 512)
+            max_position_embeddings=max(image_size ** 2, 512),
+            checkpoint_policy=checkpoint_policy,
         )
         # return TransformerNetModel2(
         #     in_channels=in_channel,  # 3, DEBUG**
@@ -421,6 +435,7 @@ def create_gaussian_diffusion(
     timestep_respacing="",
     model_arch='conv-unet',
     training_mode='emb',
+    logits_chunk_size=0,
 ):
     betas = gd.get_named_beta_schedule(noise_schedule, steps)
     if training_mode == 'e2e':
@@ -464,6 +479,7 @@ def create_gaussian_diffusion(
         rescale_timesteps=rescale_timesteps,
         model_arch=model_arch,
         training_mode=training_mode,
+        logits_chunk_size=logits_chunk_size,
     )
 
 
@@ -0,0 +1,106 @@
+"""
+Per-phase wall-clock timing of training steps.
+
+Phases may nest; each phase is charged its exclusive time (minus that of the
+phases nested in it), so the phases of a step add up to the step time. CUDA
+kernels run asynchronously, so without synchronization the time of a phase is
+charged to whichever later phase waits for the device; with sync=True the
+device is synchronized at every phase boundary, which is accurate but slows
+training down a little.
+"""
+
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import torch as th
+
+from . import logger
+
+
+class StepTimer:
+    """
+    Times the phases of each step and reports rolling statistics over the
+    last `window` steps.
+
+    :param window: the number of steps the statistics are computed over.
+    :param sync: if True, synchronize the device at phase boundaries.
+    :param device: the device to synchronize.
+    """
+
+    def __init__(self, window=100, sync=False, device=None):
+        self.window = window
+        self.sync = sync and device is not None and th.device(device).type == "cuda"
+        self.device = device
+        self.history = defaultdict(lambda: deque(maxlen=window))
+        self.step_times = deque(maxlen=window)
+        self.samples = deque(maxlen=window)
+        self.tokens = deque(maxlen=window)
+        self._current = defaultdict(float)
+        self._stack = []
+        self._step_start = None
+
+    def _now(self):
+        if self.sync:
+            th.cuda.synchronize(self.device)
+        return time.perf_counter()
+
+    def start_step(self):
+        self._current.clear()
+        self._step_start = self._now()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Charge the time spent in the block (minus nested phases) to `name`.
+        The block is also labeled `name` in profiler traces.
+        """
+        start = self._now()
+        self._stack.append(0.0)
+        try:
+            with th.profiler.record_function(name):
+                yield
+        finally:
+            nested = self._stack.pop()
+            elapsed = self._now() - start
+            self._current[name] += elapsed - nested
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def end_step(self, samples, tokens=0):
+        """
+        Record the phases of the step that began at the last start_step().
+
+        :param samples: the number of samples trained on in the step.
+        :param tokens: the number of tokens trained on in the step.
+        """
+        if self._step_start is None:
+            return
+        total = self._now() - self._step_start
+        self._current["other"] += total - sum(self._current.values())
+        for name in set(self.history) | set(self._current):
+            self.history[name].append(self._current.get(name, 0.0))
+        self.step_times.append(total)
+        self.samples.append(samples)
+        self.tokens.append(tokens)
+        self._step_start = None
+
+    def log(self):
+        """
+        Log the mean and 90th percentile (in ms) of every phase, the
+        50th/90th/99th percentiles of the whole step, the throughput and the
+        fraction of time spent waiting for data.
+        """
+        if not self.step_times:
+            return
+        for name, times in [("step", self.step_times)] + sorted(self.history.items()):
+            times = np.asarray(times) * 1000
+            logger.logkv(f"time_{name}_ms", times.mean())
+            for q in (50, 90, 99) if name == "step" else (90,):
+                logger.logkv(f"time_{name}_p{q}_ms", np.percentile(times, q))
+        elapsed = sum(self.step_times)
+        logger.logkv("samples_per_sec", sum(self.samples) / elapsed)
+        if sum(self.tokens):
+            logger.logkv("tokens_per_sec", sum(self.tokens) / elapsed)
+        logger.logkv("data_wait_frac", sum(self.history.get("data", ())) / elapsed)
@@ -1,5 +1,6 @@
 import torch as th
-import numpy as np
+
+from .rounding_index import RoundingIndex, rounding_index_kwargs
 
 def compute_logp(args, model, x, input_ids):
     word_emb = model.weight
@@ -57,48 +58,10 @@ def denoised_fn_round(args, model, text_emb, t):
     # assert t.float().mean() == t[0].float()
     
     # print(text_emb.shape) # bsz, seqlen, dim
-    down_proj_emb = model.weight  # input_embs
-    # print(t)
     old_shape = text_emb.shape
     old_device = text_emb.device
-
-    def get_efficient_knn(down_proj_emb, text_emb, dist='l2'):
-        if dist == 'l2':
-            emb_norm = (down_proj_emb**2).sum(-1).view(-1, 1) #vocab
-            text_emb_t = th.transpose(text_emb.view(-1, text_emb.size(-1)), 0, 1) #d, bsz*seqlen
-            arr_norm = (text_emb ** 2).sum(-1).view(-1, 1) #bsz*seqlen, 1
-            # print(emb_norm.shape, arr_norm.shape)
-            dist = emb_norm + arr_norm.transpose(0, 1) - 2.0 * th.mm(down_proj_emb, text_emb_t) #(vocab, d) x (d, bsz*seqlen)
-            dist = th.clamp(dist, 0.0, np.inf)
-            # print(dist.shape)
-        topk_out = th.topk(-dist, k=1, dim=0)
-        #     adjacency = down_proj_emb.unsqueeze(1).expand(-1, text_emb.size(0), -1) - text_emb.unsqueeze(0).expand(
-        #         down_proj_emb.size(0), -1, -1)
-        #     adjacency = -th.norm(adjacency, dim=-1)
-        # topk_out = th.topk(adjacency, k=1, dim=0)
-        # print(topk_out1.indices == topk_out.indices)
-        # assert th.all(topk_out1.indices == topk_out.indices)
-        return topk_out.values, topk_out.indices
-
-    def get_knn(down_proj_emb, text_emb, dist='l2'):
-        if dist == 'l2':
-            adjacency = down_proj_emb.unsqueeze(1).expand(-1, text_emb.size(0), -1) - text_emb.unsqueeze(0).expand(
-                down_proj_emb.size(0), -1, -1)
-            adjacency = -th.norm(adjacency, dim=-1)
-        topk_out = th.topk(adjacency, k=1, dim=0)
-        return topk_out.values, topk_out.indices
-
-    dist = 'l2'
-    if len(text_emb.shape) > 2:
-        text_emb = text_emb.reshape(-1, text_emb.size(-1))
-    else:
-        text_emb = text_emb
-    # val, indices = get_knn(down_proj_emb,
-    #                        text_emb.to(down_proj_emb.device), dist=dist)
-    val, indices = get_efficient_knn(down_proj_emb,
-                           text_emb.to(down_proj_emb.device), dist=dist)
-    rounded_tokens = indices[0]
-    # print(rounded_tokens.shape)
+    index = RoundingIndex.for_embedding(model, **rounding_index_kwargs(args))
+    rounded_tokens = index.round(text_emb).view(-1).to(model.weight.device)
     new_embeds = model(rounded_tokens).view(old_shape).to(old_device)
     if args.model_arch == '1d-unet':
         new_embeds = new_embeds.permute(0, 2, 1)
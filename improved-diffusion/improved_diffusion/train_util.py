@@ -1,6 +1,9 @@
+import contextlib
 import copy
 import functools
 import os
+import random
+import time
 
 import blobfile as bf
 import numpy as np
@@ -10,6 +13,9 @@ from torch.nn.parallel.distributed import DistributedDataParallel as DDP
 from torch.optim import AdamW
 
 from . import dist_util, logger
+from .checkpoint_writer import CheckpointWriter, read_latest_checkpoint
+from .comm_hooks import COMM_HOOKS, register_comm_hook
+from .indexed_checkpoint import INDEXED_SUFFIX, is_indexed_checkpoint
 from .fp16_util import (
     make_master_params,
     master_params_to_model_params,
@@ -17,14 +23,27 @@ from .fp16_util import (
     unflatten_master_params,
     zero_grad,
 )
-from .nn import update_ema
+from .nn import set_checkpointing, update_ema
 from .resample import LossAwareSampler, UniformSampler
+from .step_timer import StepTimer
+from .validation import Validator
+from .zero_optimizer import ShardedOptimizer
 
 # For ImageNet experiments, this was a good default value.
 # We found that the lg_loss_scale quickly climbed to
 # 20-21 within the first ~1K steps of training.
 INITIAL_LOG_LOSS_SCALE = 20.0
 
+# Autocast mixed precision; "fp32" disables it. The legacy use_fp16 path
+# (fp16 weights with flat fp32 master params) is separate.
+PRECISIONS = ("fp32", "bf16", "fp16")
+
+EMA_DTYPES = {"fp32": th.float32, "bf16": th.bfloat16, "fp16": th.float16}
+
+# With compile_step, the loss is compiled for static shapes; past this many
+# distinct microbatch shapes it is recompiled once with dynamic shapes.
+COMPILE_MAX_SHAPES = 4
+
 
 class TrainLoop:
     def __init__(
@@ -49,6 +68,30 @@ class TrainLoop:
         gradient_clipping=-1.,
         eval_data=None,
         eval_interval=-1,
+        precision="fp32",
+        ema_every=1,
+        ema_device="",
+        ema_dtype="fp32",
+        auto_microbatch=False,
+        microbatch_memory_fraction=0.9,
+        async_checkpoint=True,
+        keep_last_checkpoints=0,
+        keep_every_checkpoints=0,
+        save_optimizer=False,
+        sync_timers=False,
+        timer_window=100,
+        compile_step=False,
+        compile_mode="default",
+        zero_stage=0,
+        eval_batches=8,
+        eval_timesteps=4,
+        eval_microbatch=-1,
+        eval_max_seconds=0.0,
+        eval_use_ema=True,
+        profiler=None,
+        ddp_comm_hook="",
+        powersgd_rank=1,
+        powersgd_start_iter=1000,
     ):
         self.model = model
         self.diffusion = diffusion
@@ -62,12 +105,51 @@ class TrainLoop:
             if isinstance(ema_rate, float)
             else [float(x) for x in ema_rate.split(",")]
         )
+        self.auto_microbatch = auto_microbatch
+        self.microbatch_memory_fraction = microbatch_memory_fraction
         self.log_interval = log_interval
         self.eval_interval = eval_interval
+        # Validation on a fixed set of held-out examples and stratified
+        # timesteps, with the weights of the first EMA rate by default.
+        self.eval_use_ema = eval_use_ema
+        self.validator = None
+        if eval_data is not None:
+            self.validator = Validator(
+                diffusion,
+                eval_data,
+                num_batches=eval_batches,
+                timesteps_per_example=eval_timesteps,
+                microbatch=eval_microbatch,
+                max_seconds=eval_max_seconds,
+            )
         self.save_interval = save_interval
         self.resume_checkpoint = resume_checkpoint
         self.use_fp16 = use_fp16
         self.fp16_scale_growth = fp16_scale_growth
+        assert precision in PRECISIONS, f"unknown precision: {precision}"
+        assert not (use_fp16 and precision != "fp32"), "use_fp16 cannot be combined with autocast"
+        self.precision = precision
+        self.autocast_device = dist_util.dev().type
+        assert precision != "fp16" or self.autocast_device == "cuda", "fp16 autocast needs CUDA, use bf16"
+        # bf16 has the range of fp32, so only fp16 needs loss scaling.
+        self.grad_scaler = th.cuda.amp.GradScaler() if precision == "fp16" else None
+        # EMA weights may be updated every ema_every steps (with the decay
+        # corrected to rate ** ema_every) and kept off the accelerator or in a
+        # lower precision. bf16/fp16 round away updates much smaller than the
+        # weights, so combine them with ema_every > 1 for rates close to 1.
+        assert ema_dtype in EMA_DTYPES, f"unknown EMA dtype: {ema_dtype}"
+        self.ema_every = ema_every
+        self.ema_device = th.device(ema_device) if ema_device else dist_util.dev()
+        self.ema_dtype = EMA_DTYPES[ema_dtype]
+        # ZeRO: 1 shards the optimizer state (and the EMA weights) across
+        # ranks, 2 also shards the gradients; see zero_optimizer.py.
+        assert zero_stage in (0, 1, 2), f"unknown ZeRO stage: {zero_stage}"
+        assert not zero_stage or not (use_fp16 or precision == "fp16"), \
+            "ZeRO sharding needs fp32 or bf16 training, its skipped steps would desync ranks"
+        self.zero_stage = zero_stage
+        # Gradient compression for the DDP all-reduce, see comm_hooks.py.
+        assert ddp_comm_hook in COMM_HOOKS, f"unknown DDP communication hook: {ddp_comm_hook}"
+        assert not (ddp_comm_hook and zero_stage == 2), "ZeRO stage 2 reduces gradients without DDP"
         self.schedule_sampler = schedule_sampler or UniformSampler(diffusion)
         self.weight_decay = weight_decay
         self.lr_anneal_steps = lr_anneal_steps
@@ -81,16 +163,47 @@ class TrainLoop:
         self.master_params = self.model_params
         self.lg_loss_scale = INITIAL_LOG_LOSS_SCALE
         self.sync_cuda = th.cuda.is_available()
+        # Per-phase step times; sync_timers makes them exact on CUDA at the
+        # cost of a device sync per phase.
+        self.timer = StepTimer(window=timer_window, sync=sync_timers, device=dist_util.dev())
+        # An optional ProfilerHook, stepped after every training step.
+        self.profiler = profiler
+
+        # torch.compile the training loss (its backward is compiled along
+        # with it), specialized to each microbatch shape; see _loss_fn().
+        assert not compile_step or hasattr(th, "compile"), "compile_step needs torch >= 2.0"
+        self.compile_step = compile_step
+        self.compile_mode = compile_mode
+        self._compiled_losses = None
+        self._compiled_shapes = set()
+        self._compile_dynamic = False
+        if compile_step and self.batch_size % self.microbatch:
+            logger.log(f"compiled step: batch_size {self.batch_size} is not a multiple of microbatch "
+                       f"{self.microbatch}, the last microbatch gets its own graph")
 
         self.checkpoint_path = checkpoint_path # DEBUG **
+        self.save_optimizer = save_optimizer
+        self.checkpoint_writer = CheckpointWriter(
+            checkpoint_path,
+            keep_last=keep_last_checkpoints,
+            keep_every=keep_every_checkpoints,
+            async_write=async_checkpoint,
+        )
 
         self._load_and_sync_parameters()
         if self.use_fp16:
             self._setup_fp16()
 
-        self.opt = AdamW(self.master_params, lr=self.lr, weight_decay=self.weight_decay)
+        if self.zero_stage:
+            self.opt = ShardedOptimizer(
+                self.master_params, AdamW, stage=self.zero_stage, lr=self.lr, weight_decay=self.weight_decay
+            )
+        else:
+            self.opt = AdamW(self.master_params, lr=self.lr, weight_decay=self.weight_decay)
         if self.resume_step:
             self._load_optimizer_state()
+            self._load_grad_scaler_state()
+            self._load_training_state()
             # Model was resumed, either due to a restart or a checkpoint
             # being specified at the command line.
             self.ema_params = [
@@ -98,10 +211,14 @@ class TrainLoop:
             ]
         else:
             self.ema_params = [
-                copy.deepcopy(self.master_params) for _ in range(len(self.ema_rate))
+                self._ema_copy(self.master_params) for _ in range(len(self.ema_rate))
             ]
 
-        if th.cuda.is_available(): # DEBUG **
+        if self.zero_stage == 2:
+            # Gradients are reduced to their owners by the optimizer instead.
+            self.use_ddp = False
+            self.ddp_model = self.model
+        elif th.cuda.is_available(): # DEBUG **
             self.use_ddp = True
             self.ddp_model = DDP(
                 self.model,
@@ -111,48 +228,67 @@ class TrainLoop:
                 bucket_cap_mb=128,
                 find_unused_parameters=False,
             )
+        elif dist.get_world_size() > 1:
+            # CPU data parallelism: DDP all-reduces the gradient buckets over
+            # gloo, overlapped with the backward pass.
+            self.use_ddp = True
+            self.ddp_model = DDP(
+                self.model,
+                broadcast_buffers=False,
+                find_unused_parameters=False,
+            )
         else:
-            if dist.get_world_size() > 1:
-                logger.warn(
-                    "Distributed training requires CUDA. "
-                    "Gradients will not be synchronized properly!"
-                )
             self.use_ddp = False
             self.ddp_model = self.model
+        if self.use_ddp:
+            register_comm_hook(self.ddp_model, ddp_comm_hook, powersgd_rank, powersgd_start_iter)
 
     def _load_and_sync_parameters(self):
-        resume_checkpoint = find_resume_checkpoint() or self.resume_checkpoint
+        resume_checkpoint = find_resume_checkpoint(self.checkpoint_path) or self.resume_checkpoint
 
         if resume_checkpoint:
             self.resume_step = parse_resume_step_from_filename(resume_checkpoint)
+            # load_state_dict() broadcasts over MPI, so every rank calls it.
+            state_dict = dist_util.load_state_dict(
+                resume_checkpoint, map_location=dist_util.dev()
+            )
             if dist.get_rank() == 0:
-                logger.log(f"loading model from checkpoint: {resume_checkpoint}...")
-                self.model.load_state_dict(
-                    dist_util.load_state_dict(
-                        resume_checkpoint, map_location=dist_util.dev()
-                    )
-                )
+                # Checkpoints do not depend on the world size, so an elastic
+                # restart may resume with a different number of ranks (and
+                # global batch size, as batch_size is per rank).
+                logger.log(f"loading model from checkpoint: {resume_checkpoint} "
+                           f"with {dist.get_world_size()} ranks...")
+                self.model.load_state_dict(state_dict)
 
         dist_util.sync_params(self.model.parameters())
 
     def _load_ema_parameters(self, rate):
         ema_params = copy.deepcopy(self.master_params)
 
-        main_checkpoint = find_resume_checkpoint() or self.resume_checkpoint
+        main_checkpoint = find_resume_checkpoint(self.checkpoint_path) or self.resume_checkpoint
         ema_checkpoint = find_ema_checkpoint(main_checkpoint, self.resume_step, rate)
         if ema_checkpoint:
+            state_dict = dist_util.load_state_dict(
+                ema_checkpoint, map_location=dist_util.dev()
+            )
             if dist.get_rank() == 0:
                 logger.log(f"loading EMA from checkpoint: {ema_checkpoint}...")
-                state_dict = dist_util.load_state_dict(
-                    ema_checkpoint, map_location=dist_util.dev()
-                )
                 ema_params = self._state_dict_to_master_params(state_dict)
 
         dist_util.sync_params(ema_params)
-        return ema_params
+        return self._ema_copy(ema_params)
+
+    def _ema_copy(self, params):
+        if self.zero_stage:
+            # Each rank only keeps the EMA of the parameters it owns.
+            params = self.opt.shard(params)
+        return [
+            p.detach().to(device=self.ema_device, dtype=self.ema_dtype, copy=True)
+            for p in params
+        ]
 
     def _load_optimizer_state(self):
-        main_checkpoint = find_resume_checkpoint() or self.resume_checkpoint
+        main_checkpoint = find_resume_checkpoint(self.checkpoint_path) or self.resume_checkpoint
         opt_checkpoint = bf.join(
             bf.dirname(main_checkpoint), f"opt{self.resume_step:06}.pt"
         )
@@ -163,6 +299,47 @@ class TrainLoop:
             )
             self.opt.load_state_dict(state_dict)
 
+    def _load_grad_scaler_state(self):
+        if self.grad_scaler is None:
+            return
+        main_checkpoint = find_resume_checkpoint(self.checkpoint_path) or self.resume_checkpoint
+        scaler_checkpoint = bf.join(
+            bf.dirname(main_checkpoint), f"scaler{self.resume_step:06}.pt"
+        )
+        if bf.exists(scaler_checkpoint):
+            logger.log(f"loading grad scaler state from checkpoint: {scaler_checkpoint}")
+            self.grad_scaler.load_state_dict(th.load(scaler_checkpoint, map_location="cpu"))
+
+    def _load_training_state(self):
+        """
+        Restore the data loader position, the RNG states of every rank and
+        the schedule sampler, so that a resumed run continues as if it had
+        not stopped (with the same number of ranks).
+        """
+        main_checkpoint = find_resume_checkpoint(self.checkpoint_path) or self.resume_checkpoint
+        state_checkpoint = bf.join(
+            bf.dirname(main_checkpoint), f"state{self.resume_step:06}.pt"
+        )
+        if not bf.exists(state_checkpoint):
+            logger.log(f"no training state in checkpoint {main_checkpoint}, "
+                       "the data order and random numbers start afresh")
+            return
+        logger.log(f"loading training state from checkpoint: {state_checkpoint}")
+        with bf.BlobFile(state_checkpoint, "rb") as f:
+            state = th.load(f, map_location="cpu")
+        self.schedule_sampler.load_state_dict(state["schedule_sampler"])
+        if state["data"] is not None and hasattr(self.data, "load_state_dict"):
+            # Skips ahead by index arithmetic, without loading any batch.
+            self.data.load_state_dict(state["data"])
+        else:
+            logger.log("the data loader cannot be resumed, it starts afresh")
+        rng_states = state["rng"]
+        if len(rng_states) != dist.get_world_size():
+            logger.log(f"the RNG states of {len(rng_states)} ranks are restored on "
+                       f"{dist.get_world_size()} ranks, random numbers will differ")
+        if dist.get_rank() < len(rng_states):
+            _set_rng_state(rng_states[dist.get_rank()])
+
     def _setup_fp16(self):
         self.master_params = make_master_params(self.model_params)
         self.model.convert_to_fp16()
@@ -172,62 +349,208 @@ class TrainLoop:
             not self.lr_anneal_steps
             or self.step + self.resume_step < self.lr_anneal_steps
         ):
-            batch, cond = next(self.data)
+            self.timer.start_step()
+            with self.timer.phase("data"):
+                batch, cond = next(self.data)
+            if self.auto_microbatch:
+                self.find_microbatch(batch, cond)
+                self.auto_microbatch = False
             self.run_step(batch, cond)
             if self.step % self.log_interval == 0:
-                logger.dumpkvs()
-            if self.eval_data is not None and self.step % self.eval_interval == 0:
-                batch_eval, cond_eval = next(self.eval_data)
-                self.forward_only(batch, cond)
-                print('eval on validation set')
-                logger.dumpkvs()
+                with self.timer.phase("log"):
+                    self.timer.log()
+                    logger.dumpkvs()
+            if self.validator is not None and self.eval_interval > 0 and self.step % self.eval_interval == 0:
+                with self.timer.phase("eval"):
+                    self.validate()
+                    logger.dumpkvs()
+            # Checkpoint N holds the state after N steps, so that a run
+            # resumed from it carries on with step N.
+            self.step += 1
             if self.step % self.save_interval == 0:
-                self.save()
+                with self.timer.phase("save"):
+                    self.save()
                 # Run for a finite amount of time in integration tests.
-                if os.environ.get("DIFFUSION_TRAINING_TEST", "") and self.step > 0:
+                if os.environ.get("DIFFUSION_TRAINING_TEST", ""):
+                    self.checkpoint_writer.wait()
                     return
-            self.step += 1
+            tokens = cond["input_ids"].numel() * dist.get_world_size() if "input_ids" in cond else 0
+            self.timer.end_step(self.global_batch, tokens)
+            if self.profiler is not None:
+                self.profiler.step(self.step + self.resume_step)
+        if self.profiler is not None:
+            self.profiler.close()
         # Save the last checkpoint if it wasn't already saved.
-        if (self.step - 1) % self.save_interval != 0:
+        if self.step % self.save_interval != 0:
             self.save()
+        self.checkpoint_writer.wait()
+
+    def find_microbatch(self, batch, cond):
+        """
+        Probe forward/backward passes on slices of a batch, with and without
+        gradient checkpointing, and keep the largest microbatch whose peak
+        memory fits in microbatch_memory_fraction of the device on every rank,
+        without checkpointing if that fits as large a microbatch. Gradients are
+        still accumulated over the whole batch, so the effective batch is
+        unchanged.
+        """
+        device = dist_util.dev()
+        if device.type != "cuda":
+            logger.log("auto microbatch: memory probing needs CUDA, keeping "
+                       f"microbatch={self.microbatch}")
+            return
+        budget = self.microbatch_memory_fraction * th.cuda.get_device_properties(device).total_memory
+        if not self.opt.state:
+            # Adam moments are allocated on the first step, after the probes.
+            budget -= 2 * sum(p.numel() * 4 for p in self.master_params)
+        sizes = sorted({min(2 ** i, batch.shape[0]) for i in range(batch.shape[0].bit_length() + 1)})
+
+        # The largest fitting size without and with checkpointing, 0 for none.
+        fits = [0, 0]
+        # The probes must not shift the random numbers of training (and of a resumed run).
+        with th.random.fork_rng(devices=[device]):
+            for use_checkpoint in (False, True):
+                if not set_checkpointing(self.model, use_checkpoint) and use_checkpoint:
+                    break
+                self._probe_microbatch(batch, cond, sizes[0])  # warm up
+                for size in sizes:
+                    result = self._probe_microbatch(batch, cond, size)
+                    if result is None:
+                        logger.log(f"auto microbatch: {size} (checkpointing={use_checkpoint}) is out of memory")
+                        break
+                    peak, seconds = result
+                    logger.log(f"auto microbatch: {size} (checkpointing={use_checkpoint}) "
+                               f"peak {peak / 2 ** 20:.0f} MiB, {size / seconds:.1f} samples/s")
+                    if peak > budget:
+                        break
+                    fits[use_checkpoint] = size
+
+        # Every rank must accumulate the same number of microbatches, with the
+        # same checkpointing, so both are chosen from the minimum over ranks.
+        fits = th.tensor(fits, device=device)
+        dist.all_reduce(fits, op=dist.ReduceOp.MIN)
+        no_checkpoint_size, checkpoint_size = fits.tolist()
+        use_checkpoint = checkpoint_size > no_checkpoint_size or not no_checkpoint_size
+        self.microbatch = max(no_checkpoint_size, checkpoint_size) or sizes[0]
+        set_checkpointing(self.model, use_checkpoint)
+        n_micro = (batch.shape[0] + self.microbatch - 1) // self.microbatch
+        logger.log(f"auto microbatch: using microbatch={self.microbatch} with checkpointing={use_checkpoint}, "
+                   f"accumulating {n_micro} microbatches per batch of {batch.shape[0]}")
+        logger.logkv("microbatch", self.microbatch)
+
+    def _probe_microbatch(self, batch, cond, size):
+        """
+        Run one forward/backward pass on the first `size` examples without
+        touching the optimizer, samplers or logs.
+
+        :return: (peak bytes, seconds), or None if it ran out of memory.
+        """
+        device = dist_util.dev()
+        micro = batch[:size].to(device)
+        micro_cond = {k: v[:size].to(device) for k, v in cond.items()}
+        t = th.randint(0, self.diffusion.num_timesteps, (size,), device=device)
+        zero_grad(self.model_params)
+        th.cuda.synchronize()
+        th.cuda.reset_peak_memory_stats(device)
+        start = time.time()
+        try:
+            with self._autocast():
+                losses = self.diffusion.training_losses(self.model, micro, t, model_kwargs=micro_cond)
+            losses["loss"].mean().backward()
+            th.cuda.synchronize()
+        except RuntimeError as e:
+            if "out of memory" not in str(e):
+                raise
+            return None
+        finally:
+            zero_grad(self.model_params)
+            losses = None
+            th.cuda.empty_cache()
+        return th.cuda.max_memory_allocated(device), time.time() - start
 
-    def run_step(self, batch, cond):  # the only thing for each step
-        self.forward_backward(batch, cond)
-        if self.use_fp16:
-            self.optimize_fp16()
-        else:
-            self.optimize_normal()
-        self.log_step()
+    def _compute_losses(self, micro, t, micro_cond):
+        return self.diffusion.training_losses(
+            self.ddp_model, micro, t, model_kwargs=dict(micro_cond)
+        )
 
-    def forward_only(self, batch, cond):
-        with th.no_grad():
-            zero_grad(self.model_params)
-            for i in range(0, batch.shape[0], self.microbatch):
-                micro = batch[i: i + self.microbatch].to(dist_util.dev())
-                micro_cond = {
-                    k: v[i: i + self.microbatch].to(dist_util.dev())
-                    for k, v in cond.items()
-                }
-                last_batch = (i + self.microbatch) >= batch.shape[0]
-                t, weights = self.schedule_sampler.sample(micro.shape[0], dist_util.dev())
-                # print(micro_cond.keys())
-                compute_losses = functools.partial(
-                    self.diffusion.training_losses,
-                    self.ddp_model,
-                    micro,
-                    t,
-                    model_kwargs=micro_cond,
-                )
+    def _loss_fn(self, micro, micro_cond):
+        """
+        Get the function computing the losses of a microbatch: eager, or
+        compiled for the shapes of this microbatch.
+
+        Each new shape (a different sequence length, or a ragged last
+        microbatch) costs a recompilation; once more than COMPILE_MAX_SHAPES
+        shapes were seen, the loss is recompiled with dynamic shapes instead.
+        """
+        if not self.compile_step:
+            return self._compute_losses
+        shape = (tuple(micro.shape),) + tuple(
+            (k, tuple(v.shape)) for k, v in sorted(micro_cond.items())
+        )
+        if shape not in self._compiled_shapes:
+            self._compiled_shapes.add(shape)
+            if len(self._compiled_shapes) > COMPILE_MAX_SHAPES and not self._compile_dynamic:
+                logger.log(f"compiled step: more than {COMPILE_MAX_SHAPES} shapes, "
+                           "recompiling with dynamic shapes")
+                th._dynamo.reset()
+                self._compile_dynamic = True
+                self._compiled_losses = None
+            elif not self._compile_dynamic:
+                logger.log(f"compiled step: compiling for shape {shape}")
+        if self._compiled_losses is None:
+            th._dynamo.config.cache_size_limit = max(
+                th._dynamo.config.cache_size_limit, COMPILE_MAX_SHAPES + 1
+            )
+            self._compiled_losses = th.compile(
+                self._compute_losses, mode=self.compile_mode, dynamic=self._compile_dynamic
+            )
+        return self._compiled_losses
 
-                if last_batch or not self.use_ddp:
-                    losses = compute_losses()
-                else:
-                    with self.ddp_model.no_sync():
-                        losses = compute_losses()
+    def _autocast(self):
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        dtype = th.bfloat16 if self.precision == "bf16" else th.float16
+        return th.autocast(device_type=self.autocast_device, dtype=dtype)
 
-                log_loss_dict(
-                    self.diffusion, t, {f"eval_{k}": v * weights for k, v in losses.items()}
-                )
+    def run_step(self, batch, cond):  # the only thing for each step
+        with self.timer.phase("forward_backward"):
+            self.forward_backward(batch, cond)
+        with self.timer.phase("optimize"):
+            if self.use_fp16:
+                self.optimize_fp16()
+            else:
+                self.optimize_normal()
+        with self.timer.phase("log"):
+            self.log_step()
+
+    def validate(self):
+        """
+        Log the losses on the validation set, computed in eval mode with the
+        EMA weights (if eval_use_ema) swapped into the model.
+        """
+        ema_params = None
+        if self.eval_use_ema:
+            ema_params = self.ema_params[0]
+            if self.zero_stage:
+                ema_params = self.opt.gather(ema_params, dst=None)
+            if self.use_fp16:
+                ema_params = unflatten_master_params(self.model_params, ema_params)
+        was_training = self.model.training
+        backup = None
+        with th.no_grad():
+            if ema_params is not None:
+                backup = [p.detach().clone() for p in self.model_params]
+                for p, ema in zip(self.model_params, ema_params):
+                    p.copy_(ema)
+            self.model.eval()
+            try:
+                fraction = self.validator.run(self.model, autocast=self._autocast)
+            finally:
+                self.model.train(was_training)
+                if backup is not None:
+                    for p, saved in zip(self.model_params, backup):
+                        p.copy_(saved)
+        logger.logkv("eval_fraction", fraction)
 
 
     def forward_backward(self, batch, cond):
@@ -243,18 +566,18 @@ class TrainLoop:
             t, weights = self.schedule_sampler.sample(micro.shape[0], dist_util.dev())
             # print(micro_cond.keys())
             compute_losses = functools.partial(
-                self.diffusion.training_losses,
-                self.ddp_model,
+                self._loss_fn(micro, micro_cond),
                 micro,
                 t,
-                model_kwargs=micro_cond,
+                micro_cond,
             )
 
-            if last_batch or not self.use_ddp:
-                losses = compute_losses()
-            else:
-                with self.ddp_model.no_sync():
+            with self._autocast():
+                if last_batch or not self.use_ddp:
                     losses = compute_losses()
+                else:
+                    with self.ddp_model.no_sync():
+                        losses = compute_losses()
 
             if isinstance(self.schedule_sampler, LossAwareSampler):
                 self.schedule_sampler.update_with_local_losses(
@@ -268,8 +591,12 @@ class TrainLoop:
             if self.use_fp16:
                 loss_scale = 2 ** self.lg_loss_scale
                 (loss * loss_scale).backward()
+            elif self.grad_scaler is not None:
+                self.grad_scaler.scale(loss).backward()
             else:
                 loss.backward()
+            if self.zero_stage == 2:
+                self.opt.reduce_gradients()
 
     def optimize_fp16(self):
         if any(not th.isfinite(p.grad).all() for p in self.model_params):
@@ -282,8 +609,7 @@ class TrainLoop:
         self._log_grad_norm()
         self._anneal_lr()
         self.opt.step()
-        for rate, params in zip(self.ema_rate, self.ema_params):
-            update_ema(params, self.master_params, rate=rate)
+        self._update_ema()
         master_params_to_model_params(self.model_params, self.master_params)
         self.lg_loss_scale += self.fp16_scale_growth
 
@@ -306,19 +632,39 @@ class TrainLoop:
             )
 
     def optimize_normal(self):
+        if self.grad_scaler is not None:
+            # Clip and log the true gradients; step() skips the update on inf/NaN.
+            self.grad_scaler.unscale_(self.opt)
         if self.gradient_clipping > 0:
             self.grad_clip()
         self._log_grad_norm()
         self._anneal_lr()
-        self.opt.step()
-        for rate, params in zip(self.ema_rate, self.ema_params):
-            update_ema(params, self.master_params, rate=rate)
+        if self.grad_scaler is not None:
+            self.grad_scaler.step(self.opt)
+            self.grad_scaler.update()
+        else:
+            self.opt.step()
+        self._update_ema()
+
+    def _update_ema(self):
+        if (self.step + self.resume_step) % self.ema_every != 0:
+            return
+        with self.timer.phase("ema"):
+            source = self.opt.shard(self.master_params) if self.zero_stage else self.master_params
+            for rate, params in zip(self.ema_rate, self.ema_params):
+                update_ema(params, source, rate=rate ** self.ema_every)
 
     def _log_grad_norm(self):
-        sqsum = 0.0
-        for p in self.master_params:
-            sqsum += (p.grad ** 2).sum().item()
-        logger.logkv_mean("grad_norm", np.sqrt(sqsum))
+        # Logged as a tensor, so no host sync happens before dumpkvs().
+        grads = [p.grad for p in self.master_params if p.grad is not None]
+        if self.zero_stage == 2:
+            # Each rank only holds the gradients it owns.
+            norm = self.opt.grad_norm()
+        elif hasattr(th, "_foreach_norm"):
+            norm = th.stack(th._foreach_norm(grads)).norm()
+        else:
+            norm = th.stack([g.norm() for g in grads]).norm()
+        logger.logkv_mean("grad_norm", norm)
 
     def _anneal_lr(self):
         if not self.lr_anneal_steps:
@@ -333,33 +679,42 @@ class TrainLoop:
         logger.logkv("samples", (self.step + self.resume_step + 1) * self.global_batch)
         if self.use_fp16:
             logger.logkv("lg_loss_scale", self.lg_loss_scale)
+        if self.grad_scaler is not None and self.step % self.log_interval == 0:
+            logger.logkv("grad_scale", self.grad_scaler.get_scale())  # syncs, so only when dumping
 
     def save(self):
-        def save_checkpoint(rate, params):
-            state_dict = self._master_params_to_state_dict(params)
-            if dist.get_rank() == 0:
-                logger.log(f"saving model {rate}...")
-                if not rate:
-                    filename = f"model{(self.step+self.resume_step):06d}.pt"
-                else:
-                    filename = f"ema_{rate}_{(self.step+self.resume_step):06d}.pt"
-                print('writing to', bf.join(get_blob_logdir(), filename))
-                print('writing to', bf.join(self.checkpoint_path, filename))
-                # with bf.BlobFile(bf.join(get_blob_logdir(), filename), "wb") as f:
-                #     th.save(state_dict, f)
-                with bf.BlobFile(bf.join(self.checkpoint_path, filename), "wb") as f: # DEBUG **
-                    th.save(state_dict, f)
-
-        save_checkpoint(0, self.master_params)
-        for rate, params in zip(self.ema_rate, self.ema_params):
-            save_checkpoint(rate, params)
-
-        # if dist.get_rank() == 0: # DEBUG **
-        #     with bf.BlobFile(
-        #         bf.join(get_blob_logdir(), f"opt{(self.step+self.resume_step):06d}.pt"),
-        #         "wb",
-        #     ) as f:
-        #         th.save(self.opt.state_dict(), f)
+        """
+        Snapshot the model, EMA, optimizer and grad scaler state, and the
+        training state (data loader position, RNG states of every rank and
+        schedule sampler), to CPU and hand them to the checkpoint writer,
+        which writes them atomically (in the background unless
+        async_checkpoint=False).
+        """
+        step = self.step + self.resume_step
+        # Sharded state is consolidated on rank 0, which takes every rank.
+        if self.zero_stage:
+            ema_params = [self.opt.gather(params) for params in self.ema_params]
+            opt_state = self.opt.consolidated_state_dict() if self.save_optimizer else None
+        else:
+            ema_params = self.ema_params
+            opt_state = self.opt.state_dict() if self.save_optimizer else None
+        rng_states = dist_util.gather_objects(_get_rng_state())
+        if dist.get_rank() == 0:
+            model_filename = f"model{step:06d}.pt"
+            files = {model_filename: self._master_params_to_state_dict(self.master_params)}
+            for rate, params in zip(self.ema_rate, ema_params):
+                files[f"ema_{rate}_{step:06d}.pt"] = self._master_params_to_state_dict(params)
+            if self.save_optimizer:
+                files[f"opt{step:06d}.pt"] = opt_state
+            if self.grad_scaler is not None:
+                files[f"scaler{step:06d}.pt"] = self.grad_scaler.state_dict()
+            files[f"state{step:06d}.pt"] = {
+                "data": self.data.state_dict() if hasattr(self.data, "state_dict") else None,
+                "rng": rng_states,
+                "schedule_sampler": self.schedule_sampler.state_dict(),
+            }
+            logger.log(f"saving checkpoint {step}...")
+            self.checkpoint_writer.save(step, files, model_filename)
 
         dist.barrier()
 
@@ -371,7 +726,8 @@ class TrainLoop:
         state_dict = self.model.state_dict()
         for i, (name, _value) in enumerate(self.model.named_parameters()):
             assert name in state_dict
-            state_dict[name] = master_params[i]
+            # EMA weights may be kept in a lower precision; checkpoints are fp32.
+            state_dict[name] = master_params[i].float()
         return state_dict
 
     def _state_dict_to_master_params(self, state_dict):
@@ -401,26 +757,57 @@ def get_blob_logdir():
     return os.environ.get("DIFFUSION_BLOB_LOGDIR", logger.get_dir())
 
 
-def find_resume_checkpoint():
+def find_resume_checkpoint(checkpoint_path=None):
     # On your infrastructure, you may want to override this to automatically
     # discover the latest checkpoint on your blob storage, etc.
-    return None
+    # By default, follow the "latest" pointer of the checkpoint writer.
+    return read_latest_checkpoint(checkpoint_path)
 
 
 def find_ema_checkpoint(main_checkpoint, step, rate):
     if main_checkpoint is None:
         return None
-    filename = f"ema_{rate}_{(step):06d}.pt"
+    suffix = INDEXED_SUFFIX if is_indexed_checkpoint(main_checkpoint) else ".pt"
+    filename = f"ema_{rate}_{(step):06d}{suffix}"
     path = bf.join(bf.dirname(main_checkpoint), filename)
     if bf.exists(path):
         return path
     return None
 
 
+def _get_rng_state():
+    """
+    Get the states of the random number generators used by training.
+    """
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "python": random.getstate(),
+        # As a tensor, which th.load() accepts with weights_only.
+        "numpy": (th.from_numpy(keys.astype(np.int64)), pos, has_gauss, cached_gaussian),
+        "torch": th.get_rng_state(),
+    }
+    if dist_util.dev().type == "cuda":
+        state["cuda"] = th.cuda.get_rng_state(dist_util.dev())
+    return state
+
+
+def _set_rng_state(state):
+    random.setstate(state["python"])
+    keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    np.random.set_state(("MT19937", keys.numpy().astype(np.uint32), pos, has_gauss, cached_gaussian))
+    th.set_rng_state(state["torch"])
+    if "cuda" in state and dist_util.dev().type == "cuda":
+        th.cuda.set_rng_state(state["cuda"], dist_util.dev())
+
+
 def log_loss_dict(diffusion, ts, losses):
+    # Everything stays on device until logger.dumpkvs().
+    quartiles = (4 * ts // diffusion.num_timesteps).clamp(max=3)
+    counts = th.bincount(quartiles, minlength=4)
     for key, values in losses.items():
-        logger.logkv_mean(key, values.mean().item())
+        values = values.detach().float()
+        logger.logkv_mean(key, values.mean())
         # Log the quantiles (four quartiles, in particular).
-        for sub_t, sub_loss in zip(ts.cpu().numpy(), values.detach().cpu().numpy()):
-            quartile = int(4 * sub_t / diffusion.num_timesteps)
-            logger.logkv_mean(f"{key}_q{quartile}", sub_loss)
+        sums = th.zeros(4, device=values.device).index_add_(0, quartiles, values)
+        for quartile in range(4):
+            logger.logkv_sum(f"{key}_q{quartile}", sums[quartile], counts[quartile])
@@ -0,0 +1,130 @@
+"""
+Low-variance validation of a diffusion model on held-out data.
+
+A fixed set of examples is drawn once from the validation loader. Every
+example is evaluated at a fixed, stratified set of timesteps (one in each of
+K equal slices of [0, T), at the same offset within its slice every time) and
+with the same noise in every run, so the change of the losses between two
+validations reflects the model rather than sampling noise.
+"""
+
+import contextlib
+import time
+
+import torch as th
+import torch.distributed as dist
+
+from . import dist_util, logger
+
+
+class Validator:
+    """
+    :param diffusion: the diffusion object whose training_losses() are used.
+    :param data: an iterator over held-out (batch, cond) pairs.
+    :param num_batches: the number of batches in the fixed validation set.
+    :param timesteps_per_example: the number K of stratified timesteps at
+                                  which each example is evaluated.
+    :param microbatch: the number of (example, timestep) pairs per forward
+                       pass; -1 for all the pairs of a batch at once. There
+                       are no activations to keep, so this can be larger
+                       than the training microbatch.
+    :param max_seconds: if positive, stop a validation run after this long
+                        (at a batch boundary) and report the losses of the
+                        part that was done.
+    :param num_buckets: the number of timestep buckets the losses are
+                        reported for, as {key}_q{bucket}.
+    :param seed: the seed of the timesteps and the noise.
+    """
+
+    def __init__(
+        self,
+        diffusion,
+        data,
+        num_batches=8,
+        timesteps_per_example=4,
+        microbatch=-1,
+        max_seconds=0.0,
+        num_buckets=4,
+        seed=0,
+    ):
+        self.diffusion = diffusion
+        self.data = data
+        self.num_batches = num_batches
+        self.timesteps_per_example = timesteps_per_example
+        self.microbatch = microbatch
+        self.max_seconds = max_seconds
+        self.num_buckets = num_buckets
+        self.seed = seed
+        self.batches = None
+
+    def _load(self):
+        """
+        Draw the fixed validation set and its timesteps.
+        """
+        generator = th.Generator().manual_seed(self.seed + dist.get_rank())
+        num_timesteps = self.diffusion.num_timesteps
+        k = self.timesteps_per_example
+        self.batches = []
+        for _ in range(self.num_batches):
+            batch, cond = next(self.data)
+            # One timestep in each of k slices of [0, T), per example.
+            offsets = th.rand(batch.shape[0], 1, generator=generator)
+            t = ((th.arange(k) + offsets) * num_timesteps / k).long().clamp(max=num_timesteps - 1)
+            self.batches.append((batch, cond, t.flatten()))
+
+    def run(self, model, autocast=None):
+        """
+        Evaluate the model on the validation set and log the mean losses,
+        prefixed with "eval_", overall and per timestep bucket.
+
+        :param model: the model, in eval mode.
+        :param autocast: an optional function returning an autocast context.
+        :return: the fraction of the validation set that was evaluated.
+        """
+        if self.batches is None:
+            self._load()
+        device = dist_util.dev()
+        start = time.time()
+        done = 0
+        with th.no_grad():
+            for index, (batch, cond, t) in enumerate(self.batches):
+                # At least one batch is evaluated.
+                if index > 0 and self._out_of_time(start):
+                    break
+                # Every (example, timestep) pair is a row.
+                k = self.timesteps_per_example
+                batch = batch.repeat_interleave(k, dim=0)
+                cond = {key: value.repeat_interleave(k, dim=0) for key, value in cond.items()}
+                step = self.microbatch if self.microbatch > 0 else batch.shape[0]
+                # The same noise in every run.
+                with th.random.fork_rng(devices=[device] if device.type == "cuda" else []):
+                    th.manual_seed(self.seed + index)
+                    for i in range(0, batch.shape[0], step):
+                        micro_t = t[i : i + step].to(device)
+                        micro_cond = {key: value[i : i + step].to(device) for key, value in cond.items()}
+                        with autocast() if autocast is not None else contextlib.nullcontext():
+                            losses = self.diffusion.training_losses(
+                                model, batch[i : i + step].to(device), micro_t, model_kwargs=micro_cond
+                            )
+                        self._log(micro_t, losses)
+                done += 1
+        return done / len(self.batches)
+
+    def _out_of_time(self, start):
+        if self.max_seconds <= 0:
+            return False
+        out_of_time = th.tensor(float(time.time() - start > self.max_seconds), device=dist_util.dev())
+        if dist.get_world_size() > 1:
+            # All ranks stop at the same batch.
+            dist.all_reduce(out_of_time, op=dist.ReduceOp.MAX)
+        return bool(out_of_time.item())
+
+    def _log(self, t, losses):
+        buckets = (self.num_buckets * t // self.diffusion.num_timesteps).clamp(max=self.num_buckets - 1)
+        counts = th.bincount(buckets, minlength=self.num_buckets)
+        for key, values in losses.items():
+            values = values.detach().float()
+            logger.logkv_sum(f"eval_{key}", values.sum(), values.numel())
+            sums = th.zeros(self.num_buckets, device=values.device).index_add_(0, buckets, values)
+            for bucket in range(self.num_buckets):
+                logger.logkv_sum(f"eval_{key}_q{bucket}", sums[bucket], counts[bucket])
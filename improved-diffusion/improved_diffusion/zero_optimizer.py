@@ -0,0 +1,226 @@
+"""
+ZeRO-style sharding of the optimizer state (stage 1) and gradients (stage 2)
+across data-parallel ranks.
+
+Every parameter is owned by one rank, which alone keeps its optimizer state
+(and, in TrainLoop, its EMA copies) and updates it; the updated parameters are
+then broadcast from their owners. With stage 2, gradients are reduced to the
+owner of each parameter after every backward pass, instead of all-reduced to
+every rank, and only the owner keeps them. Checkpoints are consolidated on
+one rank in the format of the unsharded optimizer, so they can be loaded with
+or without sharding.
+"""
+
+import torch as th
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+from . import dist_util
+
+
+class ShardedOptimizer:
+    """
+    Wraps an optimizer class so that each rank only steps the parameters it
+    owns.
+
+    :param params: the sequence of parameters, in the same order on all ranks.
+    :param optimizer_class: the optimizer class, e.g. AdamW.
+    :param stage: 1 to shard the optimizer state, 2 to also shard gradients.
+    :param kwargs: passed to the optimizer.
+    """
+
+    def __init__(self, params, optimizer_class, stage=1, **kwargs):
+        assert stage in (1, 2), f"unknown ZeRO stage: {stage}"
+        self.params = list(params)
+        self.stage = stage
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.comm_device = dist_util.dev()
+
+        # Greedily balance the number of elements owned by each rank.
+        self.owner = [0] * len(self.params)
+        loads = [0] * self.world_size
+        for i in sorted(range(len(self.params)), key=lambda i: -self.params[i].numel()):
+            self.owner[i] = loads.index(min(loads))
+            loads[self.owner[i]] += self.params[i].numel()
+        self.indices = [
+            [i for i in range(len(self.params)) if self.owner[i] == rank]
+            for rank in range(self.world_size)
+        ]
+        self.local_params = self.shard(self.params)
+
+        # An optimizer cannot have an empty parameter list.
+        self.optim = optimizer_class(self.local_params, **kwargs) if self.local_params else None
+        # The reduced (averaged) gradients of the local parameters, stage 2.
+        self._grads = None
+        if stage == 2 and self.local_params:
+            self._grads = th.zeros_like(_flatten_dense_tensors([p.detach() for p in self.local_params]))
+
+    @property
+    def param_groups(self):
+        return self.optim.param_groups if self.optim is not None else []
+
+    @property
+    def state(self):
+        return self.optim.state if self.optim is not None else {}
+
+    def shard(self, seq):
+        """
+        Get the items of a per-parameter sequence that this rank owns.
+        """
+        return [seq[i] for i in self.indices[self.rank]]
+
+    def gather(self, local, dst=0):
+        """
+        Reassemble a per-parameter sequence sharded with shard() (e.g. EMA
+        parameters) on rank dst, or on every rank if dst is None. Must be
+        called on all ranks.
+
+        :return: the full list on rank dst, None on the other ranks.
+        """
+        full = [None] * len(self.params)
+        dtype = local[0].dtype if local else self.params[0].dtype
+        dtype = self._broadcast_dtype(dtype)
+        for owner, indices in enumerate(self.indices):
+            if not indices:
+                continue
+            if owner == self.rank:
+                flat = _flatten_dense_tensors([t.detach() for t in local]).to(self.comm_device)
+            else:
+                flat = th.empty(sum(self.params[i].numel() for i in indices), dtype=dtype, device=self.comm_device)
+            dist.broadcast(flat, owner)
+            if dst is None or self.rank == dst:
+                templates = [self.params[i].detach() for i in indices]
+                unflat = local if owner == self.rank else _unflatten_dense_tensors(flat, templates)
+                for i, t in zip(indices, unflat):
+                    full[i] = t
+        return full if dst is None or self.rank == dst else None
+
+    def _broadcast_dtype(self, dtype):
+        # Ranks that own nothing need to know the dtype of the shards.
+        dtypes = [None] * self.world_size
+        dist.all_gather_object(dtypes, dtype if self.local_params else None)
+        return next(d for d in dtypes if d is not None)
+
+    def reduce_gradients(self):
+        """
+        Stage 2: reduce the gradients of the last backward pass to the ranks
+        owning them and free them everywhere. Call after every backward pass,
+        on all ranks.
+        """
+        for owner, indices in enumerate(self.indices):
+            if not indices:
+                continue
+            params = [self.params[i] for i in indices]
+            flat = _flatten_dense_tensors(
+                [p.grad if p.grad is not None else th.zeros_like(p) for p in params]
+            )
+            dist.reduce(flat, owner)
+            if owner == self.rank:
+                self._grads.add_(flat, alpha=1 / self.world_size)
+            for p in params:
+                p.grad = None
+
+    def _install_grads(self):
+        if self._grads is None:
+            return
+        for p, g in zip(self.local_params, _unflatten_dense_tensors(self._grads, self.local_params)):
+            p.grad = g
+
+    def grad_norm(self):
+        """
+        Get the global gradient norm, as a tensor.
+        """
+        if self.stage == 1:
+            grads = [p.grad for p in self.params if p.grad is not None]
+            return th.stack([g.float().norm() for g in grads]).norm()
+        self._install_grads()
+        sqsum = th.zeros([], device=self.comm_device)
+        for p in self.local_params:
+            sqsum += p.grad.float().pow(2).sum().to(self.comm_device)
+        dist.all_reduce(sqsum)
+        return sqsum.sqrt()
+
+    def clip_grad_norm(self, max_norm):
+        """
+        Clip the gradients to a global norm of max_norm; with stage 2 the
+        norm is reduced across ranks.
+        """
+        if self.stage == 1:
+            return th.nn.utils.clip_grad_norm_(self.params, max_norm)
+        norm = self.grad_norm()
+        coef = (max_norm / (norm + 1e-6)).clamp(max=1.0)
+        for p in self.local_params:
+            p.grad.mul_(coef.to(p.grad.device))
+        return norm
+
+    def step(self):
+        """
+        Step the local parameters, then broadcast every parameter from its
+        owner.
+        """
+        self._install_grads()
+        if self.optim is not None:
+            self.optim.step()
+        if self._grads is not None:
+            self._grads.zero_()
+            for p in self.local_params:
+                p.grad = None
+        for owner, indices in enumerate(self.indices):
+            if not indices:
+                continue
+            params = [self.params[i].detach() for i in indices]
+            flat = _flatten_dense_tensors(params)
+            dist.broadcast(flat, owner)
+            if owner != self.rank:
+                for p, t in zip(params, _unflatten_dense_tensors(flat, params)):
+                    p.copy_(t)
+
+    def consolidated_state_dict(self, dst=0):
+        """
+        Gather the optimizer state on rank dst, in the format of the state
+        dict of the unsharded optimizer. Must be called on all ranks.
+
+        :return: the state dict on rank dst, None on the other ranks.
+        """
+        local = self.optim.state_dict() if self.optim is not None else None
+        if local is not None:
+            local = {
+                "state": {
+                    self.indices[self.rank][i]: {
+                        k: v.cpu() if th.is_tensor(v) else v for k, v in state.items()
+                    }
+                    for i, state in local["state"].items()
+                },
+                "param_groups": local["param_groups"],
+            }
+        gathered = [None] * self.world_size if self.rank == dst else None
+        dist.gather_object(local, gathered, dst=dst)
+        if self.rank != dst:
+            return None
+        state, group = {}, None
+        for shard in gathered:
+            if shard is not None:
+                state.update(shard["state"])
+                group = group or shard["param_groups"][0]
+        group = dict(group, params=list(range(len(self.params))))
+        return {"state": state, "param_groups": [group]}
+
+    def load_state_dict(self, state_dict):
+        """
+        Load the local shard of a consolidated (or unsharded optimizer's)
+        state dict.
+        """
+        if self.optim is None:
+            return
+        assert len(state_dict["param_groups"]) == 1, "only a single param group is supported"
+        indices = self.indices[self.rank]
+        group = dict(state_dict["param_groups"][0], params=list(range(len(indices))))
+        self.optim.load_state_dict({
+            "state": {
+                local: state_dict["state"][i]
+                for local, i in enumerate(indices)
+                if i in state_dict["state"]
+            },
+            "param_groups": [group],
+        })
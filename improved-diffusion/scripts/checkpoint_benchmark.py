@@ -0,0 +1,113 @@
+"""
+Measure the memory saved and the throughput cost of the activation
+checkpointing policies (--checkpoint_policy) of the transformer denoisers on
+synthetic token batches.
+
+The activation memory is the size of the tensors autograd saves for backward
+during a training forward pass, so it is measured on CPU as well; the peak
+memory is only reported on CUDA. Model flags are the training ones, e.g.
+    python scripts/checkpoint_benchmark.py --model_arch transformer \
+        --training_mode e2e --vocab_size 218 --image_size 32 --in_channel 32 --out_channel 32
+"""
+
+import argparse
+import time
+
+import torch as th
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    args_to_dict,
+    add_dict_to_argparser,
+)
+
+
+def synthetic_batch(args):
+    seqlen = args.image_size ** 2
+    input_ids = th.randint(0, args.vocab_size, (args.batch_size, seqlen), device=dist_util.dev())
+    return th.zeros(args.batch_size, seqlen, args.in_channel, device=dist_util.dev()), {'input_ids': input_ids}
+
+
+def saved_activation_bytes(diffusion, model, batch, cond):
+    """
+    The number of bytes autograd saves for the backward pass of one loss.
+    """
+    total = 0
+
+    def pack(tensor):
+        nonlocal total
+        total += tensor.numel() * tensor.element_size()
+        return tensor
+
+    t = th.randint(0, diffusion.num_timesteps, (batch.shape[0],), device=batch.device)
+    with th.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        diffusion.training_losses(model, batch, t, model_kwargs=dict(cond))
+    return total
+
+
+def benchmark(args, policy):
+    th.manual_seed(args.seed)
+    args.checkpoint_policy = '' if policy == 'none' else policy
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    model.to(dist_util.dev())
+    model.train()
+    batch, cond = synthetic_batch(args)
+    activations = saved_activation_bytes(diffusion, model, batch, cond)
+
+    def step():
+        t = th.randint(0, diffusion.num_timesteps, (batch.shape[0],), device=batch.device)
+        losses = diffusion.training_losses(model, batch, t, model_kwargs=dict(cond))
+        losses['loss'].mean().backward()
+        model.zero_grad(set_to_none=True)
+
+    for _ in range(args.warmup):
+        step()
+    if th.cuda.is_available():
+        th.cuda.synchronize()
+        th.cuda.reset_peak_memory_stats()
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    if th.cuda.is_available():
+        th.cuda.synchronize()
+    elapsed = time.time() - start
+    peak = th.cuda.max_memory_allocated() / 2 ** 20 if th.cuda.is_available() else float('nan')
+    return args.steps * args.batch_size / elapsed, activations / 2 ** 20, peak
+
+
+def main():
+    args = create_argparser().parse_args()
+    dist_util.setup_dist()
+    logger.configure()
+
+    results = {}
+    for policy in args.policies.split(','):
+        throughput, activations, peak = results[policy] = benchmark(args, policy)
+        if 'none' in results:
+            base_throughput, base_activations, _ = results['none']
+            cost = f'{1 - throughput / base_throughput:+.1%} slower'
+            saved = f'{1 - activations / base_activations:.1%} saved'
+        else:
+            cost = saved = 'baseline'
+        logger.log(f'{policy:>20}: {throughput:8.1f} samples/s ({cost}), '
+                   f'activations {activations:8.1f} MiB ({saved}), peak memory {peak:.0f} MiB')
+
+
+def create_argparser():
+    defaults = dict(
+        policies='none,all,every_2,attention,attention_every_2',
+        batch_size=8,
+        steps=10,
+        warmup=2,
+        seed=101,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
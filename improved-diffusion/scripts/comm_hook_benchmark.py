@@ -0,0 +1,161 @@
+"""
+Compare the DDP gradient compression hooks of TrainLoop (--ddp_comm_hook) on
+synthetic token batches: bytes all-reduced per step, and the steps and time
+taken to reach a fixed (smoothed) training loss. Each hook is launched with
+torchrun on --procs processes from the same initialization.
+
+The target loss is --target_loss, or else the loss the uncompressed run
+reaches after --steps steps; compressed runs get up to --max_steps_factor
+times as many steps to reach it. Model flags are the training ones, e.g.
+    python scripts/comm_hook_benchmark.py --procs 4 --microbatch 8 --model_arch 1d-unet \
+        --training_mode e2e --vocab_size 218 --image_size 8 --in_channel 16 --out_channel 16
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch as th
+import torch.distributed as dist
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    args_to_dict,
+    add_dict_to_argparser,
+)
+from improved_diffusion.train_util import TrainLoop
+
+RESULT_PREFIX = "comm hook result:"
+
+
+def synthetic_data(args):
+    seqlen = args.image_size ** 2
+    generator = th.Generator().manual_seed(args.seed + dist.get_rank())
+    while True:
+        input_ids = th.randint(0, args.vocab_size, (args.batch_size, seqlen), generator=generator)
+        yield th.zeros(args.batch_size, seqlen, args.in_channel), {'input_ids': input_ids}
+
+
+def count_all_reduce_bytes():
+    """
+    Count the bytes all-reduced from Python, which is where the hooks
+    communicate, while counter['enabled'] is set.
+    """
+    counter = dict(bytes=0, enabled=False)
+    all_reduce = dist.all_reduce
+
+    def counting_all_reduce(tensor, *args, **kwargs):
+        if counter['enabled']:
+            counter['bytes'] += tensor.numel() * tensor.element_size()
+        return all_reduce(tensor, *args, **kwargs)
+
+    dist.all_reduce = counting_all_reduce
+    return counter
+
+
+def worker(args):
+    dist_util.setup_dist()
+    logger.configure(format_strs=[])
+    th.manual_seed(args.seed)
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    model.to(dist_util.dev())
+    loop = TrainLoop(
+        model=model,
+        diffusion=diffusion,
+        data=synthetic_data(args),
+        batch_size=args.batch_size,
+        microbatch=args.microbatch,
+        lr=args.lr,
+        ema_rate='0.9999',
+        log_interval=10 ** 9,
+        save_interval=10 ** 9,
+        resume_checkpoint='',
+        checkpoint_path=tempfile.mkdtemp(),
+        ddp_comm_hook='' if args.hook == 'none' else args.hook,
+        powersgd_rank=args.powersgd_rank,
+        powersgd_start_iter=args.powersgd_start_iter,
+    )
+    if args.hook == 'none':
+        # DDP's own all-reduce runs in C++; the equivalent Python hook is counted.
+        loop.ddp_model.register_comm_hook(None, default_hooks.allreduce_hook)
+    counter = count_all_reduce_bytes()
+    data = synthetic_data(args)
+    max_steps = args.steps if args.target_loss <= 0 else args.steps * args.max_steps_factor
+    smoothed, elapsed, step = None, 0.0, 0
+    for step in range(1, max_steps + 1):
+        batch, cond = next(data)
+        start = time.time()
+        counter['enabled'] = True
+        loop.run_step(batch, cond)
+        counter['enabled'] = False
+        elapsed += time.time() - start
+        # The logged loss is averaged over ranks (an all-reduce left out of
+        # the count), so every rank stops together.
+        loss = logger.getkvs(reduce=True)['loss']
+        logger.get_current().clearkvs()
+        smoothed = loss if smoothed is None else 0.9 * smoothed + 0.1 * loss
+        if args.target_loss > 0 and step >= 10 and smoothed <= args.target_loss:
+            break
+    reached = args.target_loss <= 0 or smoothed <= args.target_loss
+    if dist.get_rank() == 0:
+        print(f"{RESULT_PREFIX} {step} {elapsed} {counter['bytes'] / step} {smoothed} {reached}", flush=True)
+
+
+def main():
+    args = create_argparser().parse_args()
+    if args.worker:
+        return worker(args)
+
+    logger.configure()
+    target = args.target_loss
+    baseline_bytes = None
+    for hook in args.hooks.split(','):
+        command = ([sys.executable, '-m', 'torch.distributed.run', '--standalone', '--nproc_per_node', str(args.procs),
+                    __file__] + sys.argv[1:]
+                   + ['--worker', 'True', '--hook', hook, '--target_loss', str(target)])
+        output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                env=dict(os.environ)).stdout
+        line = [l for l in output.splitlines() if l.startswith(RESULT_PREFIX)][-1]
+        steps, elapsed, step_bytes, loss, reached = line[len(RESULT_PREFIX):].split()
+        steps, elapsed, step_bytes, loss = int(steps), float(elapsed), float(step_bytes), float(loss)
+        if target <= 0:
+            # The first (uncompressed) run sets the target.
+            target = loss
+            logger.log(f'target loss: {target:.4f}')
+        baseline_bytes = baseline_bytes or step_bytes
+        logger.log(f'{hook:>14}: {step_bytes / 2 ** 20:8.2f} MiB all-reduced per step '
+                   f'({baseline_bytes / step_bytes:5.1f}x less), '
+                   f'{"reached" if reached == "True" else "did not reach"} loss {target:.4f} '
+                   f'in {steps} steps / {elapsed:.1f}s (final {loss:.4f})')
+
+
+def create_argparser():
+    defaults = dict(
+        hooks='none,fp16,bf16,powersgd',  # the first one sets the target loss
+        procs=2,
+        worker=False,
+        hook='none',
+        batch_size=16,
+        microbatch=-1,
+        lr=1e-3,
+        steps=200,
+        max_steps_factor=3,
+        target_loss=0.0,  # 0 takes the loss of the first hook after --steps steps
+        powersgd_rank=2,
+        powersgd_start_iter=10,
+        seed=101,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
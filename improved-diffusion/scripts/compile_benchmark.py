@@ -0,0 +1,101 @@
+"""
+Compare the training steps/s of TrainLoop with an eager and a compiled
+(compile_step) loss on synthetic token batches. The first compiled steps are
+reported separately, as they include compilation.
+
+Model flags are the training ones, e.g. on CPU
+    python scripts/compile_benchmark.py --model_arch transformer \
+        --training_mode e2e --vocab_size 218 --image_size 16 --in_channel 32
+"""
+
+import argparse
+import tempfile
+import time
+
+import torch as th
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    args_to_dict,
+    add_dict_to_argparser,
+)
+from improved_diffusion.train_util import TrainLoop
+
+
+def synthetic_data(args):
+    seqlen = args.image_size ** 2
+    while True:
+        input_ids = th.randint(0, args.vocab_size, (args.batch_size, seqlen))
+        yield th.zeros(args.batch_size, seqlen, args.in_channel), {'input_ids': input_ids}
+
+
+def benchmark(args, mode):
+    th.manual_seed(args.seed)
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    model.to(dist_util.dev())
+    loop = TrainLoop(
+        model=model,
+        diffusion=diffusion,
+        data=synthetic_data(args),
+        batch_size=args.batch_size,
+        microbatch=args.microbatch,
+        lr=args.lr,
+        ema_rate='0.9999',
+        log_interval=args.steps + args.warmup,
+        save_interval=args.steps + args.warmup,
+        resume_checkpoint='',
+        checkpoint_path=tempfile.mkdtemp(),
+        compile_step=mode == 'compiled',
+        compile_mode=args.compile_mode,
+    )
+    data = synthetic_data(args)
+    start = time.time()
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            if th.cuda.is_available():
+                th.cuda.synchronize()
+            warmup = time.time() - start
+            start = time.time()
+        loop.run_step(*next(data))
+    if th.cuda.is_available():
+        th.cuda.synchronize()
+    elapsed = time.time() - start
+    loss = logger.getkvs().get('loss', float('nan'))
+    logger.get_current().clearkvs()
+    return args.steps / elapsed, warmup, loss
+
+
+def main():
+    args = create_argparser().parse_args()
+    dist_util.setup_dist()
+    logger.configure()
+
+    results = {}
+    for mode in args.modes.split(','):
+        steps_per_sec, warmup, loss = results[mode] = benchmark(args, mode)
+        speedup = steps_per_sec / results['eager'][0] if 'eager' in results else float('nan')
+        logger.log(f'{mode:>8}: {steps_per_sec:7.2f} steps/s ({speedup:.2f}x eager), '
+                   f'first {args.warmup} steps {warmup:.1f}s, mean loss {loss:.4f}')
+
+
+def create_argparser():
+    defaults = dict(
+        modes='eager,compiled',
+        compile_mode='default',
+        batch_size=16,
+        microbatch=-1,
+        lr=1e-4,
+        steps=20,
+        warmup=3,
+        seed=101,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Convert .pt model / EMA checkpoints to the indexed, memory-mappable format
+(see improved_diffusion/indexed_checkpoint.py), e.g.
+    python scripts/convert_checkpoint.py --src diff_models/model200000.pt
+    python scripts/convert_checkpoint.py --src diff_models  # every model / EMA file
+
+The converted files sit next to the originals, with the .safetensors suffix.
+Optimizer and grad scaler states are not flat dicts of tensors and are skipped.
+"""
+
+import argparse
+import re
+
+import blobfile as bf
+import torch as th
+
+from improved_diffusion import logger
+from improved_diffusion.indexed_checkpoint import (
+    INDEXED_SUFFIX,
+    IndexedCheckpoint,
+    save_indexed_checkpoint,
+)
+from improved_diffusion.script_util import add_dict_to_argparser
+
+_CONVERTIBLE_RE = re.compile(r"^(?:model|ema_[0-9.]+_)\d+\.pt$")
+
+
+def convert(src, dst, verify):
+    with bf.BlobFile(src, "rb") as f:
+        state_dict = th.load(f, map_location="cpu")
+    save_indexed_checkpoint(state_dict, dst, metadata={"source": bf.basename(src)})
+    if verify:
+        indexed = IndexedCheckpoint(dst)
+        assert sorted(indexed.keys()) == sorted(state_dict), f"{dst} does not have the keys of {src}"
+        for name, tensor in state_dict.items():
+            assert th.equal(indexed.get_tensor(name), tensor), f"{name} differs in {dst}"
+    size = sum(t.numel() * t.element_size() for t in state_dict.values())
+    logger.log(f"{src} -> {dst}: {len(state_dict)} tensors, {size / 2 ** 20:.1f} MiB")
+
+
+def main():
+    args = create_argparser().parse_args()
+    logger.configure()
+
+    if bf.isdir(args.src):
+        sources = [bf.join(args.src, name) for name in sorted(bf.listdir(args.src)) if _CONVERTIBLE_RE.match(name)]
+    else:
+        sources = [args.src]
+    for src in sources:
+        dst = args.dst if args.dst and len(sources) == 1 else src[: -len(".pt")] + INDEXED_SUFFIX
+        if bf.exists(dst) and not args.overwrite:
+            logger.log(f"{dst} exists, skipping")
+            continue
+        convert(src, dst, args.verify)
+
+
+def create_argparser():
+    defaults = dict(
+        src="",  # a .pt checkpoint, or a checkpoint directory
+        dst="",  # the output path for a single file; next to the source by default
+        verify=True,  # re-read every converted tensor and compare it with the source
+        overwrite=False,
+    )
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Measure how TrainLoop training throughput scales with the number of
+data-parallel processes (DDP over gloo on CPU, NCCL on GPU) on synthetic token
+batches, at a fixed per-process batch size. Each process count is launched
+with mpiexec; the workers also check that the parameters stay identical
+across ranks.
+
+Model flags are the training ones, e.g.
+    python scripts/ddp_scaling_benchmark.py --procs 1,2,4,8 --model_arch transformer \
+        --training_mode e2e --vocab_size 218 --image_size 8 --in_channel 16 --out_channel 16
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch as th
+import torch.distributed as dist
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    args_to_dict,
+    add_dict_to_argparser,
+)
+from improved_diffusion.train_util import TrainLoop
+
+RESULT_PREFIX = "scaling result:"
+
+
+def synthetic_data(args):
+    seqlen = args.image_size ** 2
+    while True:
+        input_ids = th.randint(0, args.vocab_size, (args.batch_size, seqlen))
+        yield th.zeros(args.batch_size, seqlen, args.in_channel), {'input_ids': input_ids}
+
+
+def worker(args):
+    dist_util.setup_dist()
+    logger.configure(format_strs=[])
+    th.manual_seed(args.seed + dist.get_rank())
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    model.to(dist_util.dev())
+    loop = TrainLoop(
+        model=model,
+        diffusion=diffusion,
+        data=synthetic_data(args),
+        batch_size=args.batch_size,
+        microbatch=args.microbatch,
+        lr=1e-4,
+        ema_rate='0.9999',
+        log_interval=args.steps + args.warmup,
+        save_interval=args.steps + args.warmup,
+        resume_checkpoint='',
+        checkpoint_path=tempfile.mkdtemp(),
+    )
+    data = synthetic_data(args)
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            dist.barrier()
+            start = time.time()
+        loop.run_step(*next(data))
+    dist.barrier()
+    elapsed = time.time() - start
+
+    # Every rank must end up with the same weights.
+    checksum = th.stack([p.detach().double().sum() for p in model.parameters()]).sum().reshape(1)
+    checksums = [th.zeros_like(checksum) for _ in range(dist.get_world_size())]
+    dist.all_gather(checksums, checksum)
+    in_sync = all(th.allclose(c, checksum) for c in checksums)
+    if dist.get_rank() == 0:
+        print(f"{RESULT_PREFIX} {args.steps * loop.global_batch / elapsed} {in_sync}", flush=True)
+
+
+def main():
+    args = create_argparser().parse_args()
+    if args.worker:
+        return worker(args)
+
+    logger.configure()
+    baseline = None
+    for procs in [int(n) for n in args.procs.split(',')]:
+        command = ([args.mpiexec, '-n', str(procs)] + args.mpiexec_args.split()
+                   + [sys.executable, __file__, '--worker', 'True'] + sys.argv[1:])
+        # The environment as Python sees it: MPI_Init in this process (on
+        # importing dist_util) adds variables that would make mpiexec fail.
+        output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                env=dict(os.environ)).stdout
+        line = [l for l in output.splitlines() if l.startswith(RESULT_PREFIX)][-1]
+        throughput, in_sync = line[len(RESULT_PREFIX):].split()
+        throughput = float(throughput)
+        baseline = baseline or throughput / procs
+        logger.log(f'{procs:>3} processes: {throughput:9.1f} samples/s, '
+                   f'scaling efficiency {throughput / (procs * baseline):.0%}, parameters in sync: {in_sync}')
+
+
+def create_argparser():
+    defaults = dict(
+        procs='1,2,4',
+        mpiexec='mpiexec',
+        mpiexec_args='',  # e.g. "--oversubscribe --bind-to core"
+        worker=False,
+        batch_size=16,
+        microbatch=-1,
+        steps=20,
+        warmup=3,
+        seed=101,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
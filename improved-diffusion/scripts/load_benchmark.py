@@ -0,0 +1,112 @@
+"""
+Measure the time and memory of dist_util.load_state_dict() against the number
+of ranks, loading through shared memory (the default) and by broadcasting the
+file to every rank. Each configuration is launched with mpiexec on a
+synthetic checkpoint of --size_mb MiB.
+
+The memory reported is the growth of the peak RSS of the worst rank, and the
+growth of the proportional set size (PSS, Linux only) summed over ranks: pages
+shared by the ranks of a node are counted once there, so it is the memory the
+node actually needs.
+    python scripts/load_benchmark.py --procs 1,2,4 --size_mb 512
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch as th
+from mpi4py import MPI
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import add_dict_to_argparser
+
+RESULT_PREFIX = "load result:"
+
+
+def rss_mib():
+    # ru_maxrss is in KiB on Linux, in bytes on macOS.
+    scale = 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def pss_mib():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return float("nan")
+
+
+def worker(args):
+    comm = MPI.COMM_WORLD
+    comm.Barrier()
+    rss_before, pss_before = rss_mib(), pss_mib()
+    start = time.time()
+    state_dict = dist_util.load_state_dict(args.checkpoint, shared_memory=args.mode == "shared", map_location="cpu")
+    # Touch every tensor, as loading it into a model would.
+    checksum = sum(float(t.sum()) for t in state_dict.values())
+    comm.Barrier()
+    elapsed = time.time() - start
+    peak = comm.reduce(rss_mib() - rss_before, op=MPI.MAX)
+    pss = comm.reduce(pss_mib() - pss_before, op=MPI.SUM)
+    checksums = comm.gather(checksum)
+    if comm.rank == 0:
+        consistent = all(c == checksums[0] for c in checksums)
+        print(f"{RESULT_PREFIX} {elapsed} {peak} {pss} {consistent}", flush=True)
+
+
+def main():
+    args = create_argparser().parse_args()
+    if args.worker:
+        return worker(args)
+
+    logger.configure()
+    checkpoint = os.path.join(tempfile.mkdtemp(), "model000000.pt")
+    numel = args.size_mb * 2 ** 20 // 4 // args.num_tensors
+    th.save({f"layer{i}.weight": th.randn(numel) for i in range(args.num_tensors)}, checkpoint)
+    try:
+        for procs in [int(n) for n in args.procs.split(",")]:
+            for mode in args.modes.split(","):
+                command = ([args.mpiexec, "-n", str(procs)] + args.mpiexec_args.split()
+                           + [sys.executable, __file__, "--worker", "True", "--checkpoint", checkpoint,
+                              "--mode", mode])
+                # The environment as Python sees it: MPI_Init in this process
+                # adds variables that would make mpiexec fail.
+                output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                        env=dict(os.environ)).stdout
+                line = [l for l in output.splitlines() if l.startswith(RESULT_PREFIX)][-1]
+                elapsed, peak, pss, consistent = line[len(RESULT_PREFIX):].split()
+                logger.log(f"{procs:>3} processes, {mode:>6}: {float(elapsed):7.2f}s, "
+                           f"peak RSS per rank +{float(peak):8.1f} MiB, total PSS +{float(pss):8.1f} MiB, "
+                           f"consistent: {consistent}")
+    finally:
+        os.remove(checkpoint)
+
+
+def create_argparser():
+    defaults = dict(
+        procs="1,2,4",
+        modes="shared,bcast",
+        size_mb=256,
+        num_tensors=64,
+        mpiexec="mpiexec",
+        mpiexec_args="",  # e.g. "--oversubscribe"
+        worker=False,
+        checkpoint="",
+        mode="shared",
+    )
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
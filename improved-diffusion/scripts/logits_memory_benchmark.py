@@ -0,0 +1,143 @@
+"""
+Measure the peak memory and time of the rounding cross-entropy
+(GaussianDiffusion.token_discrete_loss, forward and backward) against the
+vocabulary size, with all the logits at once (--logits_chunk_size 0) and in
+chunks. Each configuration runs in its own process, so that peaks do not
+carry over; the peak is the CUDA allocator peak on GPU and the growth of the
+peak RSS (Linux only) on CPU.
+
+Each chunk size is also checked against the unchunked loss and gradients.
+    python scripts/logits_memory_benchmark.py --vocab_sizes 1000,10000,30000 --chunk_sizes 0,1024,4096
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import torch as th
+
+from improved_diffusion import logger
+from improved_diffusion.script_util import create_gaussian_diffusion, add_dict_to_argparser
+
+RESULT_PREFIX = "logits result:"
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS to the current RSS, and return it in MiB.
+    """
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+    return _status_mib("VmRSS")
+
+
+def peak_rss():
+    return _status_mib("VmHWM")
+
+
+def _status_mib(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 2 ** 10
+    return float("nan")
+
+
+def make_inputs(args, vocab_size, device, batch_size):
+    th.manual_seed(args.seed)
+    generator = th.Generator().manual_seed(args.seed)
+    lm_head = th.nn.Linear(args.in_channel, vocab_size).to(device)
+    hidden = th.randn(batch_size, args.seqlen, args.in_channel, generator=generator).to(device)
+    input_ids = th.randint(0, vocab_size, (batch_size, args.seqlen), generator=generator).to(device)
+    return lm_head, hidden.requires_grad_(), input_ids
+
+
+def loss_and_grads(args, vocab_size, chunk_size, device, batch_size=None):
+    diffusion = create_gaussian_diffusion(
+        model_arch='transformer', training_mode='e2e', logits_chunk_size=chunk_size
+    )
+    lm_head, hidden, input_ids = make_inputs(args, vocab_size, device, batch_size or args.batch_size)
+    loss = diffusion.token_discrete_loss(hidden, lm_head, input_ids)
+    loss.sum().backward()
+    return loss.detach(), [hidden.grad] + [p.grad for p in lm_head.parameters()]
+
+
+def worker(args):
+    device = th.device(args.device)
+    # Warm up on a single sequence.
+    loss_and_grads(args, args.vocab_size, args.chunk_size, device, batch_size=1)
+    if device.type == "cuda":
+        th.cuda.synchronize()
+        th.cuda.reset_peak_memory_stats(device)
+        before = th.cuda.memory_allocated(device) / 2 ** 20
+    else:
+        before = reset_peak_rss()
+    start = time.time()
+    loss_and_grads(args, args.vocab_size, args.chunk_size, device)
+    if device.type == "cuda":
+        th.cuda.synchronize()
+        peak = th.cuda.max_memory_allocated(device) / 2 ** 20 - before
+    else:
+        peak = peak_rss() - before
+    print(f"{RESULT_PREFIX} {peak} {time.time() - start}", flush=True)
+
+
+def max_difference(args, vocab_size, chunk_size, device):
+    """
+    The largest difference between the chunked and unchunked loss and
+    gradients, relative to the largest magnitude of each.
+    """
+    reference = loss_and_grads(args, vocab_size, 0, device)
+    chunked = loss_and_grads(args, vocab_size, chunk_size, device)
+    pairs = [(reference[0], chunked[0])] + list(zip(reference[1], chunked[1]))
+    return max(float((a - b).abs().max() / a.abs().max().clamp(min=1e-30)) for a, b in pairs)
+
+
+def main():
+    args = create_argparser().parse_args()
+    if not args.device:
+        args.device = "cuda" if th.cuda.is_available() else "cpu"
+    if args.worker:
+        return worker(args)
+
+    logger.configure()
+    logger.log(f"{args.batch_size} x {args.seqlen} positions of {args.in_channel} channels on {args.device}")
+    for vocab_size in [int(v) for v in args.vocab_sizes.split(",")]:
+        logits_mib = args.batch_size * args.seqlen * vocab_size * 4 / 2 ** 20
+        for chunk_size in [int(c) for c in args.chunk_sizes.split(",")]:
+            command = [sys.executable, __file__] + sys.argv[1:] + [
+                "--worker", "True", "--device", args.device,
+                "--vocab_size", str(vocab_size), "--chunk_size", str(chunk_size),
+            ]
+            output = subprocess.run(command, check=True, capture_output=True, text=True,
+                                    env=dict(os.environ)).stdout
+            line = [l for l in output.splitlines() if l.startswith(RESULT_PREFIX)][-1]
+            peak, elapsed = (float(x) for x in line[len(RESULT_PREFIX):].split())
+            difference = max_difference(args, vocab_size, chunk_size, args.device) if chunk_size > 0 else 0.0
+            logger.log(f"vocab {vocab_size:>6} (logits {logits_mib:7.1f} MiB), chunk {chunk_size:>5}: "
+                       f"peak +{peak:8.1f} MiB, {elapsed * 1000:8.1f} ms, "
+                       f"max relative difference {difference:.1e}")
+
+
+def create_argparser():
+    defaults = dict(
+        vocab_sizes="1000,10000,30000",
+        chunk_sizes="0,1024,4096",  # 0 computes all the logits at once
+        batch_size=64,
+        seqlen=256,
+        in_channel=16,
+        device="",  # cuda if available
+        seed=101,
+        worker=False,
+        vocab_size=1000,
+        chunk_size=0,
+    )
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare the training throughput of the precision modes of TrainLoop on
+synthetic token batches: fp32, the legacy fp16 master-param path
+(use_fp16) and autocast bf16 / fp16.
+
+Model flags are the training ones, e.g.
+    python scripts/precision_benchmark.py --model_arch transformer \
+        --training_mode e2e --vocab_size 218 --image_size 16 --in_channel 32
+"""
+
+import argparse
+import tempfile
+import time
+
+import torch as th
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    args_to_dict,
+    add_dict_to_argparser,
+)
+from improved_diffusion.train_util import TrainLoop
+
+
+def synthetic_data(args):
+    seqlen = args.image_size ** 2
+    while True:
+        input_ids = th.randint(0, args.vocab_size, (args.batch_size, seqlen))
+        yield th.zeros(args.batch_size, seqlen, args.in_channel), {'input_ids': input_ids}
+
+
+def benchmark(args, mode):
+    th.manual_seed(args.seed)
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    if mode == 'legacy_fp16' and not hasattr(model, 'convert_to_fp16'):
+        return None
+    model.to(dist_util.dev())
+    loop = TrainLoop(
+        model=model,
+        diffusion=diffusion,
+        data=synthetic_data(args),
+        batch_size=args.batch_size,
+        microbatch=args.microbatch,
+        lr=args.lr,
+        ema_rate='0.9999',
+        log_interval=args.steps + args.warmup,
+        save_interval=args.steps + args.warmup,
+        resume_checkpoint='',
+        use_fp16=mode == 'legacy_fp16',
+        checkpoint_path=tempfile.mkdtemp(),
+        precision='fp32' if mode == 'legacy_fp16' else mode,
+    )
+    data = synthetic_data(args)
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            if th.cuda.is_available():
+                th.cuda.synchronize()
+                th.cuda.reset_peak_memory_stats()
+            start = time.time()
+        loop.run_step(*next(data))
+    if th.cuda.is_available():
+        th.cuda.synchronize()
+    elapsed = time.time() - start
+    loss = logger.getkvs().get('loss', float('nan'))
+    logger.get_current().clearkvs()
+    memory = th.cuda.max_memory_allocated() / 2 ** 20 if th.cuda.is_available() else float('nan')
+    return args.steps * args.batch_size / elapsed, loss, memory
+
+
+def main():
+    args = create_argparser().parse_args()
+    dist_util.setup_dist()
+    logger.configure()
+
+    modes = [m for m in args.modes.split(',') if th.cuda.is_available() or m not in ('fp16', 'legacy_fp16')]
+    results = {}
+    for mode in modes:
+        result = benchmark(args, mode)
+        if result is None:
+            logger.log(f'{mode:>12}: skipped, the model has no convert_to_fp16()')
+            continue
+        results[mode] = result
+        throughput, loss, memory = result
+        speedup = throughput / results['fp32'][0] if 'fp32' in results else float('nan')
+        logger.log(f'{mode:>12}: {throughput:9.1f} samples/s ({speedup:.2f}x fp32), '
+                   f'mean loss {loss:.4f}, peak memory {memory:.0f} MiB')
+
+
+def create_argparser():
+    defaults = dict(
+        modes='fp32,legacy_fp16,bf16,fp16',
+        batch_size=16,
+        microbatch=-1,
+        lr=1e-4,
+        steps=20,
+        warmup=3,
+        seed=101,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
@@ -41,6 +41,9 @@ if __name__ == '__main__':
     parser.add_argument('--midi_tokenizer', type=str, default='REMI', help='')
     parser.add_argument('--data_path', type=str, default='../datasets/midi/giant_midi_piano', help='')
     parser.add_argument('--debug', type=bool, default=False, help='')
+    parser.add_argument('--nproc_per_node', type=int, default=1, help='processes to launch with torchrun')
+    parser.add_argument('--max_restarts', type=int, default=0, help='torchrun restarts of failed workers, '
+                                                                    'resuming from the latest checkpoint')
     args = parser.parse_args()
 
     folder_name = "diffusion_models/"
@@ -102,10 +105,15 @@ if __name__ == '__main__':
     Model_FILE = os.path.join(folder_name, Model_FILE)
 
     app = " " + args.app
+    if args.nproc_per_node > 1 or args.max_restarts > 0:
+        launch = f"torchrun --nnodes=1 --nproc_per_node={args.nproc_per_node} " \
+                 f"--max_restarts={args.max_restarts} "
+    else:
+        launch = "python3 "
     # go command line and run scripts/train.py
     COMMANDLINE = f" OPENAI_LOGDIR={Model_FILE}  " \
                   f"TOKENIZERS_PARALLELISM=false " \
-                  f"python3 scripts/train.py   " \
+                  f"{launch}scripts/train.py   " \
                   f"--checkpoint_path {Model_FILE} " \
                   f"--model_arch {args.model_arch} " \
                   f"--modality {args.modality} " \
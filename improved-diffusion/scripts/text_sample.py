@@ -20,6 +20,10 @@ from improved_diffusion.rounding import rounding_func, load_models, load_tokeniz
 from improved_diffusion.test_util import get_weights, denoised_fn_round
 
 from improved_diffusion import dist_util, logger
+from improved_diffusion.onnx_backend import load_denoiser_backend
+from improved_diffusion.rounding_policy import rounding_policy_defaults, rounding_policy_from_args
+from improved_diffusion.rounding_index import rounding_index_kwargs
+from improved_diffusion.profiler_hook import profiler_defaults, profiler_from_args
 from functools import partial
 from improved_diffusion.script_util import (
     NUM_CLASSES,
@@ -46,6 +50,8 @@ def main():  # !!! don't use checkpoint_path from hyper
     with open(config_path, 'rb', ) as f:
         training_args = json.load(f)
     training_args['batch_size'] = args.batch_size
+    # The profiler flags are the sampler's own.
+    training_args.update({k: getattr(args, k) for k in profiler_defaults()})
     args.__dict__.update(training_args)
     args.sigma_small = True
 
@@ -68,6 +74,13 @@ def main():  # !!! don't use checkpoint_path from hyper
     print(diffusion.rescale_timesteps, 'a marker for whether we are in the debug mode')
     model.to(dist_util.dev())
     model.eval()  # DEBUG
+    model = load_denoiser_backend(
+        args.backend, model, args.onnx_path or os.path.splitext(args.model_path)[0] + '.onnx',
+        seq_len=args.image_size ** 2,
+    )
+    # Every denoising step is a profiler step.
+    profiler = profiler_from_args(args)
+    profiler.attach(model)
 
     if args.experiment_mode == 'conditional_gen':
         from improved_diffusion.text_datasets import load_data_text
@@ -108,12 +121,16 @@ def main():  # !!! don't use checkpoint_path from hyper
     all_labels = []
     print(args.num_samples)
     model3 = get_weights(model2, args)
+    model3 = model3.cuda() if torch.cuda.is_available() else model3
+    branch_timesteps, branch_factors = parse_branch_schedule(args)
+    # MBR candidates share their trajectory down to the branch timesteps
+    branching = args.mbr_sample > 1 and args.experiment_mode == 'conditional_gen' and len(branch_timesteps) > 0
     while len(all_images) * args.batch_size < args.num_samples:
         model_kwargs = {}
         if args.experiment_mode == 'conditional_gen':  # TODO condition
             batch, model_kwargs = next(data)
             model_kwargs.pop('input_ids')
-            if args.mbr_sample > 1:
+            if args.mbr_sample > 1 and not branching:
                 model_kwargs = {k: v.to(dist_util.dev()).repeat_interleave(args.mbr_sample, dim=0) for k, v in model_kwargs.items()}
             else:
                 model_kwargs = {k: v.to(dist_util.dev()) for k, v in model_kwargs.items()}
@@ -137,14 +154,33 @@ def main():  # !!! don't use checkpoint_path from hyper
             else:
                 sample_shape = (args.batch_size, args.image_size ** 2, args.in_channel)
         print(sample_shape)
-        sample = sample_fn(
-            model,
-            sample_shape,
-            clip_denoised=args.clip_denoised,
-            denoised_fn=partial(denoised_fn_round, args, model3.cuda() if torch.cuda.is_available() else model3) if args.clamp == 'clamp' else None,
-            model_kwargs=model_kwargs,
-            top_p =args.top_p,
-        )
+        denoised_fn = rounding_policy_from_args(
+            args, partial(denoised_fn_round, args, model3), model3, diffusion.num_timesteps
+        ) if args.clamp == 'clamp' else None
+        if branching:
+            assert not args.use_ddim, 'branching needs stochastic (non-DDIM) sampling'
+            out = diffusion.p_sample_loop_branching(
+                model,
+                (args.batch_size,) + sample_shape[1:],
+                branch_timesteps,
+                branch_factors,
+                clip_denoised=args.clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+                top_p=args.top_p,
+            )
+            sample = out['sample']
+            logger.log(f"branching saved {out['compute_saved']:.1%} of the model evaluations "
+                       f"({out['model_evals']} vs {out['independent_model_evals']})")
+        else:
+            sample = sample_fn(
+                model,
+                sample_shape,
+                clip_denoised=args.clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+                top_p =args.top_p,
+            )
 
         if args.model_arch == '1d-unet':
             print(sample.shape)
@@ -161,6 +197,7 @@ def main():  # !!! don't use checkpoint_path from hyper
             dist.all_gather(gathered_labels, classes)
             all_labels.extend([labels.cpu().numpy() for labels in gathered_labels])
         logger.log(f"created {len(all_images) * args.batch_size} samples")
+    profiler.close()
 
     arr = np.concatenate(all_images, axis=0)
     print(arr.shape, 'full shape')
@@ -222,7 +259,8 @@ def main():  # !!! don't use checkpoint_path from hyper
                                                os.path.split(args.model_path)[0])
             print('rounding')
             word_lst = rounding_func(args.experiment, arr, model, tokenizer,
-                                     emb_scale_factor=args.emb_scale_factor)
+                                     emb_scale_factor=args.emb_scale_factor,
+                                     index_kwargs=rounding_index_kwargs(args))
         if is_midi_task(args):
             midi_lst = word_lst
             for i, midi in enumerate(midi_lst):
@@ -252,6 +290,25 @@ def main():  # !!! don't use checkpoint_path from hyper
 
 
 
+def parse_branch_schedule(args):
+    """
+    Get the branch timesteps and factors of MBR sampling from e.g.
+    --mbr_branch_timesteps 1000,200 --mbr_branch_factors 2,5; with a single
+    timestep the factor defaults to mbr_sample. Factors must multiply to
+    mbr_sample.
+    """
+    if not args.mbr_branch_timesteps:
+        return [], []
+    timesteps = [int(x) for x in args.mbr_branch_timesteps.split(',')]
+    if args.mbr_branch_factors:
+        factors = [int(x) for x in args.mbr_branch_factors.split(',')]
+    else:
+        factors = [args.mbr_sample] if len(timesteps) == 1 else []
+    assert len(factors) == len(timesteps) and int(np.prod(factors)) == args.mbr_sample, \
+        'mbr_branch_factors must give one factor per branch timestep, multiplying to mbr_sample'
+    return timesteps, factors
+
+
 def create_argparser():
     defaults = dict(
         clip_denoised=False,
@@ -259,10 +316,14 @@ def create_argparser():
         batch_size=64,
         use_ddim=False,
         mbr_sample=1,
+        mbr_branch_timesteps='',  # e.g. 1000,200: share MBR trajectories above these timesteps
+        mbr_branch_factors='',
         model_path="",
         model_arch='conv-unet',
         verbose='yes',
-        out_dir="diffusion_lm/improved_diffusion/out_gen"
+        out_dir="diffusion_lm/improved_diffusion/out_gen",
+        backend='torch',  # torch | onnx
+        onnx_path='',
     )
     text_defaults = dict(modality='text',
                          dataset_name='wikitext',
@@ -273,6 +334,8 @@ def create_argparser():
                          emb_scale_factor=1.0, top_p=-1., split='valid', clamp='clamp', midi_tokenizer='REMI')
     defaults.update(model_and_diffusion_defaults())
     defaults.update(text_defaults)
+    defaults.update(rounding_policy_defaults())
+    defaults.update(profiler_defaults())
     # defaults.update(model_and_diffusion_defaults())
     parser = argparse.ArgumentParser()
     add_dict_to_argparser(parser, defaults)
@@ -22,11 +22,11 @@ from symbolic_music.rounding import load_embedding_model
 from symbolic_music.utils import is_midi_task
 from transformers import AutoTokenizer
 from improved_diffusion.train_util import TrainLoop
+from improved_diffusion.profiler_hook import profiler_defaults, profiler_from_args
 from transformers import set_seed
 from functools import partial
 from improved_diffusion.test_util import get_weights, compute_logp
 from improved_diffusion.rounding import load_models, load_tokenizer
-import wandb
 
 
 def main():
@@ -52,11 +52,15 @@ def main():
     with open(f'{args.checkpoint_path}/training_args.json', 'w') as f:
         json.dump(args.__dict__, f, indent=2)
 
-    wandb.init(
-        project=os.getenv("WANDB_PROJECT", "diffusion_lm"),
-        name=args.checkpoint_path,
-    )
-    wandb.config.update(args.__dict__, allow_val_change=True)
+    if args.use_wandb:
+        import wandb
+
+        wandb.init(
+            project=os.getenv("WANDB_PROJECT", "diffusion_lm"),
+            name=args.checkpoint_path,
+        )
+        wandb.config.update(args.__dict__, allow_val_change=True)
+        logger.add_output_format('wandb')
 
     if args.experiment_mode == 'conditional_gen':
         assert args.modality in ['e2e']
@@ -83,8 +87,6 @@ def main():
         logger.log(f'Finish load training data loader...')
         time.sleep(1)
         point_debug(args)
-        next(data)
-        point_debug(args)
         logger.log(f'Load embedding model...')
         embedding_model = load_embedding_model(args)
         logger.log(f'Load validation data...')
@@ -201,7 +203,31 @@ def main():
         checkpoint_path=args.checkpoint_path,
         gradient_clipping=args.gradient_clipping,
         eval_data=data_valid,
-        eval_interval=args.eval_interval
+        eval_interval=args.eval_interval,
+        precision=args.precision,
+        ema_every=args.ema_every,
+        ema_device=args.ema_device,
+        ema_dtype=args.ema_dtype,
+        auto_microbatch=args.auto_microbatch,
+        microbatch_memory_fraction=args.microbatch_memory_fraction,
+        async_checkpoint=args.async_checkpoint,
+        keep_last_checkpoints=args.keep_last_checkpoints,
+        keep_every_checkpoints=args.keep_every_checkpoints,
+        save_optimizer=args.save_optimizer,
+        sync_timers=args.sync_timers,
+        timer_window=args.timer_window,
+        compile_step=args.compile_step,
+        compile_mode=args.compile_mode,
+        zero_stage=args.zero_stage,
+        eval_batches=args.eval_batches,
+        eval_timesteps=args.eval_timesteps,
+        eval_microbatch=args.eval_microbatch,
+        eval_max_seconds=args.eval_max_seconds,
+        eval_use_ema=args.eval_use_ema,
+        profiler=profiler_from_args(args),
+        ddp_comm_hook=args.ddp_comm_hook,
+        powersgd_rank=args.powersgd_rank,
+        powersgd_start_iter=args.powersgd_start_iter,
     ).run_loop()
 
 
@@ -214,15 +240,39 @@ def create_argparser():
         lr_anneal_steps=0,
         batch_size=1,
         microbatch=-1,  # -1 disables microbatches
+        auto_microbatch=False,  # probe for the largest microbatch that fits on startup
+        microbatch_memory_fraction=0.9,
         ema_rate="0.9999",  # comma-separated list of EMA values
+        ema_every=1,  # update the EMA every k steps, with the rate corrected to rate ** k
+        ema_device='',  # e.g. cpu to keep EMA weights off the accelerator
+        ema_dtype='fp32',  # fp32 | bf16 | fp16
         log_interval=50,
         save_interval=50000,
+        async_checkpoint=True,  # write checkpoints on a background thread
+        keep_last_checkpoints=0,  # prune all but the last N checkpoints (0 keeps all)...
+        keep_every_checkpoints=0,  # ...and those whose step is a multiple of K
+        save_optimizer=False,
+        sync_timers=False,  # synchronize CUDA around timed phases for exact step-time breakdowns
+        timer_window=100,  # steps the step-time statistics are computed over
+        compile_step=False,  # torch.compile the training loss (and its backward)
+        compile_mode="default",  # torch.compile mode, e.g. reduce-overhead or max-autotune
+        zero_stage=0,  # 1 shards the optimizer state and EMA across ranks, 2 also the gradients
+        ddp_comm_hook='',  # gradient compression: fp16 | bf16 | powersgd | powersgd_fp16 | powersgd_bf16
+        powersgd_rank=1,  # rank of the PowerSGD gradient approximation
+        powersgd_start_iter=1000,  # uncompressed steps before PowerSGD starts
         resume_checkpoint="",
         use_fp16=False,
         fp16_scale_growth=1e-3,
+        precision='fp32',  # fp32 | bf16 | fp16 (autocast)
         seed=101,
+        use_wandb=True,  # log metrics to wandb; other sinks via OPENAI_LOG_FORMAT (stdout,log,csv,json,tensorboard)
         gradient_clipping=-1.0,
         eval_interval=2000,
+        eval_batches=8,  # size of the fixed validation set, in batches
+        eval_timesteps=4,  # stratified timesteps per validation example
+        eval_microbatch=-1,  # (example, timestep) pairs per validation forward pass, -1 for a whole batch
+        eval_max_seconds=0.0,  # stop validation early after this long (0 runs it in full)
+        eval_use_ema=True,  # validate the weights of the first EMA rate
         checkpoint_path='diff_models',
         dataset_partition=1.0,
         debug=False
@@ -246,6 +296,7 @@ def create_argparser():
                          midi_tokenizer='REMI')
     defaults.update(model_and_diffusion_defaults())
     defaults.update(text_defaults)
+    defaults.update(profiler_defaults())
     parser = argparse.ArgumentParser()
     add_dict_to_argparser(parser, defaults)
     return parser
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 from improved_diffusion.nn import (
     SiLU,
+    apply_checkpoint_policy,
     linear,
     timestep_embedding,
 )
@@ -19,7 +20,8 @@ class CleanedTransformerModel(nn.Module):
         config_name='bert-base-uncased',
         vocab_size=None,  # size of the vocabulary, e.g. 218 for REMI
         experiment_mode='lm',  # lm or conditional_gen
-        max_position_embeddings=512
+        max_position_embeddings=512,
+        checkpoint_policy='',  # activation checkpointing of the encoder layers, see nn.parse_checkpoint_policy
     ):
         super().__init__()
 
@@ -68,6 +70,9 @@ class CleanedTransformerModel(nn.Module):
         # attention(SelfAttention + output(dense + LayerNorm + drop)) + 放大层dense + output(dense + LayerNorm + drop)
         # -> 768
         self.input_transformers = BertEncoder(config)
+        apply_checkpoint_policy(self.input_transformers.layer, checkpoint_policy, attention_attr='attention')
+        if self.conditional_gen:
+            apply_checkpoint_policy(self.encoder.layer, checkpoint_policy, attention_attr='attention')
         # self.position_ids
         self.register_buffer("position_ids", torch.arange(config.max_position_embeddings).expand((1, -1)))
         # position embedding = 512 -> 768
@@ -3,10 +3,11 @@ import random
 import torch
 from miditoolkit import MidiFile
 import os
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 import numpy as np
 from typing import List
 
+from improved_diffusion.resumable_loader import ResumableLoader
 from improved_diffusion.text_datasets import _collate_batch_helper
 from improved_diffusion.utils import point_debug
 from symbolic_music.advanced_padding import advanced_remi_bar_block
@@ -62,6 +63,13 @@ class MidiDataset(Dataset):
         return self.length
 
     def __getitem__(self, idx):
+        return self.get_example(idx, np.random)
+
+    def get_example(self, idx, rng):
+        """
+        :param rng: the generator of the noise_level augmentation, np.random or a
+                    np.random.Generator (see ResumableLoader).
+        """
         arr = np.array(self.midi_data_list[idx]['hidden_states'], dtype=np.float32)
         if self.eigen_transform is not None:
             old_shape = arr.shape
@@ -71,7 +79,7 @@ class MidiDataset(Dataset):
             arr = arr.reshape(old_shape)
 
         if hasattr(self.data_args, 'noise_level') and self.data_args.noise_level > 0:
-            arr = arr + self.data_args.noise_level * np.random.randn(*arr.shape).astype(arr.dtype)
+            arr = arr + self.data_args.noise_level * rng.standard_normal(arr.shape).astype(arr.dtype)
 
         out_dict = {'input_ids': np.array(self.midi_data_list[idx]['input_ids'])}
         if self.data_args.experiment_mode == 'conditional_gen':  # TODO not implementing conditional gen for now
@@ -98,6 +106,13 @@ class LargeMidiDataset(Dataset):
         return self.length
 
     def __getitem__(self, idx):
+        return self.get_example(idx, np.random)
+
+    def get_example(self, idx, rng):
+        """
+        :param rng: the generator of the noise_level augmentation, np.random or a
+                    np.random.Generator (see ResumableLoader).
+        """
         padded_tokens = self.padded_tokens_list[idx]
         arr = np.array(self.embedding_model(torch.tensor(padded_tokens)).cpu().tolist(), dtype=np.float32)
         if self.eigen_transform is not None:
@@ -108,7 +123,7 @@ class LargeMidiDataset(Dataset):
             arr = arr.reshape(old_shape)
 
         if hasattr(self.data_args, 'noise_level') and self.data_args.noise_level > 0:
-            arr = arr + self.data_args.noise_level * np.random.randn(*arr.shape).astype(arr.dtype)
+            arr = arr + self.data_args.noise_level * rng.standard_normal(arr.shape).astype(arr.dtype)
 
         out_dict = {'input_ids': np.array(padded_tokens)}
         if self.data_args.experiment_mode == 'conditional_gen':  # TODO not implementing conditional gen for now
@@ -207,13 +222,12 @@ def create_midi_dataloader(
             model_arch=data_args.model_arch,  # transformer for NLP / MIDI, or probably use better music transformer? TODO
         )
     print('Making DataLoader...')
-    data_loader = DataLoader(
+    # Shards the batches across ranks; its position is saved with the checkpoints.
+    data_loader = ResumableLoader(
         dataset,
         batch_size=batch_size,  # 64,
-        drop_last=True,
-        shuffle=True,
+        seed=data_args.seed,
         num_workers=1,
     )
     print('Finish making DataLoader...')
-    while True:
-        yield from data_loader
+    return data_loader
@@ -6,6 +6,7 @@ from torch import Tensor
 
 from improved_diffusion.nn import (
     SiLU,
+    apply_checkpoint_policy,
     linear,
     timestep_embedding,
 )
@@ -24,6 +25,7 @@ class LongformerNetModel(nn.Module):
         config_name='allenai/longformer-base-4096',
         vocab_size=None,  # size of the vocabulary, e.g. 218 for REMI
         experiment_mode='lm',  # lm or conditional_gen
+        checkpoint_policy='',  # activation checkpointing of the encoder layers, see nn.parse_checkpoint_policy
     ):
         super().__init__()
 
@@ -71,6 +73,9 @@ class LongformerNetModel(nn.Module):
         # attention(SelfAttention + output(dense + LayerNorm + drop)) + 放大层dense + output(dense + LayerNorm + drop)
         # -> 768
         self.input_transformers = LongformerEncoder(config)
+        apply_checkpoint_policy(self.input_transformers.layer, checkpoint_policy, attention_attr='attention')
+        if self.conditional_gen:
+            apply_checkpoint_policy(self.encoder.layer, checkpoint_policy, attention_attr='attention')
         # self.position_ids
         self.register_buffer("position_ids", torch.arange(config.max_position_embeddings).expand((1, -1)))
         # position embedding = 512 -> 768
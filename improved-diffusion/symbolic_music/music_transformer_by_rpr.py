@@ -1,3 +1,4 @@
+import torch
 from torch.nn import functional as F
 from torch.nn.parameter import Parameter
 from torch.nn import Module
@@ -6,6 +6,7 @@ import torch
 import torch.nn as nn
 from improved_diffusion.nn import (
     SiLU,
+    apply_checkpoint_policy,
     linear,
     timestep_embedding,
 )
@@ -42,6 +43,7 @@ class MusicTransformerModel(nn.Module):
         config_name='bert-base-uncased',
         vocab_size=None,  # size of the vocabulary, e.g. 218 for REMI
         experiment_mode='lm',  # lm or conditional_gen
+        checkpoint_policy='',  # activation checkpointing of the encoder layers, see nn.parse_checkpoint_policy
     ):
         super().__init__()
 
@@ -92,6 +94,9 @@ class MusicTransformerModel(nn.Module):
         # attention(SelfAttention + output(dense + LayerNorm + drop)) + 放大层dense + output(dense + LayerNorm + drop)
         # -> 768
         self.input_transformers = create_music_transformer_encoder_by_config(config, max_sequence=self.max_period)
+        apply_checkpoint_policy(self.input_transformers.layers, checkpoint_policy, attention_attr='self_attn')
+        if self.conditional_gen:
+            apply_checkpoint_policy(self.encoder.layers, checkpoint_policy, attention_attr='self_attn')
         self.positional_encoding = PositionalEncoding(config.hidden_size, self.dropout, self.max_period)
         # self.position_ids
         # self.register_buffer("position_ids", torch.arange(config.max_position_embeddings).expand((1, -1)))
@@ -0,0 +1,137 @@
+import torch
+
+from symbolic_music.utils import get_tokenizer
+
+# REMI token-type successions, used when the tokenizer does not expose its own
+# `tokens_types_graph` (miditok builds the same graph, plus special tokens).
+REMI_TYPES_GRAPH = {
+    'Bar': ['Position', 'Bar'],
+    'Position': ['Pitch', 'Chord', 'Tempo'],
+    'Chord': ['Tempo', 'Pitch'],
+    'Tempo': ['Chord', 'Pitch'],
+    'Pitch': ['Velocity'],
+    'Velocity': ['Duration'],
+    'Duration': ['Pitch', 'Position', 'Bar', 'Chord', 'Rest'],
+    'Rest': ['Rest', 'Position', 'Bar'],
+}
+
+# Types after which a note is incomplete, so the sequence may not stop there.
+NOTE_TYPES = ('Pitch', 'Velocity')
+
+
+def _event_to_token(vocab):
+    if hasattr(vocab, 'event_to_token'):
+        return dict(vocab.event_to_token)
+    return dict(vocab)
+
+
+class RemiGrammar:
+    """
+    A token-type automaton over a REMI vocabulary, used to decode scores into
+    sequences that tokens_to_midi can fully convert.
+
+    The state of a sequence is the type of its last token and the last Position
+    value in the current bar, so besides type successions (e.g. Duration must
+    follow Velocity, which must follow Pitch) Position tokens are forced to
+    increase within a bar.
+
+    :param tokenizer: a miditok REMI tokenizer.
+    :param start_types: token types allowed first; None allows any type.
+    :param strict_notes: if True, PAD/EOS cannot interrupt a Pitch-Velocity-
+                         Duration triplet.
+    """
+
+    def __init__(self, tokenizer, start_types=None, strict_notes=True):
+        event_to_token = _event_to_token(tokenizer.vocab)
+        graph = getattr(tokenizer, 'tokens_types_graph', None)
+        if graph is None:
+            graph = {k: v + ['PAD', 'EOS'] for k, v in REMI_TYPES_GRAPH.items()}
+            graph.update({'PAD': ['PAD', 'EOS'], 'SOS': ['Bar', 'Position'], 'EOS': ['EOS', 'PAD']})
+
+        vocab_size = max(event_to_token.values()) + 1
+        types = sorted({event.split('_')[0] for event in event_to_token} | set(graph))
+        self.types = types
+        type_index = {name: i for i, name in enumerate(types)}
+
+        self.token_type = torch.zeros(vocab_size, dtype=torch.long)
+        self.position_value = torch.full((vocab_size,), -1, dtype=torch.long)
+        for event, token in event_to_token.items():
+            type_, _, value = event.partition('_')
+            self.token_type[token] = type_index[type_]
+            if type_ == 'Position':
+                self.position_value[token] = int(value)
+        self.is_position = self.position_value >= 0
+        self.is_bar = self.token_type == type_index['Bar']
+
+        # transitions[prev_type, token] -> allowed; the extra last row is the start state.
+        type_allowed = torch.zeros(len(types) + 1, len(types), dtype=torch.bool)
+        for prev, nexts in graph.items():
+            for next_ in nexts:
+                if next_ in type_index and not (strict_notes and prev in NOTE_TYPES and next_ in ('PAD', 'EOS')):
+                    type_allowed[type_index[prev], type_index[next_]] = True
+        for name in (start_types or types):
+            if name in type_index:
+                type_allowed[len(types), type_index[name]] = True
+        self.start_state = len(types)
+        self.transitions = type_allowed[:, self.token_type]
+
+    def _to(self, device):
+        if self.transitions.device != device:
+            for name in ('token_type', 'position_value', 'is_position', 'is_bar', 'transitions'):
+                setattr(self, name, getattr(self, name).to(device))
+
+    def decode(self, scores):
+        """
+        Greedily decode the highest-scoring valid sequence, left to right.
+
+        :param scores: a [N x T x V] tensor, higher is better (logits or
+                       negative distances).
+        :return: an [N x T] tensor of token ids.
+        """
+        self._to(scores.device)
+        n, length, _ = scores.shape
+        state = torch.full((n,), self.start_state, dtype=torch.long, device=scores.device)
+        last_position = torch.full((n,), -1, dtype=torch.long, device=scores.device)
+        tokens = []
+        for j in range(length):
+            allowed = self.transitions[state]
+            allowed &= ~(self.is_position[None] & (self.position_value[None] <= last_position[:, None]))
+            token = scores[:, j].masked_fill(~allowed, -float('inf')).argmax(dim=-1)
+            state = self.token_type[token]
+            last_position = torch.where(
+                self.is_bar[token], torch.full_like(last_position, -1),
+                torch.where(self.is_position[token], self.position_value[token], last_position),
+            )
+            tokens.append(token)
+        return torch.stack(tokens, dim=1)
+
+    def count_violations(self, tokens):
+        """
+        Count the grammar violations of each sequence in an [N x T] tensor.
+        """
+        self._to(tokens.device)
+        n, length = tokens.shape
+        state = torch.full((n,), self.start_state, dtype=torch.long, device=tokens.device)
+        last_position = torch.full((n,), -1, dtype=torch.long, device=tokens.device)
+        violations = torch.zeros(n, dtype=torch.long, device=tokens.device)
+        for j in range(length):
+            token = tokens[:, j]
+            ok = self.transitions[state, token]
+            ok &= ~(self.is_position[token] & (self.position_value[token] <= last_position))
+            violations += (~ok).long()
+            state = self.token_type[token]
+            last_position = torch.where(
+                self.is_bar[token], torch.full_like(last_position, -1),
+                torch.where(self.is_position[token], self.position_value[token], last_position),
+            )
+        return violations
+
+
+def create_remi_grammar(args):
+    """
+    Build the grammar of the tokenizer used by a training run; bar_block data
+    always starts with a Bar token.
+    """
+    tokenizer = get_tokenizer(args)
+    start_types = ('Bar',) if args.padding_mode == 'bar_block' else None
+    return RemiGrammar(tokenizer, start_types=start_types)
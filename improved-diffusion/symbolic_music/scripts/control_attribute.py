@@ -13,8 +13,10 @@ from symbolic_music.utils import get_tokenizer
 from transformers import set_seed, BertConfig
 import torch.distributed as dist
 from improved_diffusion.test_util import denoised_fn_round
+from improved_diffusion.rounding_policy import rounding_policy_from_args
 from functools import partial
 from improved_diffusion import logger
+from improved_diffusion.indexed_checkpoint import load_tensor
 from infill_util import langevin_fn3, prepare_args, create_model, create_embedding, save_results
 
 
@@ -42,7 +44,8 @@ def main():
         else:
             model_control = TransformerNetClassifierModel(config, args.in_channel)
         model_control.load_state_dict(th.load(args.control_model_path, map_location=th.device('cpu')))
-        learned_embeddings = th.load(args.model_path, map_location=th.device('cpu'))['word_embedding.weight']
+        # Only reads the embedding from indexed checkpoints (convert_checkpoint.py).
+        learned_embeddings = load_tensor(args.model_path, 'word_embedding.weight')
         model_control.transformer_net.word_embedding.weight.data = learned_embeddings.clone()
         model_control.transformer_net.word_embedding.weight.requires_grad = False
 
@@ -93,7 +96,10 @@ def main():
                 for sample in loop_func_(
                         model,
                         sample_shape,
-                        denoised_fn=partial(denoised_fn_round, args, frozen_embedding_model.cuda() if th.cuda.is_available() else frozen_embedding_model),
+                        denoised_fn=rounding_policy_from_args(
+                            args, partial(denoised_fn_round, args, frozen_embedding_model), frozen_embedding_model,
+                            diffusion.num_timesteps,
+                        ),
                         clip_denoised=args.clip_denoised,
                         model_kwargs=model_kwargs,
                         device=encoded_seq_hidden.device,
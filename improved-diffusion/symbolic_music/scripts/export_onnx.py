@@ -0,0 +1,84 @@
+"""
+Export a trained transformer denoiser to ONNX, check it against torch, and
+benchmark CPU latency of both backends.
+
+The exported file can then be used by midi_sampling.py / text_sample.py with
+--backend onnx --onnx_path <file>.
+"""
+
+import argparse
+import json
+import os
+
+import torch as th
+from transformers import set_seed
+
+from improved_diffusion import logger
+from improved_diffusion.onnx_backend import (
+    export_denoiser_onnx,
+    OnnxDenoiser,
+    check_parity,
+    benchmark_latency,
+)
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    add_dict_to_argparser,
+    args_to_dict,
+)
+
+
+def main():
+    set_seed(101)
+    logger.configure()
+    args = create_argparser().parse_args()
+    config_path = os.path.join(os.path.split(args.model_path)[0], "training_args.json")
+    with open(config_path, 'rb', ) as f:
+        training_args = json.load(f)
+    training_args['batch_size'] = args.batch_size
+    args.__dict__.update(training_args)
+
+    model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    model.load_state_dict(th.load(args.model_path, map_location='cpu'))
+    model.eval()
+
+    seq_len = args.image_size ** 2
+    onnx_path = args.onnx_path or os.path.splitext(args.model_path)[0] + '.onnx'
+    export_denoiser_onnx(model, onnx_path, seq_len=seq_len, opset_version=args.opset_version)
+    denoiser = OnnxDenoiser(onnx_path, model, num_threads=args.num_threads)
+
+    if args.num_threads > 0:
+        th.set_num_threads(args.num_threads)
+    check_parity(
+        model, denoiser,
+        shapes=((1, seq_len // 2), (args.batch_size, seq_len)),
+        num_timesteps=diffusion.num_timesteps,
+        atol=args.atol,
+    )
+    for batch_size in (1, args.batch_size):
+        torch_latency = benchmark_latency(model, args.in_channel, batch_size, seq_len, repeat=args.repeat)
+        onnx_latency = benchmark_latency(denoiser, args.in_channel, batch_size, seq_len, repeat=args.repeat)
+        logger.log(f"batch={batch_size} torch: {torch_latency['mean'] * 1000:.2f}ms "
+                   f"(p90 {torch_latency['p90'] * 1000:.2f}ms), "
+                   f"onnx: {onnx_latency['mean'] * 1000:.2f}ms (p90 {onnx_latency['p90'] * 1000:.2f}ms), "
+                   f"speedup {torch_latency['mean'] / onnx_latency['mean']:.2f}x")
+
+
+def create_argparser():
+    defaults = dict(
+        model_path='',
+        onnx_path='',
+        batch_size=8,
+        opset_version=13,
+        num_threads=0,
+        repeat=20,
+        atol=1e-4,
+    )
+    defaults.update(model_and_diffusion_defaults())
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
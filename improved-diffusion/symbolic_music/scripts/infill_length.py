@@ -13,6 +13,7 @@ from symbolic_music.scripts.infill_util import create_embedding, create_model, p
 from symbolic_music.utils import get_tokenizer
 import torch.distributed as dist
 from improved_diffusion.test_util import denoised_fn_round
+from improved_diffusion.rounding_policy import rounding_policy_from_args
 from functools import partial
 from improved_diffusion import logger
 
@@ -92,7 +93,10 @@ def main():
                     sample_shape,
                     encoded_seq_hidden,
                     partial_mask,
-                    denoised_fn=partial(denoised_fn_round, args, frozen_embedding_model.cuda() if th.cuda.is_available() else frozen_embedding_model),
+                    denoised_fn=rounding_policy_from_args(
+                        args, partial(denoised_fn_round, args, frozen_embedding_model), frozen_embedding_model,
+                        diffusion.num_timesteps,
+                    ),
                     clip_denoised=args.clip_denoised,
                     model_kwargs=model_kwargs,
                     device=encoded_seq_hidden.device,
@@ -9,6 +9,7 @@ from transformers import set_seed
 import torch.distributed as dist
 from improved_diffusion.test_util import get_weights
 from improved_diffusion import dist_util, logger
+from improved_diffusion.rounding_policy import rounding_policy_defaults
 from improved_diffusion.script_util import (
     model_and_diffusion_defaults,
     create_model_and_diffusion,
@@ -27,6 +28,7 @@ def create_argparser():
         control_model_path='./classifier_models/bert/checkpoint-30000/pytorch_model.bin',
     )
     defaults.update(model_and_diffusion_defaults())
+    defaults.update(rounding_policy_defaults())
     parser = argparse.ArgumentParser()
     add_dict_to_argparser(parser, defaults)
     return parser
@@ -12,10 +12,17 @@ import torch
 import torch as th
 import torch.distributed as dist
 
-from symbolic_music.rounding import load_embedding_model, tokens_list_to_midi_list, denoised_fn_round
+from symbolic_music.rounding import (
+    load_embedding_model, tokens_list_to_midi_list, denoised_fn_round, grammar_denoised_fn_round,
+)
+from symbolic_music.remi_grammar import create_remi_grammar
 from transformers import set_seed
 from improved_diffusion.test_util import get_weights
 from improved_diffusion import dist_util, logger
+from improved_diffusion.onnx_backend import load_denoiser_backend
+from improved_diffusion.profiler_hook import profiler_defaults, profiler_from_args
+from improved_diffusion.rounding_index import rounding_index_kwargs
+from improved_diffusion.rounding_policy import rounding_policy_defaults, rounding_policy_from_args
 from functools import partial
 from improved_diffusion.script_util import (
     model_and_diffusion_defaults,
@@ -35,6 +42,8 @@ def __prepare_args():
     with open(config_path, 'rb', ) as f:
         training_args = json.load(f)
     training_args['batch_size'] = args.batch_size
+    # The profiler flags are the sampler's own.
+    training_args.update({k: getattr(args, k) for k in profiler_defaults()})
     args.__dict__.update(training_args)
     args.sigma_small = True
     return args
@@ -51,6 +60,10 @@ def __prepare_models(args):
     print(diffusion.rescale_timesteps, 'a marker for whether we are in the debug mode')
     model.to(dist_util.dev())
     model.eval()  # DEBUG
+    model = load_denoiser_backend(
+        args.backend, model, args.onnx_path or os.path.splitext(args.model_path)[0] + '.onnx',
+        seq_len=args.image_size ** 2,
+    )
     return model, diffusion
 
 
@@ -63,9 +76,14 @@ def __prepare_embedding_model(args, model):
     return frozen_embedding_model
 
 
-def __sampling(args, model, diffusion, frozen_embedding_model):
+def __sampling(args, model, diffusion, frozen_embedding_model, grammar=None):
     all_images = []
     print(args.num_samples)
+    frozen_embedding_model = frozen_embedding_model.cuda() if torch.cuda.is_available() else frozen_embedding_model
+    if args.constrained_rounding == 'all':
+        round_fn = partial(grammar_denoised_fn_round, grammar, frozen_embedding_model)
+    else:
+        round_fn = partial(denoised_fn_round, frozen_embedding_model, index_kwargs=rounding_index_kwargs(args))
 
     while len(all_images) * args.batch_size < args.num_samples:
         model_kwargs = {}
@@ -82,9 +100,9 @@ def __sampling(args, model, diffusion, frozen_embedding_model):
             model,
             sample_shape,
             clip_denoised=args.clip_denoised,
-            denoised_fn=partial(
-                denoised_fn_round,
-                frozen_embedding_model.cuda() if torch.cuda.is_available() else frozen_embedding_model
+            denoised_fn=rounding_policy_from_args(
+                args, round_fn, frozen_embedding_model,
+                diffusion.num_timesteps,
             ) if args.clamp == 'clamp' else None,
             model_kwargs=model_kwargs,
             top_p=args.top_p,
@@ -119,14 +137,19 @@ def __save_results(args, samples, midi_list):
             midi.dump(out_path2)
 
 
-def __calc_indices(samples, model):
+def __calc_indices(samples, model, grammar=None):
     # (sample_size, image_size **2, embedding)
     x_t = th.tensor(samples).cuda() if torch.cuda.is_available() else th.tensor(samples)  # for debug
     # go over the lm head and get logits (sample_size, image_size **2, vocab_len)
     logits = model.get_logits(x_t)  # bsz, seqlen, vocab
     cands = th.topk(logits, k=1, dim=-1)
     print(f"cands is {cands}")
-    return cands.indices
+    if grammar is None:
+        return cands.indices
+    violations = grammar.count_violations(cands.indices[..., 0])
+    logger.log(f'{(violations > 0).sum().item()}/{len(violations)} unconstrained samples break the REMI grammar '
+               f'({violations.float().mean().item():.2f} violations per sample), decoding with the grammar')
+    return grammar.decode(logits).unsqueeze(-1)
 
 
 def main():  # !!! don't use checkpoint_path from hyper
@@ -141,15 +164,20 @@ def main():  # !!! don't use checkpoint_path from hyper
         pass  # TODO
 
     frozen_embedding_model = __prepare_embedding_model(args, model)
+    grammar = create_remi_grammar(args) if args.constrained_rounding != 'none' else None
     logger.log("sampling...")
     start = time.time()
 
-    samples = __sampling(args, model, diffusion, frozen_embedding_model)
+    # Every denoising step is a profiler step.
+    profiler = profiler_from_args(args)
+    profiler.attach(model)
+    samples = __sampling(args, model, diffusion, frozen_embedding_model, grammar)
+    profiler.close()
     print(samples.shape)
     logger.log("sampling complete")
     print(f'Sample cost time: {time.time() - start}')
 
-    midi_list = tokens_list_to_midi_list(args, __calc_indices(samples, model))
+    midi_list = tokens_list_to_midi_list(args, __calc_indices(samples, model, grammar))
     __save_results(args, samples, midi_list)
 
 
@@ -163,7 +191,10 @@ def create_argparser():
         model_path="",
         model_arch='conv-unet',
         verbose='yes',
-        out_dir="diffusion_lm/improved_diffusion/out_gen"
+        out_dir="diffusion_lm/improved_diffusion/out_gen",
+        backend='torch',  # torch | onnx
+        onnx_path='',
+        constrained_rounding='none',  # none | final | all (final and intermediate rounding)
     )
     text_defaults = dict(modality='text',
                          dataset_name='wikitext',
@@ -174,6 +205,8 @@ def create_argparser():
                          emb_scale_factor=1.0, top_p=-1., split='valid', clamp='clamp', midi_tokenizer='REMI')
     defaults.update(model_and_diffusion_defaults())
     defaults.update(text_defaults)
+    defaults.update(rounding_policy_defaults())
+    defaults.update(profiler_defaults())
     parser = argparse.ArgumentParser()
     add_dict_to_argparser(parser, defaults)
     return parser
@@ -0,0 +1,178 @@
+"""
+Quantize a MIDI denoiser (and optionally its guidance classifier) to int8 and
+report how far the int8 models drift from float32.
+
+The quantized state dicts are cached next to the checkpoints (or in
+--cache_dir), so later runs only pay for the comparison.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import torch as th
+from transformers import set_seed, BertConfig
+
+from improved_diffusion import logger
+from improved_diffusion.quantization import (
+    load_quantized_model,
+    quantized_cache_path,
+    model_size_mb,
+    rounded_token_agreement,
+    classifier_accuracy,
+)
+from improved_diffusion.script_util import (
+    model_and_diffusion_defaults,
+    create_model_and_diffusion,
+    add_dict_to_argparser,
+    args_to_dict,
+)
+from music_classifier.trainer import create_dataset
+from music_classifier.transfomer_net import TransformerNetClassifierModel
+
+
+def __prepare_args():
+    args = create_argparser().parse_args()
+    config_path = os.path.join(os.path.split(args.model_path)[0], "training_args.json")
+    with open(config_path, 'rb', ) as f:
+        training_args = json.load(f)
+    training_args['batch_size'] = args.batch_size
+    args.__dict__.update(training_args)
+    args.sigma_small = True
+    return args
+
+
+def __load_tokens(args):
+    x, y = create_dataset(args, args.split)
+    x = th.tensor(np.array(x[: args.num_samples + args.calibration_size]), dtype=th.long)
+    return x[: args.num_samples], x[args.num_samples:], list(y[: args.num_samples])
+
+
+def __latency(model, inputs, repeat=5):
+    with th.no_grad():
+        model(*inputs)
+        start = time.time()
+        for _ in range(repeat):
+            model(*inputs)
+    return (time.time() - start) / repeat
+
+
+def __quantize_denoiser(args, eval_ids, calib_ids):
+    def model_fn():
+        return create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))[0]
+
+    fp32_model, diffusion = create_model_and_diffusion(**args_to_dict(args, model_and_diffusion_defaults().keys()))
+    fp32_model.load_state_dict(th.load(args.model_path, map_location='cpu'))
+    fp32_model.eval()
+
+    def calibrate_fn(model):
+        for i in range(0, calib_ids.shape[0], args.batch_size):
+            x_start = model.get_embeds(calib_ids[i: i + args.batch_size])
+            t = th.randint(0, diffusion.num_timesteps, (x_start.shape[0],))
+            model(diffusion.q_sample(x_start, t), diffusion._scale_timesteps(t))
+
+    int8_model = load_quantized_model(
+        model_fn, args.model_path, mode=args.quant_mode, cache_dir=args.cache_dir or None,
+        calibrate_fn=calibrate_fn if calib_ids.shape[0] else None,
+    )
+
+    timesteps = [min(int(t), diffusion.num_timesteps - 1) for t in args.report_timesteps.split(',')]
+    agreement = rounded_token_agreement(fp32_model, int8_model, diffusion, eval_ids, timesteps)
+    for t, (agree, acc32, acc8) in agreement.items():
+        logger.log(f't={t}: token agreement {agree:.4f}, fp32 acc {acc32:.4f}, int8 acc {acc8:.4f}')
+
+    x_t = fp32_model.get_embeds(eval_ids[: args.batch_size])
+    t = th.zeros(x_t.shape[0], dtype=th.long)
+    report = {
+        'token_agreement': agreement,
+        'fp32_size_mb': model_size_mb(fp32_model),
+        'int8_size_mb': model_size_mb(int8_model),
+        'fp32_latency_s': __latency(fp32_model, (x_t, t)),
+        'int8_latency_s': __latency(int8_model, (x_t, t)),
+    }
+    logger.log(f"denoiser size {report['fp32_size_mb']:.1f}MB -> {report['int8_size_mb']:.1f}MB, "
+               f"latency {report['fp32_latency_s']:.4f}s -> {report['int8_latency_s']:.4f}s")
+    return report
+
+
+def __quantize_classifier(args, eval_ids, calib_ids, raw_labels):
+    config = BertConfig.from_json_file(os.path.join(os.path.split(args.control_model_path)[0], '..', 'bert-config.json'))
+    labels = th.tensor([config.label2id.get(str(y), config.label2id.get('-1', 0)) for y in raw_labels])
+    learned_embeddings = th.load(args.model_path, map_location='cpu')['word_embedding.weight']
+
+    def model_fn():
+        model = TransformerNetClassifierModel(config, args.in_channel)
+        model.transformer_net.word_embedding.weight.data = learned_embeddings.clone()
+        return model
+
+    fp32_model = model_fn()
+    fp32_model.load_state_dict(th.load(args.control_model_path, map_location='cpu'))
+    fp32_model.eval()
+
+    def timesteps_for(n):
+        return th.full((n,), args.classifier_t, dtype=th.long)
+
+    def calibrate_fn(model):
+        for i in range(0, calib_ids.shape[0], args.batch_size):
+            batch = calib_ids[i: i + args.batch_size]
+            model(input_ids=batch, labels=None, timesteps=timesteps_for(batch.shape[0]))
+
+    int8_model = load_quantized_model(
+        model_fn, args.control_model_path, mode=args.quant_mode, cache_dir=args.cache_dir or None,
+        calibrate_fn=calibrate_fn if calib_ids.shape[0] else None,
+    )
+    timesteps = timesteps_for(eval_ids.shape[0])
+    report = {
+        'fp32_accuracy': classifier_accuracy(fp32_model, eval_ids, labels, timesteps, args.batch_size),
+        'int8_accuracy': classifier_accuracy(int8_model, eval_ids, labels, timesteps, args.batch_size),
+        'fp32_size_mb': model_size_mb(fp32_model),
+        'int8_size_mb': model_size_mb(int8_model),
+    }
+    logger.log(f"classifier accuracy fp32 {report['fp32_accuracy']:.4f}, int8 {report['int8_accuracy']:.4f}")
+    return report
+
+
+def main():
+    set_seed(101)
+    logger.configure()
+    args = __prepare_args()
+    eval_ids, calib_ids, raw_labels = __load_tokens(args)
+    if args.quant_mode == 'dynamic':
+        calib_ids = calib_ids[:0]
+
+    report = {'quant_mode': args.quant_mode, 'denoiser': __quantize_denoiser(args, eval_ids, calib_ids)}
+    if args.control_model_path:
+        report['classifier'] = __quantize_classifier(args, eval_ids, calib_ids, raw_labels)
+
+    out_path = quantized_cache_path(args.model_path, args.quant_mode, args.cache_dir or None)[:-3] + '.report.json'
+    logger.log(f'saving report to {out_path}')
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def create_argparser():
+    defaults = dict(
+        model_path='',
+        control_model_path='',
+        quant_mode='dynamic',  # dynamic | static
+        cache_dir='',
+        batch_size=32,
+        num_samples=256,
+        calibration_size=64,
+        report_timesteps='0,100,500,1000,1999',
+        classifier_t=2000,  # the classifier's "clean input" time embedding
+        split='valid',
+        data_path='../datasets/midi/midi_files',
+        output_path='./classifier_models/bert/',
+    )
+    defaults.update(model_and_diffusion_defaults())
+    defaults.update(dict(midi_tokenizer='REMI', padding_mode='bar_block'))
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+if __name__ == "__main__":
+    main()
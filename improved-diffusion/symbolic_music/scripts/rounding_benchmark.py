@@ -0,0 +1,114 @@
+"""
+Benchmark the rounding policies: sampling time against sample quality.
+
+Every policy samples from the same seed, so the final tokens can be compared
+with those of the "always" policy. Quality is reported as the agreement with
+"always", the mean distance of the final samples to their nearest embedding,
+and the fraction of samples that decode to a non-empty MIDI file.
+
+Policies are given as name[:value], e.g.
+    --policies always,threshold:100,every_k:5,soft:1.0
+where the value is the threshold, k, or the soft rounding temperature.
+"""
+
+import json
+import os
+import time
+from functools import partial
+
+import torch as th
+from transformers import set_seed
+
+from improved_diffusion import dist_util, logger
+from improved_diffusion.script_util import add_dict_to_argparser
+from improved_diffusion.rounding_policy import create_rounding_policy
+from improved_diffusion.test_util import denoised_fn_round
+from symbolic_music.rounding import tokens_list_to_midi_list
+from symbolic_music.scripts.infill_util import create_argparser, create_model, create_embedding
+
+
+def __prepare_args():
+    parser = create_argparser()
+    add_dict_to_argparser(parser, dict(
+        policies='always,threshold:200,threshold:50,every_k:5,every_k:20,soft:1.0',
+        num_batches=1,
+        seed=101,
+    ))
+    args = parser.parse_args()
+    config_path = os.path.join(os.path.split(args.model_path)[0], "training_args.json")
+    with open(config_path, 'rb', ) as f:
+        training_args = json.load(f)
+    training_args['batch_size'] = args.batch_size
+    args.__dict__.update(training_args)
+    args.sigma_small = True
+
+    dist_util.setup_dist()
+    logger.configure()
+    return args
+
+
+def __parse_policy(spec):
+    name, _, value = spec.partition(':')
+    kwargs = {}
+    if name == 'threshold':
+        kwargs['t_threshold'] = int(value or 200)
+    elif name == 'every_k':
+        kwargs['every_k'] = int(value or 10)
+    elif name == 'soft':
+        kwargs['temperature'] = float(value or 1.0)
+    return name, kwargs
+
+
+def __valid_midi_count(args, tokens):
+    count = 0
+    for seq in tokens:
+        try:
+            midi = tokens_list_to_midi_list(args, seq[None, :, None])[0]
+            count += int(sum(len(ins.notes) for ins in midi.instruments) > 0)
+        except Exception:
+            pass
+    return count
+
+
+def main():
+    args = __prepare_args()
+    model, diffusion = create_model(args)
+    frozen_embedding_model = create_embedding(args, model)
+    weight = frozen_embedding_model.weight
+    sample_shape = (args.batch_size, args.image_size ** 2, args.in_channel)
+
+    reference = None
+    for spec in args.policies.split(','):
+        name, kwargs = __parse_policy(spec)
+        policy = create_rounding_policy(
+            name, partial(denoised_fn_round, args, frozen_embedding_model),
+            embedding=frozen_embedding_model, num_timesteps=diffusion.num_timesteps, **kwargs
+        )
+        set_seed(args.seed)
+        start = time.time()
+        samples = []
+        for _ in range(args.num_batches):
+            sample_fn = diffusion.p_sample_loop if not args.use_ddim else diffusion.ddim_sample_loop
+            samples.append(sample_fn(
+                model, sample_shape, clip_denoised=args.clip_denoised, denoised_fn=policy, model_kwargs={},
+                device=weight.device,
+            ))
+        elapsed = time.time() - start
+        samples = th.cat(samples)
+
+        with th.no_grad():
+            tokens = model.get_logits(samples).argmax(dim=-1)
+            flat = samples.reshape(-1, samples.size(-1)).to(weight.device)
+            dist = th.cdist(flat, weight).min(dim=-1).values.mean().item()
+        if reference is None:
+            reference = tokens
+        agreement = (tokens == reference).float().mean().item()
+        valid = __valid_midi_count(args, tokens.cpu())
+        logger.log(
+            f'{spec:>16}: {elapsed:8.2f}s, rounded {policy.num_rounded}/{policy.num_calls} steps, '
+            f'agreement {agreement:.4f}, nearest-emb dist {dist:.4f}, valid midi {valid}/{tokens.shape[0]}'
+        )
+
+
+if __name__ == "__main__":
+    main()